@@ -0,0 +1,213 @@
+# batch_process.py
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import cv2
+
+import process_image as pi
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff")
+
+OUTPUT_EXTENSIONS = {
+    "png": ".png",
+    "webp": ".webp",
+    "jpeg": ".jpg",
+}
+
+def params_to_argv(params):
+    """
+    تبدیل دیکشنری پارامترهای افکت ({"blur": 5, "faceEnhance": true, ...}) به آرگومان‌های process_image.py.
+    مقدارهای دیکشنری/لیست (مثل "pipeline") به صورت JSON فرستاده می‌شوند.
+    """
+    argv = []
+    for key, value in (params or {}).items():
+        if isinstance(value, bool):
+            value = 'True' if value else 'False'
+        elif isinstance(value, (dict, list)):
+            value = json.dumps(value)
+        argv += [f"--{key}", str(value)]
+    return argv
+
+def collect_entries(source, output_dir, output_extension):
+    """
+    فهرست کارها از یک پوشه، الگوی glob یا مانیفست JSONL.
+    هر کار: {"input": ..., "output": ..., "argv": [...]}؛ در مانیفست هر خط {"input", "output"?, "params"?} است.
+    پسوند خروجی پیش‌فرض هر خط مانیفست از outputFormat همان خط می‌آید و در نبودش از output_extension (فرمت preset).
+    """
+    if source.endswith(".jsonl") and os.path.isfile(source):
+        entries = []
+        with open(source, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                item = json.loads(line)
+                params = item.get("params") or {}
+                entry_extension = OUTPUT_EXTENSIONS.get(params.get("outputFormat"), output_extension)
+                entries.append({
+                    "input": item["input"],
+                    "output": item.get("output") or default_output_path(item["input"], None, output_dir, entry_extension),
+                    "argv": params_to_argv(params),
+                })
+        return entries
+
+    if os.path.isdir(source):
+        root = source
+        paths = []
+        for directory, _, files in os.walk(source):
+            paths += [os.path.join(directory, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        root = None
+        paths = [path for path in glob.glob(source, recursive=True) if path.lower().endswith(IMAGE_EXTENSIONS)]
+
+    return [
+        {"input": path, "output": default_output_path(path, root, output_dir, output_extension), "argv": []}
+        for path in sorted(paths)
+    ]
+
+def default_output_path(input_path, root, output_dir, output_extension):
+    """
+    مسیر خروجی: همان مسیر نسبی ورودی (نسبت به پوشهٔ مبدأ) در output_dir با پسوند فرمت خروجی.
+    """
+    relative = os.path.relpath(input_path, root) if root else os.path.basename(input_path)
+    return os.path.join(output_dir, os.path.splitext(relative)[0] + output_extension)
+
+def load_finished(summary_path):
+    """
+    خروجی‌هایی که در اجرای قبلی با موفقیت تمام شده‌اند (از فایل خلاصهٔ JSONL).
+    """
+    finished = set()
+    if not summary_path or not os.path.exists(summary_path):
+        return finished
+    with open(summary_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # خط آخر ممکن است در اجرای قطع‌شده نیمه‌کاره مانده باشد
+                continue
+            if record.get("ok") and os.path.exists(record.get("output", "")):
+                finished.add(record["output"])
+    return finished
+
+# وضعیت گرم هر پروسهٔ worker
+_PARSER = None
+_PRESET_ARGV = []
+_VERBOSE = False
+
+def init_worker(preset_argv, verbose):
+    """
+    مقداردهی اولیهٔ هر پروسهٔ worker: مدل‌های لازم برای preset یک بار بارگذاری می‌شوند.
+    """
+    global _PARSER, _PRESET_ARGV, _VERBOSE
+    _VERBOSE = verbose
+    # موازی‌سازی در سطح پروسه‌هاست؛ نخ‌های OpenCV هر پروسه محدود می‌شوند
+    cv2.setNumThreads(1)
+    _PARSER = pi.build_arg_parser()
+    _PRESET_ARGV = list(preset_argv)
+    preset = _PARSER.parse_args(_PRESET_ARGV)
+    # needs_face_landmarks پلن را چاپ می‌کند؛ در initializer هر پروسه ساکت می‌ماند
+    with contextlib.redirect_stdout(sys.stdout if verbose else io.StringIO()):
+        needs_landmarks = pi.needs_face_landmarks(preset)
+    if needs_landmarks:
+        pi.get_face_mesh()
+    if preset.removeBg.lower() == 'true':
+        pi.get_rembg_session(preset.rembgModel, preset.rembgThreads)
+    pi.load_overlay_asset(pi.GLASSES_IMAGE_PATH)
+
+def process_entry(entry):
+    """
+    اجرای یک کار در worker و برگرداندن رکورد خلاصه؛ خطای یک فایل کل دسته را متوقف نمی‌کند.
+    """
+    start = time.perf_counter()
+    record = {"input": entry["input"], "output": entry["output"], "ok": True}
+    # لاگ‌های process_image جمع می‌شوند تا پیام خطای همان فایل در خلاصه بیاید
+    log = sys.stdout if _VERBOSE else io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log):
+            args = _PARSER.parse_args(_PRESET_ARGV + entry["argv"] + [entry["input"], "-"])
+            outputs = pi.run_job(args)
+        profiler = pi.last_job_profile()
+        if profiler is not None:
+            record["profile"] = profiler.to_record()
+        os.makedirs(os.path.dirname(os.path.abspath(entry["output"])), exist_ok=True)
+        pi.write_outputs(outputs, entry["output"])
+    except SystemExit as e:
+        record["ok"] = False
+        errors = [] if _VERBOSE else [line for line in log.getvalue().splitlines() if line.startswith("Error")]
+        record["error"] = errors[-1] if errors else f"job exited with status {e.code}"
+    except Exception as e:
+        record["ok"] = False
+        record["error"] = str(e)
+    record["seconds"] = round(time.perf_counter() - start, 3)
+    record["peakRssMb"] = round(pi.peak_rss_mb(), 1)
+    record["pid"] = os.getpid()
+    return record
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Apply one effect preset to a directory, glob or JSONL manifest of images. '
+                    'Unrecognised flags are passed to process_image.py as the preset.'
+    )
+    parser.add_argument('source', type=str, help='Input directory, glob pattern or JSONL manifest')
+    parser.add_argument('--outputDir', type=str, default='batch_output', help='Output directory for directory/glob sources and manifest entries without an output')
+    parser.add_argument('--summary', type=str, default='', help='JSONL summary file (default: <outputDir>/summary.jsonl)')
+    parser.add_argument('--processes', type=int, default=0, help='Worker processes (0 = CPU count)')
+    parser.add_argument('--resume', type=str, default='True', help='Skip files already finished in the summary (True/False)')
+    parser.add_argument('--verbose', action='store_true', help='Keep per-stage log lines from the workers')
+    args, preset_argv = parser.parse_known_args()
+
+    # هر پروسه تک‌نخی اجرا می‌شود مگر اینکه preset خودش --threads بدهد
+    preset_argv = ['--threads', '1'] + preset_argv
+    try:
+        preset = pi.build_arg_parser().parse_args(preset_argv)
+    except SystemExit:
+        print("Error: invalid preset flags for process_image.py", file=sys.stderr)
+        sys.exit(1)
+
+    output_extension = OUTPUT_EXTENSIONS.get(preset.outputFormat or "png")
+    summary_path = args.summary or os.path.join(args.outputDir, "summary.jsonl")
+
+    try:
+        entries = collect_entries(args.source, args.outputDir, output_extension)
+    except Exception as e:
+        print(f"Error collecting inputs: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    finished = load_finished(summary_path) if args.resume.lower() == 'true' else set()
+    pending = [entry for entry in entries if entry["output"] not in finished]
+    print(f"{len(entries)} file(s), {len(entries) - len(pending)} already done, {len(pending)} to process", file=sys.stderr)
+    if not pending:
+        return
+
+    os.makedirs(os.path.dirname(os.path.abspath(summary_path)), exist_ok=True)
+    processes = args.processes or os.cpu_count() or 1
+    done = failed = 0
+    start = time.perf_counter()
+    with open(summary_path, "a", encoding="utf-8") as summary, \
+            multiprocessing.Pool(processes, initializer=init_worker, initargs=(preset_argv, args.verbose)) as pool:
+        # imap_unordered با chunksize=1: پروسه‌ها مستقل از هم در مراحل مختلف دیکد/پردازش/کد کردن هستند
+        for record in pool.imap_unordered(process_entry, pending, chunksize=1):
+            summary.write(json.dumps(record) + "\n")
+            summary.flush()
+            done += 1
+            if not record["ok"]:
+                failed += 1
+                print(f"Failed: {record['input']}: {record['error']}", file=sys.stderr)
+            if done % 10 == 0 or done == len(pending):
+                elapsed = time.perf_counter() - start
+                print(f"{done}/{len(pending)} processed, {failed} failed, {done / elapsed:.2f} files/s", file=sys.stderr)
+
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
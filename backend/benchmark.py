@@ -0,0 +1,388 @@
+# benchmark.py
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import cv2
+import numpy as np
+
+import process_image as pi
+
+def synthetic_subject(megapixels, seed=0, with_face=True, transparent=True):
+    """
+    ساخت یک تصویر مصنوعی BGRA شبیه خروجی rembg: سوژهٔ بیضی‌شکل با پوست نویزدار روی پس‌زمینهٔ شفاف.
+    transparent=False: آلفای کاملاً مات (مثل عکسی که پس‌زمینه‌اش حذف نشده)؛ سوژه کل قاب است.
+    خروجی: (image, geometries) که geometries هندسهٔ مصنوعی چهره است (یا لیست خالی).
+    """
+    rng = np.random.default_rng(seed)
+    height = int(round((megapixels * 1e6 * 4 / 3) ** 0.5))
+    width = int(round(megapixels * 1e6 / height))
+
+    image = np.zeros((height, width, 4), dtype=np.uint8)
+    noise = rng.normal(0, 18, (height, width, 3))
+    image[:, :, :3] = np.clip(noise + (120, 150, 200), 0, 255).astype(np.uint8)
+    center = (width // 2, height // 2)
+    alpha = np.zeros((height, width), dtype=np.uint8)
+    cv2.ellipse(alpha, center, (int(width * 0.35), int(height * 0.45)), 0, 0, 360, 255, -1)
+    image[:, :, 3] = alpha if transparent else 255
+
+    geometries = []
+    if with_face:
+        geometries.append(synthetic_face_geometry(width, height, (0.5, 0.4), (0.15, 0.2), seed))
+    return image, geometries
+
+def synthetic_face_points(center, axes, seed=0):
+    """
+    478 نقطهٔ مصنوعی چهره درون یک بیضی (مختصات نرمال‌شده، هم‌شکل خروجی detect_faces).
+    """
+    rng = np.random.default_rng(seed)
+    angles = rng.uniform(0, 2 * np.pi, 478)
+    radii = np.sqrt(rng.uniform(0, 1, 478))
+    return np.stack([
+        center[0] + axes[0] * radii * np.cos(angles),
+        center[1] + axes[1] * radii * np.sin(angles),
+    ], axis=1).astype(np.float32)
+
+def synthetic_face_geometry(width, height, center, axes, seed=0):
+    """
+    ساخت FaceGeometry مصنوعی با 478 نقطه درون یک بیضی (مختصات نرمال‌شده)،
+    تا افکت‌های چهره بدون mediapipe قابل اندازه‌گیری باشند.
+    """
+    return pi.FaceGeometry(synthetic_face_points(center, axes, seed), width, height)
+
+@contextlib.contextmanager
+def synthetic_face_detection(faces):
+    """
+    جایگزینی موقت detect_faces با نقاط مصنوعی (نرمال‌شده نسبت به کل قاب) تا خط لوله بدون mediapipe
+    و بدون شبکه اجرا شود. process_subject تشخیص را روی کل قاب منبع (پیش از پیش‌نمایش و برش) صدا می‌زند
+    و خودش landmarkها را به دستگاه برش نگاشت می‌کند، پس نقاط بدون تغییر برگردانده می‌شوند.
+    """
+    original = pi.detect_faces
+
+    def detect(bgr, max_side=1024):
+        return [points.copy() for points in faces]
+
+    pi.detect_faces = detect
+    try:
+        yield
+    finally:
+        pi.detect_faces = original
+
+def time_call(func, repeats=3):
+    """
+    کمترین زمان اجرای func در چند تکرار (ثانیه) و خروجی آخرین اجرا.
+    """
+    best = None
+    result = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+def peak_traced_mb(func):
+    """
+    بیشینهٔ حافظهٔ تخصیص‌یافته (مگابایت) در یک اجرای func طبق tracemalloc (آرایه‌های numpy را هم می‌شمارد).
+    جدا از زمان‌سنجی اجرا می‌شود چون tracemalloc اجرا را کند می‌کند.
+    """
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / (1024 * 1024)
+
+def max_rss_mb():
+    """
+    بیشینهٔ RSS پروسه تا این لحظه (مگابایت).
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def measure(record, func, repeats):
+    """
+    تکمیل record با بهترین زمان، بیشینهٔ حافظهٔ tracemalloc و RSS پروسه.
+    """
+    # لاگ‌های print تابع‌های process_image در خروجی JSON قاطی نشوند
+    with contextlib.redirect_stdout(io.StringIO()):
+        seconds, _ = time_call(func, repeats)
+        traced = peak_traced_mb(func)
+    record["seconds"] = round(seconds, 4)
+    record["peakTracedMb"] = round(traced, 1)
+    record["maxRssMb"] = round(max_rss_mb(), 1)
+    return record
+
+def psnr(a, b, mask=None):
+    """
+    PSNR بین دو تصویر uint8 (در صورت وجود mask فقط روی پیکسل‌های آن).
+    """
+    diff = a.astype(np.float64) - b.astype(np.float64)
+    if mask is not None:
+        diff = diff[mask > 0]
+    mse = float(np.mean(diff * diff)) if diff.size else 0.0
+    return float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse)
+
+def bench_skin_smooth(sizes, strength=0.6, qualities=(0.25, 0.5, 1.0), repeats=3):
+    """
+    مقایسهٔ کنار هم حالت bilateral و حالت fast صاف‌سازی پوست: زمان و PSNR ناحیهٔ چهره نسبت به bilateral.
+    """
+    records = []
+    for megapixels in sizes:
+        image, geometries = synthetic_subject(megapixels)
+        bgr = np.ascontiguousarray(image[:, :, :3])
+        face_mask = pi.create_face_mask(bgr, geometries[0])
+
+        bilateral_time, reference = time_call(lambda: pi.apply_skin_smooth(bgr, strength), repeats)
+        records.append({
+            "suite": "skin_smooth",
+            "megapixels": megapixels,
+            "mode": "bilateral",
+            "seconds": round(bilateral_time, 4),
+        })
+        for quality in qualities:
+            fast_time, fast = time_call(
+                lambda: pi.apply_skin_smooth(bgr, strength, mode="fast", quality=quality, geometries=geometries),
+                repeats
+            )
+            records.append({
+                "suite": "skin_smooth",
+                "megapixels": megapixels,
+                "mode": "fast",
+                "quality": quality,
+                "seconds": round(fast_time, 4),
+                "speedup": round(bilateral_time / fast_time, 2) if fast_time > 0 else None,
+                "facePsnrVsBilateral": round(psnr(reference, fast, face_mask), 2),
+            })
+        # حالت fast بدون چهره (کل قاب) برای مقایسهٔ منصفانهٔ خود فیلتر
+        full_time, full = time_call(lambda: pi.apply_skin_smooth(bgr, strength, mode="fast"), repeats)
+        records.append({
+            "suite": "skin_smooth",
+            "megapixels": megapixels,
+            "mode": "fast-fullframe",
+            "quality": 0.5,
+            "seconds": round(full_time, 4),
+            "speedup": round(bilateral_time / full_time, 2) if full_time > 0 else None,
+            "facePsnrVsBilateral": round(psnr(reference, full, face_mask), 2),
+        })
+    return records
+
+def synthetic_glasses(directory):
+    """
+    ساخت یک تصویر عینک مصنوعی RGBA (دو عدسی نیمه‌شفاف و یک پل) برای اجرای آفلاین add_glasses.
+    """
+    glasses = np.zeros((200, 400, 4), dtype=np.uint8)
+    for cx in (100, 300):
+        cv2.circle(glasses, (cx, 100), 80, (40, 40, 40, 160), -1)
+        cv2.circle(glasses, (cx, 100), 80, (10, 10, 10, 255), 8)
+    cv2.line(glasses, (180, 90), (220, 90), (10, 10, 10, 255), 8)
+    path = os.path.join(directory, "glasses.png")
+    cv2.imwrite(path, glasses)
+    return path
+
+def effect_cases(bgr, geometry, glasses_path):
+    """
+    فهرست (نام، تابع) برای هر تابع عمومی افکت. افکت‌های چهره درجا می‌نویسند؛ روی یک کپی ثابت
+    تکرار می‌شوند تا کپی در زمان‌سنجی نیاید (هزینهٔ آن‌ها به مقدار پیکسل بستگی ندارد).
+    """
+    face_scratch = bgr.copy()
+    tone_stages = (("posterize", 4), ("contrast", 1.2), ("overlay", 0.5, (0, 0, 0)))
+    h, w = bgr.shape[:2]
+    cases = [
+        ("blend_with_grayscale", lambda: pi.blend_with_grayscale(bgr, 0.2)),
+        ("posterize", lambda: pi.posterize(bgr, 4)),
+        ("adjust_contrast", lambda: pi.adjust_contrast(bgr, 1.2)),
+        ("apply_overlay", lambda: pi.apply_overlay(bgr, 0.5, (0, 0, 0))),
+        ("apply_tone_curve", lambda: pi.apply_tone_curve(bgr, tone_stages)),
+        ("adjust_brightness", lambda: pi.adjust_brightness(bgr, 0.2)),
+        ("adjust_saturation", lambda: pi.adjust_saturation(bgr, 0.2)),
+        ("adjust_hue", lambda: pi.adjust_hue(bgr, 10)),
+        ("adjust_hsv", lambda: pi.adjust_hsv(bgr, 0.2, 0.2, 10)),
+        ("adjust_sharpness+", lambda: pi.adjust_sharpness(bgr, 0.5)),
+        ("adjust_sharpness-", lambda: pi.adjust_sharpness(bgr, -0.5)),
+        ("apply_blur", lambda: pi.apply_blur(bgr, 15)),
+        ("apply_vignette", lambda: pi.apply_vignette(bgr, 0.5)),
+        ("apply_skin_smooth[bilateral]", lambda: pi.apply_skin_smooth(bgr, 0.5)),
+        ("apply_skin_smooth[fast]", lambda: pi.apply_skin_smooth(bgr, 0.5, mode="fast", geometries=[geometry])),
+        ("run_tiled[sharpness]", lambda: pi.run_tiled(bgr, lambda tile, out: pi.adjust_sharpness(tile, 0.5, out=out), pi.sharpness_halo(0.5))),
+        ("create_face_mask", lambda: pi.create_face_mask(bgr, geometry)),
+        ("apply_eye_brighten", lambda: pi.apply_eye_brighten(face_scratch, geometry, 0.5)),
+        ("apply_teeth_whiten", lambda: pi.apply_teeth_whiten(face_scratch, geometry, 0.5)),
+        ("apply_lipstick", lambda: pi.apply_lipstick(face_scratch, geometry, 0.5)),
+        ("apply_eyelash_enhance", lambda: pi.apply_eyelash_enhance(face_scratch, geometry, 0.5)),
+        ("add_glasses", lambda: pi.add_glasses(face_scratch, geometry, glasses_path)),
+        ("FaceGeometry", lambda: synthetic_face_geometry(w, h, (0.5, 0.4), (0.15, 0.2)).hull),
+    ]
+    return cases
+
+def bench_effects(sizes, repeats=3):
+    """
+    زمان و حافظهٔ هر تابع عمومی افکت روی ورودی مصنوعی در هر اندازه.
+    """
+    records = []
+    with tempfile.TemporaryDirectory() as directory:
+        glasses_path = synthetic_glasses(directory)
+        for megapixels in sizes:
+            image, geometries = synthetic_subject(megapixels)
+            bgr = np.ascontiguousarray(image[:, :, :3])
+            for name, func in effect_cases(bgr, geometries[0], glasses_path):
+                records.append(measure({
+                    "suite": "effects",
+                    "name": name,
+                    "megapixels": megapixels,
+                }, func, repeats))
+            for fmt in ("png", "webp", "jpeg"):
+                args = pi.build_arg_parser().parse_args(["--outputFormat", fmt])
+                records.append(measure({
+                    "suite": "effects",
+                    "name": f"encode_outputs[{fmt}]",
+                    "megapixels": megapixels,
+                }, lambda: pi.encode_outputs(image, args), repeats))
+    return records
+
+# پریست‌های رایج خط لوله (آرگومان‌های process_image.py)
+PIPELINE_PRESETS = {
+    "defaults": [],
+    "stylized": ["--saturation", "0.3", "--hue", "10", "--sharpness", "0.5", "--blur", "5", "--vignette", "0.5"],
+    "portrait": [
+        "--faceEnhance", "True", "--eyeBrighten", "0.3", "--teethWhiten", "0.3", "--lipstick", "0.3",
+        "--eyelashEnhance", "0.5", "--skinSmooth", "0.5", "--skinSmoothMode", "fast", "--sharpness", "0.3",
+    ],
+    "portrait-bilateral": [
+        "--faceEnhance", "True", "--eyeBrighten", "0.3", "--lipstick", "0.3", "--skinSmooth", "0.5",
+    ],
+    "preview": [
+        "--previewMaxSide", "1024", "--faceEnhance", "True", "--eyeBrighten", "0.3",
+        "--skinSmooth", "0.5", "--skinSmoothMode", "fast", "--vignette", "0.5",
+    ],
+}
+
+def bench_pipeline(sizes, presets=None, repeats=3):
+    """
+    زمان و حافظهٔ کل خط لوله (process_subject + کد کردن PNG، معادل یک اجرای main) برای هر پریست،
+    با و بدون چهره و با و بدون شفافیت.
+    """
+    records = []
+    parser = pi.build_arg_parser()
+    for megapixels in sizes:
+        for with_face in (True, False):
+            for transparent in (True, False):
+                image, _ = synthetic_subject(megapixels, with_face=with_face, transparent=transparent)
+                faces = [synthetic_face_points((0.5, 0.4), (0.15, 0.2))] if with_face else []
+                for preset in presets or PIPELINE_PRESETS:
+                    args = parser.parse_args(PIPELINE_PRESETS[preset])
+
+                    def run():
+                        return pi.encode_outputs(pi.process_subject(image, args), args)
+
+                    with synthetic_face_detection(faces):
+                        records.append(measure({
+                            "suite": "pipeline",
+                            "name": preset,
+                            "megapixels": megapixels,
+                            "faces": with_face,
+                            "transparent": transparent,
+                        }, run, repeats))
+    return records
+
+def record_key(record):
+    """
+    کلید یکتای یک اندازه‌گیری برای مقایسهٔ دو اجرا.
+    """
+    return (
+        record.get("suite"), record.get("name"), record.get("mode"), record.get("quality"),
+        record.get("megapixels"), record.get("faces"), record.get("transparent"),
+    )
+
+def compare_runs(baseline_path, current_path, threshold=0.1):
+    """
+    مقایسهٔ دو فایل نتیجه؛ اندازه‌گیری‌هایی که بیش از threshold کندتر شده‌اند پسرفت گزارش می‌شوند.
+    خروجی: لیست رکوردهای مقایسه.
+    """
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {record_key(r): r for r in json.load(f)["records"]}
+    with open(current_path, "r", encoding="utf-8") as f:
+        current = json.load(f)["records"]
+
+    rows = []
+    for record in current:
+        base = baseline.get(record_key(record))
+        if base is None or not base.get("seconds"):
+            continue
+        ratio = record["seconds"] / base["seconds"]
+        rows.append({
+            "suite": record.get("suite"),
+            "name": record.get("name") or record.get("mode"),
+            "megapixels": record.get("megapixels"),
+            "faces": record.get("faces"),
+            "transparent": record.get("transparent"),
+            "baseSeconds": base["seconds"],
+            "seconds": record["seconds"],
+            "ratio": round(ratio, 3),
+            "regression": ratio > 1 + threshold,
+        })
+    return rows
+
+def run_metadata(args):
+    """
+    مشخصات محیط اجرا برای تکرارپذیری نتایج.
+    """
+    return {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "opencv": cv2.__version__,
+        "platform": platform.platform(),
+        "cpuCount": os.cpu_count(),
+        "cvThreads": cv2.getNumThreads(),
+        "suite": args.suite,
+        "sizes": args.sizes,
+        "repeats": args.repeats,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark image effects on synthetic inputs.')
+    parser.add_argument('--suite', type=str, default='all', choices=['skin', 'effects', 'pipeline', 'all'], help='Benchmark suite to run')
+    parser.add_argument('--sizes', type=float, nargs='+', default=[0.5, 2, 12, 24], help='Image sizes in megapixels')
+    parser.add_argument('--repeats', type=int, default=3, help='Repetitions per measurement (best time is kept)')
+    parser.add_argument('--presets', type=str, nargs='+', choices=list(PIPELINE_PRESETS), help='Pipeline presets to run (default: all)')
+    parser.add_argument('--output', type=str, default='', help='Write all results as one JSON document to this file')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('BASELINE', 'CURRENT'), help='Compare two result files instead of running')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Compare: relative slowdown reported as a regression')
+    args = parser.parse_args()
+
+    if args.compare:
+        rows = compare_runs(args.compare[0], args.compare[1], args.threshold)
+        for row in rows:
+            print(json.dumps(row))
+        regressions = [row for row in rows if row["regression"]]
+        print(f"{len(regressions)} regression(s) in {len(rows)} measurement(s)", file=sys.stderr)
+        sys.exit(1 if regressions else 0)
+
+    records = []
+    if args.suite in ('skin', 'all'):
+        records += bench_skin_smooth(args.sizes, repeats=args.repeats)
+    if args.suite in ('effects', 'all'):
+        records += bench_effects(args.sizes, repeats=args.repeats)
+    if args.suite in ('pipeline', 'all'):
+        records += bench_pipeline(args.sizes, args.presets, repeats=args.repeats)
+
+    for record in records:
+        print(json.dumps(record))
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump({"meta": run_metadata(args), "records": records}, f, indent=1)
+
+if __name__ == "__main__":
+    main()
@@ -4,19 +4,33 @@ import cv2
 import numpy as np
 import argparse
 import sys
-import mediapipe as mp
 import os
-
-def blend_with_grayscale(image, alpha):
+import functools
+import hashlib
+import io
+import json
+import struct
+import resource
+import contextlib
+import importlib
+import re
+import time
+import threading
+import tracemalloc
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+def blend_with_grayscale(image, alpha, out=None):
     """
     ترکیب تصویر اصلی با تصویر سیاه و سفید با استفاده از فاکتور alpha.
     alpha=0: بدون تغییر
     alpha=1: سیاه و سفید کامل
+    out: بافر خروجی اختیاری هم‌اندازهٔ image (جدا از image)؛ نسخهٔ سه‌کاناله خاکستری هم در همان ساخته می‌شود.
     """
     try:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        gray_bgr = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR)
-        blended = cv2.addWeighted(gray_bgr, alpha, image, 1 - alpha, 0)
+        gray_bgr = cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, dst=out)
+        blended = cv2.addWeighted(gray_bgr, alpha, image, 1 - alpha, 0, dst=gray_bgr)
         return blended
     except Exception as e:
         print(f"Error in blend_with_grayscale: {e}")
@@ -61,22 +75,161 @@ def apply_overlay(image, alpha, color=(0, 0, 0)):
         print(f"Error in apply_overlay: {e}")
         sys.exit(1)
 
-def create_face_mask(image, face_landmarks):
+# مراحل نقطه‌ای (هر کانال uint8 -> uint8) که در یک LUT قابل ترکیب‌اند
+_TONE_OPS = {
+    "posterize": posterize,
+    "contrast": adjust_contrast,
+    "overlay": apply_overlay,
+}
+
+def _is_identity_tone_stage(stage):
+    name, params = stage[0], stage[1:]
+    if name == "posterize":
+        return params[0] >= 8
+    if name == "contrast":
+        return params[0] == 1.0
+    if name == "overlay":
+        return params[0] == 0
+    return False
+
+@functools.lru_cache(maxsize=128)
+def compile_tone_lut(stages):
+    """
+    ترکیب یک دنبالهٔ مراحل نقطه‌ای در یک LUT سه‌کاناله (1x256x3).
+    stages: تاپل مراحل، مثل (("posterize", 4), ("contrast", 1.2), ("overlay", 0.5, (0, 0, 0))).
+    LUT با اجرای همان توابع روی یک رمپ 0..255 ساخته می‌شود، پس خروجی دقیقاً برابر اجرای پشت‌سرهم است.
+    اگر همهٔ مراحل خنثی باشند None برمی‌گرداند.
+    """
+    active = [stage for stage in stages if not _is_identity_tone_stage(stage)]
+    if not active:
+        return None
+    ramp = np.repeat(np.arange(256, dtype=np.uint8).reshape(1, 256, 1), 3, axis=2)
+    for stage in active:
+        ramp = _TONE_OPS[stage[0]](ramp, *stage[1:])
+    lut = np.ascontiguousarray(ramp, dtype=np.uint8)
+    lut.setflags(write=False)
+    return lut
+
+def apply_tone_curve(image, stages, out=None):
+    """
+    اعمال چند مرحلهٔ نقطه‌ای (posterize، contrast، overlay با رنگ ثابت) با یک فراخوانی cv2.LUT.
+    out: بافر خروجی اختیاری هم‌اندازهٔ image (می‌تواند خود image باشد).
+    """
+    try:
+        lut = compile_tone_lut(tuple(stages))
+        if lut is None:
+            return image
+        return cv2.LUT(image, lut, dst=out)
+    except Exception as e:
+        print(f"Error in apply_tone_curve: {e}")
+        sys.exit(1)
+
+# اندیس‌های landmark هر ناحیه در FaceMesh (478 نقطه با refine_landmarks)
+LEFT_EYE_INDICES = [33, 133, 160, 158, 144, 153, 154, 155, 173, 157, 158, 159, 160, 161, 246]
+RIGHT_EYE_INDICES = [362, 263, 387, 385, 380, 373, 374, 380, 381, 382, 385, 387, 388, 389, 466]
+TEETH_INDICES = list(range(0, 17)) + list(range(17, 33))
+UPPER_LIP_INDICES = [61, 146, 91, 181, 84, 17, 314, 405, 321, 375, 291]
+LOWER_LIP_INDICES = [61, 185, 40, 39, 37, 0, 267, 269, 270, 409, 291]
+LEFT_EYELASH_INDICES = [33, 7, 163, 144, 145, 153, 154, 155, 133]
+RIGHT_EYELASH_INDICES = [362, 263, 387, 385, 380, 373, 374, 380, 381]
+
+class FaceGeometry:
+    """
+    هندسهٔ یک چهره در مختصات پیکسلی یک تصویر مشخص.
+    landmarkها یک بار به آرایهٔ (N, 2) تبدیل می‌شوند و چندضلعی‌ها، hull و کادرهای هر ناحیه
+    در اولین استفاده محاسبه و نگه داشته می‌شوند تا همهٔ افکت‌های چهره از همان داده استفاده کنند.
+    normalized_points: آرایهٔ (N, 2) مختصات نرمال‌شدهٔ x, y (همان خروجی mediapipe).
+    """
+
+    def __init__(self, normalized_points, width, height):
+        self.width = width
+        self.height = height
+        self.normalized = np.asarray(normalized_points, dtype=np.float32).reshape(-1, 2)
+        # مثل int(pt.x * w) قبلی: ضرب با دقت float64 و برش به سمت صفر
+        self.points = (self.normalized.astype(np.float64) * (width, height)).astype(np.int32)
+
+    @classmethod
+    def from_landmarks(cls, face_landmarks, width, height):
+        """
+        ساخت هندسه از خروجی NormalizedLandmarkList در mediapipe.
+        """
+        normalized = np.array([(lm.x, lm.y) for lm in face_landmarks.landmark], dtype=np.float32)
+        return cls(normalized, width, height)
+
+    def region(self, indices):
+        """
+        نقاط پیکسلی (K, 2) برای اندیس‌های داده شده؛ اندیس‌های خارج از محدوده نادیده گرفته می‌شوند.
+        """
+        indices = np.asarray(indices)
+        return self.points[indices[indices < len(self.points)]]
+
+    @functools.cached_property
+    def hull(self):
+        if len(self.points) == 0:
+            return None
+        return cv2.convexHull(self.points)
+
+    @functools.cached_property
+    def left_eye(self):
+        return self.region(LEFT_EYE_INDICES)
+
+    @functools.cached_property
+    def right_eye(self):
+        return self.region(RIGHT_EYE_INDICES)
+
+    @functools.cached_property
+    def teeth(self):
+        return self.region(TEETH_INDICES)
+
+    @functools.cached_property
+    def upper_lip(self):
+        return self.region(UPPER_LIP_INDICES)
+
+    @functools.cached_property
+    def lower_lip(self):
+        return self.region(LOWER_LIP_INDICES)
+
+    @functools.cached_property
+    def left_eyelash(self):
+        return self.region(LEFT_EYELASH_INDICES)
+
+    @functools.cached_property
+    def right_eyelash(self):
+        return self.region(RIGHT_EYELASH_INDICES)
+
+    @staticmethod
+    def bounding_box(points):
+        """
+        کادر (x, y, w, h) نقاط با همان تعریف min/max قبلی؛ None برای مجموعهٔ خالی.
+        """
+        if len(points) == 0:
+            return None
+        x, y = points.min(axis=0)
+        x2, y2 = points.max(axis=0)
+        return int(x), int(y), int(x2 - x), int(y2 - y)
+
+    @functools.cached_property
+    def face_bbox(self):
+        return self.bounding_box(self.points)
+
+    @functools.cached_property
+    def left_eye_bbox(self):
+        return self.bounding_box(self.left_eye)
+
+    @functools.cached_property
+    def right_eye_bbox(self):
+        return self.bounding_box(self.right_eye)
+
+def create_face_mask(image, geometry):
     """
     ایجاد ماسک دقیق برای چهره بر اساس نقاط کلیدی تشخیص داده شده با استفاده از Convex Hull.
     """
     try:
         h, w, _ = image.shape
-        points = []
-        for landmark in face_landmarks.landmark:
-            x, y = int(landmark.x * w), int(landmark.y * h)
-            points.append((x, y))
-        
-        if points:
+        if geometry.hull is not None:
             # استفاده از Convex Hull برای ایجاد ماسک
-            hull = cv2.convexHull(np.array(points, dtype=np.int32))
             mask = np.zeros((h, w), dtype=np.uint8)
-            cv2.fillConvexPoly(mask, hull, 255)
+            cv2.fillConvexPoly(mask, geometry.hull, 255)
             return mask
         else:
             print("No landmarks found to create mask.")
@@ -97,15 +250,22 @@ def draw_red_border(image, mask, thickness=2):
         print(f"Error in draw_red_border: {e}")
         sys.exit(1)
 
-def apply_effects_to_face(image, mask, args, face_landmarks):
+def apply_effects_to_face(image, mask, params, geometry):
     """
     اعمال افکت‌ها به ناحیه چهره مشخص شده توسط ماسک.
+    params: پارامترهای op faceEffects (eyeBrighten، teethWhiten، lipstick، eyelashEnhance، addGlasses).
     """
     try:
         #face_region = cv2.bitwise_and(image, image, mask=mask)
         # بقیه‌ی افکت‌های مخصوص چهره (مثلاً unsharp، bilateralFilter...) اینجا قابل افزودنند.
 
         final_image = image
+        final_image = apply_eye_brighten(final_image, geometry, params["eyeBrighten"])
+        final_image = apply_teeth_whiten(final_image, geometry, params["teethWhiten"])
+        final_image = apply_lipstick(final_image, geometry, params["lipstick"])
+        final_image = apply_eyelash_enhance(final_image, geometry, params["eyelashEnhance"])
+        if params["addGlasses"]:
+            final_image = add_glasses(final_image, geometry)
         # مثلا اگر بخواهید دور ماسک چهره حاشیه قرمز بکشید:
         #final_image = draw_red_border(final_image, mask, thickness=2)
 
@@ -114,52 +274,81 @@ def apply_effects_to_face(image, mask, args, face_landmarks):
         print(f"Error in apply_effects_to_face: {e}")
         sys.exit(1)
 
-def adjust_brightness(image, factor):
+@functools.lru_cache(maxsize=64)
+def _hsv_lut(brightness, saturation, hue):
     """
-    تنظیم روشنایی تصویر.
-    factor: فاکتور تنظیم روشنایی. مقادیر مثبت = افزایش روشنایی، منفی = کاهش روشنایی.
+    ساخت جدول LUT سه‌کاناله (1x256x3) برای H، S و V.
+    محاسبه با float32 انجام می‌شود تا با نسخهٔ قبلی (float32 و برش به uint8) یکسان باشد.
+    """
+    ramp = np.arange(256, dtype=np.float32)
+    h = ramp if hue == 0 else np.clip((ramp + hue) % 180, 0, 179)
+    s = ramp if saturation == 0 else np.clip(ramp * (1 + saturation), 0, 255)
+    v = ramp if brightness == 0 else np.clip(ramp * (1 + brightness), 0, 255)
+    lut = np.stack([h, s, v], axis=-1).astype(np.uint8).reshape(1, 256, 3)
+    lut.setflags(write=False)
+    return lut
+
+def adjust_hsv(image, brightness=0.0, saturation=0.0, hue=0.0, out=None):
+    """
+    تنظیم هم‌زمان روشنایی، اشباع و Hue با یک بار تبدیل به HSV و یک بار برگشت.
+    هر سه تنظیم با یک cv2.LUT روی کانال‌های H، S و V اعمال می‌شوند.
+    brightness، saturation: مقادیر مثبت افزایش، منفی کاهش (0 = بدون تغییر).
+    hue: چرخش Hue (0 = بدون تغییر).
+    out: بافر خروجی اختیاری هم‌اندازهٔ image (جدا از image)؛ هر سه گام درجا در همان انجام می‌شوند.
+    اگر هر سه مقدار خنثی باشند، تصویر بدون هیچ پردازشی برگردانده می‌شود.
     """
     try:
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV).astype(np.float32)
-        hsv[:, :, 2] = hsv[:, :, 2] * (1 + factor)
-        hsv[:, :, 2] = np.clip(hsv[:, :, 2], 0, 255)
-        bright_image = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
-        return bright_image
+        if brightness == 0 and saturation == 0 and hue == 0:
+            return image
+        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV, dst=out)
+        hsv = cv2.LUT(hsv, _hsv_lut(float(brightness), float(saturation), float(hue)), dst=hsv)
+        return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR, dst=hsv)
     except Exception as e:
-        print(f"Error in adjust_brightness: {e}")
+        print(f"Error in adjust_hsv: {e}")
         sys.exit(1)
 
+def adjust_brightness(image, factor):
+    """
+    تنظیم روشنایی تصویر.
+    factor: فاکتور تنظیم روشنایی. مقادیر مثبت = افزایش روشنایی، منفی = کاهش روشنایی.
+    """
+    return adjust_hsv(image, brightness=factor)
+
 def adjust_saturation(image, factor):
     """
     تنظیم اش saturate یک تر معشری تصویر.
     factor: فاکتور تنظیم اش saturate. مقادیر مثبت افزایش اش saturate، منفی کاهش اش saturate.
     """
-    try:
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV).astype(np.float32)
-        hsv[:, :, 1] = hsv[:, :, 1] * (1 + factor)
-        hsv[:, :, 1] = np.clip(hsv[:, :, 1], 0, 255)
-        saturated_image = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
-        return saturated_image
-    except Exception as e:
-        print(f"Error in adjust_saturation: {e}")
-        sys.exit(1)
+    return adjust_hsv(image, saturation=factor)
+
+def scale_kernel_radius(radius, scale):
+    """
+    شعاع کرنل متناظر برای تصویری که با ضریب scale کوچک شده (حداقل 1).
+    """
+    if scale == 1.0:
+        return radius
+    return max(1, int(round(radius * scale)))
 
-def adjust_sharpness(image, factor):
+def adjust_sharpness(image, factor, scale=1.0, out=None):
     """
     تنظیم وضوح تصویر.
     factor: فاکتور تنظیم وضوح. مقادیر مثبت افزایش وضوح، مقادیر منفی کاهش وضوح.
+    scale: ضریب کوچک‌سازی تصویر نسبت به اصل (حالت پیش‌نمایش)؛ کرنل Gaussian به همان نسبت کوچک می‌شود.
+    out: بافر خروجی اختیاری هم‌اندازهٔ image (جدا از image)؛ نسخهٔ Blur‌شده هم در همان ساخته می‌شود.
     """
     try:
         if factor == 0:
             return image
 
+        ksize = 2 * scale_kernel_radius(4, scale) + 1
         if factor > 0:
-            gaussian = cv2.GaussianBlur(image, (9, 9), 10.0)
-            sharp_image = cv2.addWeighted(image, 1 + factor, gaussian, -factor, 0)
+            gaussian = cv2.GaussianBlur(image, (ksize, ksize), 10.0 * scale, dst=out)
+            sharp_image = cv2.addWeighted(image, 1 + factor, gaussian, -factor, 0, dst=gaussian)
             return sharp_image
         else:
-            blurred = cv2.GaussianBlur(image, (9, 9), 0)
-            blurred = cv2.addWeighted(image, 1 + factor, blurred, -factor, 0)
+            # sigma پیش‌فرض OpenCV برای کرنل 9x9 برابر 1.7 است
+            blurred = cv2.GaussianBlur(image, (ksize, ksize), 0 if scale == 1.0 else 1.7 * scale, dst=out)
+            blurred = cv2.addWeighted(image, 1 + factor, blurred, -factor, 0, dst=blurred)
             return blurred
     except Exception as e:
         print(f"Error in adjust_sharpness: {e}")
@@ -170,179 +359,277 @@ def adjust_hue(image, factor):
     تنظیم Hue تصویر.
     factor: فاکتور تنظیم Hue. مقادیر مثبت چرخش Hue به جلو، مقادیر منفی چرخش Hue به عقب.
     """
-    try:
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV).astype(np.float32)
-        hsv[:, :, 0] = (hsv[:, :, 0] + factor) % 180
-        hsv[:, :, 0] = np.clip(hsv[:, :, 0], 0, 179)
-        hue_adjusted_image = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
-        return hue_adjusted_image
-    except Exception as e:
-        print(f"Error in adjust_hue: {e}")
-        sys.exit(1)
+    return adjust_hsv(image, hue=factor)
 
-def apply_blur(image, blur_level):
+def apply_blur(image, blur_level, scale=1.0, out=None):
     """
     اعمال افکت Blur به تصویر.
     blur_level: میزان تیرگی تصویر. مقادیر مثبت برای افزایش Blur.
+    scale: ضریب کوچک‌سازی تصویر نسبت به اصل (حالت پیش‌نمایش)؛ اندازهٔ کرنل به همان نسبت کوچک می‌شود.
+    out: بافر خروجی اختیاری هم‌اندازهٔ image (جدا از image).
     """
     try:
         if blur_level <= 0:
             return image
-        ksize = int(blur_level)
+        ksize = int(blur_level * scale)
         if ksize % 2 == 0:
             ksize += 1
-        blurred = cv2.GaussianBlur(image, (ksize, ksize), 0)
+        blurred = cv2.GaussianBlur(image, (ksize, ksize), 0, dst=out)
         return blurred
     except Exception as e:
         print(f"Error in apply_blur: {e}")
         sys.exit(1)
 
-def apply_vignette(image, vignette_strength):
+# کش LRU ماسک‌های Vignette با سقف حجم؛ کلید = (rows, cols, strength)
+# کش‌های سطح ماژول با قفل محافظت می‌شوند چون process_video چند قاب را هم‌زمان پردازش می‌کند
+_VIGNETTE_CACHE = OrderedDict()
+_VIGNETTE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+_VIGNETTE_LOCK = threading.Lock()
+
+def get_vignette_mask(rows, cols, vignette_strength):
+    """
+    ماسک float32 (rows x cols) افکت Vignette؛ برای ابعاد و شدت تکراری از کش برگردانده می‌شود.
+    """
+    key = (rows, cols, float(vignette_strength))
+    with _VIGNETTE_LOCK:
+        mask = _VIGNETTE_CACHE.get(key)
+        if mask is not None:
+            _VIGNETTE_CACHE.move_to_end(key)
+            return mask
+
+    kernel_x = cv2.getGaussianKernel(cols, cols / (vignette_strength * 2))
+    kernel_y = cv2.getGaussianKernel(rows, rows / (vignette_strength * 2))
+    kernel = kernel_y * kernel_x.T
+    mask = (kernel / kernel.max()).astype(np.float32)
+    mask.setflags(write=False)
+
+    with _VIGNETTE_LOCK:
+        _VIGNETTE_CACHE[key] = mask
+        total = sum(m.nbytes for m in _VIGNETTE_CACHE.values())
+        while total > _VIGNETTE_CACHE_MAX_BYTES and len(_VIGNETTE_CACHE) > 1:
+            _, evicted = _VIGNETTE_CACHE.popitem(last=False)
+            total -= evicted.nbytes
+    return mask
+
+def apply_vignette(image, vignette_strength, frame_shape=None, offset=(0, 0), out=None):
     """
     اعمال افکت Vignette به تصویر.
     vignette_strength: میزان شدت افکت Vignette (0 تا 1).
+    frame_shape: ابعاد قاب اصلی وقتی image فقط برشی از آن است (پیش‌فرض: ابعاد خود image).
+    offset: مختصات (y, x) گوشهٔ بالا-چپ برش در قاب اصلی؛ مرکز Vignette نسبت به قاب اصلی می‌ماند.
+    out: بافر خروجی اختیاری هم‌اندازهٔ image (می‌تواند خود image باشد).
     """
     try:
         rows, cols = image.shape[:2]
         if vignette_strength <= 0:
             return image
-        kernel_x = cv2.getGaussianKernel(cols, cols / (vignette_strength * 2))
-        kernel_y = cv2.getGaussianKernel(rows, rows / (vignette_strength * 2))
-        kernel = kernel_y * kernel_x.T
-        mask = kernel / kernel.max()
-        vignette = np.copy(image)
-        for i in range(3):
-            vignette[:, :, i] = vignette[:, :, i] * mask
-        return vignette.astype(np.uint8)
+        frame_rows, frame_cols = frame_shape[:2] if frame_shape is not None else (rows, cols)
+        mask = get_vignette_mask(frame_rows, frame_cols, vignette_strength)
+        y0, x0 = offset
+        mask = mask[y0:y0 + rows, x0:x0 + cols]
+        # یک ضرب broadcast مستقیم در آرایهٔ خروجی (برش به uint8 مثل قبل)
+        vignette = out if out is not None else np.empty_like(image)
+        np.multiply(image, mask[:, :, None], out=vignette, casting='unsafe')
+        return vignette
     except Exception as e:
         print(f"Error in apply_vignette: {e}")
         sys.exit(1)
 
-def apply_skin_smooth(image, smooth_strength):
+def _fast_guided_filter(image, radius, eps, scale):
+    """
+    فیلتر guided سریع (خودراهنما، برای هر کانال جدا) روی تصویر uint8.
+    ضرایب a و b روی نسخهٔ کوچک‌شده با ضریب scale محاسبه و با درون‌یابی خطی به اندازهٔ اصلی برمی‌گردند؛
+    چون خروجی a * I + b روی تصویر کامل ساخته می‌شود، لبه‌ها در رزولوشن اصلی حفظ می‌شوند.
+    """
+    h, w = image.shape[:2]
+    full = image.astype(np.float32) * (1.0 / 255)
+    if scale < 1.0:
+        small = cv2.resize(full, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+    else:
+        small = full
+    r = max(1, round(radius * scale))
+    ksize = (2 * r + 1, 2 * r + 1)
+    mean_i = cv2.boxFilter(small, -1, ksize)
+    var_i = cv2.boxFilter(small * small, -1, ksize) - mean_i * mean_i
+    a = var_i / (var_i + eps)
+    b = mean_i - a * mean_i
+    mean_a = cv2.boxFilter(a, -1, ksize)
+    mean_b = cv2.boxFilter(b, -1, ksize)
+    if small is not full:
+        mean_a = cv2.resize(mean_a, (w, h), interpolation=cv2.INTER_LINEAR)
+        mean_b = cv2.resize(mean_b, (w, h), interpolation=cv2.INTER_LINEAR)
+    smoothed = mean_a * full + mean_b
+    return np.clip(smoothed * 255 + 0.5, 0, 255).astype(np.uint8)
+
+def apply_skin_smooth(image, smooth_strength, mode="bilateral", quality=0.5, geometries=None, scale=1.0, out=None):
     """
     اعمال افکت Skin Smooth به تصویر.
     smooth_strength: میزان صاف‌سازی پوست (0 تا 1).
+    mode: "bilateral" (bilateralFilter روی کل تصویر) یا "fast" (فیلتر guided زیرنمونه‌شده فقط روی ماسک چهره).
+    quality: در حالت fast نسبت رزولوشنی که ضرایب فیلتر روی آن محاسبه می‌شوند (0.1 تا 1؛ بیشتر = دقیق‌تر و کندتر).
+    geometries: لیست FaceGeometry چهره‌ها؛ در حالت fast اگر خالی باشد کل تصویر صاف می‌شود.
+    scale: ضریب کوچک‌سازی تصویر نسبت به اصل (حالت پیش‌نمایش)؛ همسایگی مکانی فیلتر به همان نسبت کوچک می‌شود.
+    out: بافر خروجی اختیاری هم‌اندازهٔ image (جدا از image)؛ در حالت fast بدون چهره استفاده نمی‌شود.
     """
     try:
         if smooth_strength <= 0:
             return image
-        smooth_image = cv2.bilateralFilter(
-            image,
-            d=15,
-            sigmaColor=75 * smooth_strength,
-            sigmaSpace=75 * smooth_strength
-        )
+        if mode != "fast":
+            smooth_image = cv2.bilateralFilter(
+                image,
+                d=2 * scale_kernel_radius(7, scale) + 1,
+                sigmaColor=75 * smooth_strength,
+                sigmaSpace=75 * smooth_strength * scale,
+                dst=out
+            )
+            return smooth_image
+
+        # معادل‌سازی پارامترها با bilateral: شعاع 7 (d=15) و eps از sigmaColor
+        radius = scale_kernel_radius(7, scale)
+        eps = (75 * smooth_strength / 255.0) ** 2
+        guide_scale = min(max(quality, 0.1), 1.0)
+
+        if not geometries:
+            return _fast_guided_filter(image, radius, eps, guide_scale)
+
+        if out is not None:
+            np.copyto(out, image)
+            smooth_image = out
+        else:
+            smooth_image = image.copy()
+        feather = radius | 1
+        for geometry in geometries:
+            if geometry.hull is None:
+                continue
+            roi = _polygon_roi(geometry.hull.reshape(-1, 2), image.shape, radius + feather)
+            if roi is None:
+                continue
+            y0, y1, x0, x1 = roi
+            region = image[y0:y1, x0:x1]
+
+            # ماسک نرم چهره تا مرز ناحیهٔ صاف‌شده دیده نشود
+            mask = np.zeros(region.shape[:2], dtype=np.uint8)
+            cv2.fillConvexPoly(mask, geometry.hull - (x0, y0), 255)
+            mask = cv2.GaussianBlur(mask, (feather * 2 + 1, feather * 2 + 1), 0)
+            weight = mask.astype(np.float32)[:, :, None] * (1.0 / 255)
+
+            smoothed = _fast_guided_filter(region, radius, eps, guide_scale)
+            blended = region + (smoothed.astype(np.float32) - region) * weight
+            smooth_image[y0:y1, x0:x1] = np.clip(blended + 0.5, 0, 255).astype(np.uint8)
         return smooth_image
     except Exception as e:
         print(f"Error in apply_skin_smooth: {e}")
         sys.exit(1)
 
-def apply_eye_brighten(image, face_landmarks, brighten_level):
+def _polygon_roi(points, shape, pad):
+    """
+    کادر محیطی نقاط (x, y) با حاشیهٔ pad، محدود به ابعاد تصویر.
+    خروجی: (y0, y1, x0, x1) یا None اگر کادر خارج از تصویر باشد.
+    """
+    h, w = shape[:2]
+    x0 = max(int(points[:, 0].min()) - pad, 0)
+    x1 = min(int(points[:, 0].max()) + pad + 1, w)
+    y0 = max(int(points[:, 1].min()) - pad, 0)
+    y1 = min(int(points[:, 1].max()) + pad + 1, h)
+    if x0 >= x1 or y0 >= y1:
+        return None
+    return y0, y1, x0, x1
+
+def apply_eye_brighten(image, geometry, brighten_level):
     """
     اعمال افکت روشن‌سازی چشم‌ها.
     brighten_level: میزان روشن‌سازی چشم‌ها (0 تا 1).
+    هر ناحیه فقط روی کادر چندضلعی خودش پردازش و نتیجه درجا در image نوشته می‌شود.
     """
     try:
         if brighten_level <= 0:
             return image
 
-        left_eye_indices = [33, 133, 160, 158, 144, 153, 154, 155, 173, 157, 158, 159, 160, 161, 246]
-        right_eye_indices = [362, 263, 387, 385, 380, 373, 374, 380, 381, 382, 385, 387, 388, 389, 466]
-
-        h, w, _ = image.shape
-        for eye_indices in [left_eye_indices, right_eye_indices]:
-            eye_points = []
-            for idx in eye_indices:
-                if idx >= len(face_landmarks.landmark):
-                    continue
-                pt = face_landmarks.landmark[idx]
-                eye_points.append((int(pt.x * w), int(pt.y * h)))
+        for eye_points in (geometry.left_eye, geometry.right_eye):
+            if len(eye_points) == 0:
+                continue
 
-            if not eye_points:
+            roi = _polygon_roi(eye_points, image.shape, 1)
+            if roi is None:
                 continue
+            y0, y1, x0, x1 = roi
+            region = image[y0:y1, x0:x1]
 
-            mask = np.zeros_like(image)
-            cv2.fillPoly(mask, [np.array(eye_points)], (255, 255, 255))
-            eye_region = cv2.bitwise_and(image, image, mask=cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY))
+            mask = np.zeros(region.shape[:2], dtype=np.uint8)
+            cv2.fillPoly(mask, [eye_points - (x0, y0)], 255)
+            eye_region = cv2.bitwise_and(region, region, mask=mask)
 
             hsv = cv2.cvtColor(eye_region, cv2.COLOR_BGR2HSV).astype(np.float32)
             hsv[:, :, 2] = hsv[:, :, 2] * (1 + brighten_level)
             hsv[:, :, 2] = np.clip(hsv[:, :, 2], 0, 255)
             bright_eye = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
 
-            image = cv2.addWeighted(image, 1, bright_eye, 1, 0)
+            cv2.add(region, bright_eye, dst=region)
 
         return image
     except Exception as e:
         print(f"Error in apply_eye_brighten: {e}")
         sys.exit(1)
 
-def apply_teeth_whiten(image, face_landmarks, whiten_level):
+def apply_teeth_whiten(image, geometry, whiten_level):
     """
     اعمال افکت سفید کردن دندان‌ها.
     whiten_level: میزان سفید کردن دندان‌ها (0 تا 1).
+    هر ناحیه فقط روی کادر چندضلعی خودش پردازش و نتیجه درجا در image نوشته می‌شود.
     """
     try:
         if whiten_level <= 0:
             return image
 
-        teeth_indices = list(range(0, 17)) + list(range(17, 33))
-
-        h, w, _ = image.shape
-        for teeth_indices_set in [teeth_indices]:
-            teeth_points = []
-            for idx in teeth_indices_set:
-                if idx >= len(face_landmarks.landmark):
-                    continue
-                pt = face_landmarks.landmark[idx]
-                teeth_points.append((int(pt.x * w), int(pt.y * h)))
+        for teeth_points in (geometry.teeth,):
+            if len(teeth_points) == 0:
+                continue
 
-            if not teeth_points:
+            roi = _polygon_roi(teeth_points, image.shape, 1)
+            if roi is None:
                 continue
+            y0, y1, x0, x1 = roi
+            region = image[y0:y1, x0:x1]
 
-            mask = np.zeros_like(image)
-            cv2.fillPoly(mask, [np.array(teeth_points)], (255, 255, 255))
-            teeth_region = cv2.bitwise_and(image, image, mask=cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY))
+            mask = np.zeros(region.shape[:2], dtype=np.uint8)
+            cv2.fillPoly(mask, [teeth_points - (x0, y0)], 255)
+            teeth_region = cv2.bitwise_and(region, region, mask=mask)
 
             hsv = cv2.cvtColor(teeth_region, cv2.COLOR_BGR2HSV).astype(np.float32)
             hsv[:, :, 2] = hsv[:, :, 2] * (1 + whiten_level)
             hsv[:, :, 2] = np.clip(hsv[:, :, 2], 0, 255)
             white_teeth = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
 
-            image = cv2.addWeighted(image, 1, white_teeth, 1, 0)
+            cv2.add(region, white_teeth, dst=region)
 
         return image
     except Exception as e:
         print(f"Error in apply_teeth_whiten: {e}")
         sys.exit(1)
 
-def apply_lipstick(image, face_landmarks, lipstick_level):
+def apply_lipstick(image, geometry, lipstick_level):
     """
     اعمال افکت لپ‌استیک به لب‌ها.
     lipstick_level: میزان اعمال لپ‌استیک (0 تا 1).
+    هر ناحیه فقط روی کادر چندضلعی خودش پردازش و نتیجه درجا در image نوشته می‌شود.
     """
     try:
         if lipstick_level <= 0:
             return image
 
-        upper_lip_indices = [61, 146, 91, 181, 84, 17, 314, 405, 321, 375, 291]
-        lower_lip_indices = [61, 185, 40, 39, 37, 0, 267, 269, 270, 409, 291]
-
-        h, w, _ = image.shape
-        for lip_indices in [upper_lip_indices, lower_lip_indices]:
-            lip_points = []
-            for idx in lip_indices:
-                if idx >= len(face_landmarks.landmark):
-                    continue
-                pt = face_landmarks.landmark[idx]
-                lip_points.append((int(pt.x * w), int(pt.y * h)))
+        for lip_points in (geometry.upper_lip, geometry.lower_lip):
+            if len(lip_points) == 0:
+                continue
 
-            if not lip_points:
+            roi = _polygon_roi(lip_points, image.shape, 1)
+            if roi is None:
                 continue
+            y0, y1, x0, x1 = roi
+            region = image[y0:y1, x0:x1]
 
-            mask = np.zeros_like(image)
-            cv2.fillPoly(mask, [np.array(lip_points)], (255, 255, 255))
-            lip_region = cv2.bitwise_and(image, image, mask=cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY))
+            mask = np.zeros(region.shape[:2], dtype=np.uint8)
+            cv2.fillPoly(mask, [lip_points - (x0, y0)], 255)
+            lip_region = cv2.bitwise_and(region, region, mask=mask)
 
             hsv = cv2.cvtColor(lip_region, cv2.COLOR_BGR2HSV).astype(np.float32)
             hsv[:, :, 0] = 160  # تن قرمز
@@ -351,162 +638,499 @@ def apply_lipstick(image, face_landmarks, lipstick_level):
             hsv[:, :, 2] = np.clip(hsv[:, :, 2], 0, 255)
             lipstick_color = cv2.cvtColor(hsv.astype(np.uint8), cv2.COLOR_HSV2BGR)
 
-            image = cv2.addWeighted(image, 1, lipstick_color, 1, 0)
+            cv2.add(region, lipstick_color, dst=region)
 
         return image
     except Exception as e:
         print(f"Error in apply_lipstick: {e}")
         sys.exit(1)
 
-def apply_eyelash_enhance(image, face_landmarks, eyelash_level):
+def apply_eyelash_enhance(image, geometry, eyelash_level):
     """
     اعمال افکت افزایش حجم مژه‌ها.
     eyelash_level: میزان افزایش حجم مژه‌ها (0 تا 1).
+    هر ناحیه فقط روی کادر چندضلعی خودش پردازش و نتیجه درجا در image نوشته می‌شود.
     """
     try:
         if eyelash_level <= 0:
             return image
 
-        left_eyelash_indices = [33, 7, 163, 144, 145, 153, 154, 155, 133]
-        right_eyelash_indices = [362, 263, 387, 385, 380, 373, 374, 380, 381]
-
-        h, w, _ = image.shape
-        for eyelash_indices in [left_eyelash_indices, right_eyelash_indices]:
-            eyelash_points = []
-            for idx in eyelash_indices:
-                if idx >= len(face_landmarks.landmark):
-                    continue
-                pt = face_landmarks.landmark[idx]
-                eyelash_points.append((int(pt.x * w), int(pt.y * h)))
+        iterations = int(eyelash_level * 3)
+        for eyelash_points in (geometry.left_eyelash, geometry.right_eyelash):
+            if len(eyelash_points) == 0:
+                continue
 
-            if not eyelash_points:
+            # حاشیه: ضخامت خط + dilate + شعاع closing
+            roi = _polygon_roi(eyelash_points, image.shape, iterations + 4)
+            if roi is None:
                 continue
+            y0, y1, x0, x1 = roi
+            region = image[y0:y1, x0:x1]
 
-            mask = np.zeros_like(image)
-            cv2.polylines(mask, [np.array(eyelash_points)], False, (255, 255, 255), thickness=2)
+            mask = np.zeros(region.shape[:2], dtype=np.uint8)
+            cv2.polylines(mask, [eyelash_points - (x0, y0)], False, 255, thickness=2)
             mask = cv2.dilate(mask, np.ones((3,3), np.uint8), iterations=1)
 
-            eyelash_region = cv2.bitwise_and(image, image, mask=cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY))
+            eyelash_region = cv2.bitwise_and(region, region, mask=mask)
 
             eyelash_enhanced = cv2.morphologyEx(
                 eyelash_region,
                 cv2.MORPH_CLOSE,
                 np.ones((3,3), np.uint8),
-                iterations=int(eyelash_level * 3)
+                iterations=iterations
             )
-            image = cv2.addWeighted(image, 1, eyelash_enhanced, 1, 0)
+            cv2.add(region, eyelash_enhanced, dst=region)
 
         return image
     except Exception as e:
         print(f"Error in apply_eyelash_enhance: {e}")
         sys.exit(1)
 
-def add_glasses(image, face_landmarks, glasses_image_path="glasses.png"):
+# مسیر پیش‌فرض تصویر عینک (کنار همین اسکریپت)
+GLASSES_IMAGE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "glasses.png")
+
+@functools.lru_cache(maxsize=16)
+def _load_overlay_asset(path, mtime):
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        return None
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    image.setflags(write=False)
+    return image
+
+def load_overlay_asset(path):
+    """
+    بارگذاری یک تصویر overlay (مثل عینک) فقط یک بار در هر worker؛ با تغییر فایل دوباره خوانده می‌شود.
+    اگر فایل وجود نداشته باشد یا خوانده نشود None برمی‌گرداند.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    return _load_overlay_asset(path, mtime)
+
+def quantize_overlay_size(width, height, step=4):
+    """
+    گرد کردن ابعاد هدف به مضرب step تا نسخه‌های تغییر اندازه یافته بین چهره‌ها و درخواست‌ها مشترک باشند.
+    """
+    return max(step, int(round(width / step)) * step), max(step, int(round(height / step)) * step)
+
+def get_resized_overlay(path, width, height):
+    """
+    نسخهٔ تغییر اندازه یافتهٔ overlay آمادهٔ ترکیب با ممیز ثابت:
+    (bgr_premultiplied, inverse_alpha) با نوع uint16 که bgr_premultiplied = bgr * alpha + 127 است؛
+    برای تصاویر بدون آلفا inverse_alpha برابر None و bgr_premultiplied خود پیکسل‌هاست.
+    مثل load_overlay_asset، کلید کش شامل mtime فایل است تا با جایگزینی فایل نسخهٔ قدیمی برنگردد.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return None
+    return _resize_overlay(path, mtime, width, height)
+
+@functools.lru_cache(maxsize=64)
+def _resize_overlay(path, mtime, width, height):
+    asset = _load_overlay_asset(path, mtime)
+    if asset is None:
+        return None
+    resized = cv2.resize(asset, (width, height), interpolation=cv2.INTER_AREA)
+    if resized.shape[2] == 4:
+        alpha = resized[:, :, 3:4].astype(np.uint16)
+        premultiplied = resized[:, :, :3].astype(np.uint16) * alpha + 127
+        inverse_alpha = 255 - alpha
+        premultiplied.setflags(write=False)
+        inverse_alpha.setflags(write=False)
+        return premultiplied, inverse_alpha
+    resized.setflags(write=False)
+    return resized, None
+
+def composite_overlay(image, overlay, x, y):
+    """
+    ترکیب درجای overlay آماده شده با get_resized_overlay در موقعیت (x, y) با آلفای ممیز ثابت uint16.
+    ناحیهٔ ترکیب به قاب تصویر محدود می‌شود.
+    """
+    premultiplied, inverse_alpha = overlay
+    h, w = image.shape[:2]
+    oh, ow = premultiplied.shape[:2]
+    x1, y1 = max(x, 0), max(y, 0)
+    x2, y2 = min(x + ow, w), min(y + oh, h)
+    if x1 >= x2 or y1 >= y2:
+        return image
+    src = (slice(y1 - y, y2 - y), slice(x1 - x, x2 - x))
+    region = image[y1:y2, x1:x2]
+    if inverse_alpha is None:
+        region[:] = premultiplied[src]
+        return image
+    blend = region.astype(np.uint16)
+    blend *= inverse_alpha[src]
+    blend += premultiplied[src]
+    blend //= 255
+    region[:] = blend
+    return image
+
+def add_glasses(image, geometry, glasses_image_path=GLASSES_IMAGE_PATH):
     """
     افزودن عینک به صورت سوژه.
     glasses_image_path: مسیر تصویر عینک با پس‌زمینه شفاف (PNG).
     """
     try:
-        if not glasses_image_path or not os.path.exists(glasses_image_path):
+        if not glasses_image_path or load_overlay_asset(glasses_image_path) is None:
             print("Glasses image not found.")
             return image
 
-        for face in [face_landmarks]:
-            left_eye_indices = [33, 133, 160, 158, 144, 153, 154, 155, 173, 157, 158, 159, 160, 161, 246]
-            right_eye_indices = [362, 263, 387, 385, 380, 373, 374, 380, 381, 382, 385, 387, 388, 389, 466]
-
+        for face in [geometry]:
             h, w, _ = image.shape
 
-            # پیدا کردن Bounding Box چپ چشم
-            left_eye_coords = []
-            for idx in left_eye_indices:
-                if idx >= len(face.landmarks.landmark):
-                    continue
-                pt = face.landmarks.landmark[idx]
-                left_eye_coords.append((int(pt.x * w), int(pt.y * h)))
-            if not left_eye_coords:
-                continue
-            left_x = min([pt[0] for pt in left_eye_coords])
-            left_y = min([pt[1] for pt in left_eye_coords])
-            left_wd = max([pt[0] for pt in left_eye_coords]) - left_x
-            left_ht = max([pt[1] for pt in left_eye_coords]) - left_y
-
-            # پیدا کردن Bounding Box راست چشم
-            right_eye_coords = []
-            for idx in right_eye_indices:
-                if idx >= len(face.landmarks.landmark):
-                    continue
-                pt = face.landmarks.landmark[idx]
-                right_eye_coords.append((int(pt.x * w), int(pt.y * h)))
-            if not right_eye_coords:
+            # Bounding Box چشم چپ و راست (از هندسهٔ مشترک چهره)
+            if face.left_eye_bbox is None or face.right_eye_bbox is None:
                 continue
-            right_x = min([pt[0] for pt in right_eye_coords])
-            right_y = min([pt[1] for pt in right_eye_coords])
-            right_wd = max([pt[0] for pt in right_eye_coords]) - right_x
-            right_ht = max([pt[1] for pt in right_eye_coords]) - right_y
+            left_x, left_y, left_wd, left_ht = face.left_eye_bbox
+            right_x, right_y, right_wd, right_ht = face.right_eye_bbox
 
             # محاسبه ابعاد و موقعیت عینک
             glasses_width = int(right_x + right_wd - left_x)
             aspect_ratio = 1.0
             glasses_height = int(glasses_width / aspect_ratio)
+            if glasses_width <= 0:
+                continue
+            glasses_width, glasses_height = quantize_overlay_size(glasses_width, glasses_height)
 
-            glasses_img = cv2.imread(glasses_image_path, cv2.IMREAD_UNCHANGED)
-            if glasses_img is None:
+            overlay = get_resized_overlay(glasses_image_path, glasses_width, glasses_height)
+            if overlay is None:
                 print("Failed to load glasses image.")
                 return image
 
-            resized_glasses = cv2.resize(glasses_img, (glasses_width, glasses_height), interpolation=cv2.INTER_AREA)
-
             y1 = left_y - int(glasses_height * 0.5)
-            y2 = y1 + glasses_height
             x1 = left_x
-            x2 = x1 + glasses_width
 
             # جلوگیری از تجاوز از مرز
-            if y1 < 0:
-                y1 = 0
-                y2 = glasses_height
-            if x1 < 0:
-                x1 = 0
-                x2 = glasses_width
-            if y2 > h:
-                y2 = h
-                y1 = h - glasses_height
-            if x2 > w:
-                x2 = w
-                x1 = w - glasses_width
-
-            if resized_glasses.shape[2] == 4:
-                alpha_glasses = resized_glasses[:, :, 3] / 255.0
-                alpha_image = 1.0 - alpha_glasses
-                for c in range(3):
-                    image[y1:y2, x1:x2, c] = (
-                        alpha_glasses * resized_glasses[:, :, c] +
-                        alpha_image * image[y1:y2, x1:x2, c]
-                    )
-            else:
-                image[y1:y2, x1:x2] = resized_glasses
+            y1 = min(max(y1, 0), h - glasses_height)
+            x1 = min(max(x1, 0), w - glasses_width)
+
+            composite_overlay(image, overlay, x1, y1)
 
         return image
     except Exception as e:
         print(f"Error in add_glasses: {e}")
         sys.exit(1)
 
-def apply_face_effects(image, face_landmarks, args):
+def apply_face_effects(image, geometry, params):
     """
-    اعمال افکت‌های خاص روی چهره بر اساس نقاط کلیدی تشخیص داده شده.
+    اعمال افکت‌های خاص روی چهره بر اساس هندسهٔ چهرهٔ تشخیص داده شده (FaceGeometry).
+    params: پارامترهای op faceEffects در مشخصات زنجیره.
     """
     try:
-        image = apply_effects_to_face(image, create_face_mask(image, face_landmarks), args, face_landmarks)
+        image = apply_effects_to_face(image, create_face_mask(image, geometry), params, geometry)
         return image
     except Exception as e:
         print(f"Error in apply_face_effects: {e}")
         sys.exit(1)
 
-def main():
+# نمونهٔ FaceMesh که در حالت worker بین درخواست‌ها زنده می‌ماند
+_FACE_MESH = None
+
+def create_face_mesh(static_image_mode=True):
+    """
+    ساخت یک FaceMesh جدید. static_image_mode=False حالت ردیابی است: landmarkهای فریم قبلی
+    نقطهٔ شروع فریم بعدی‌اند و تشخیص کامل فقط وقتی ردیابی از دست برود تکرار می‌شود
+    (فریم‌ها باید به ترتیب و از یک نخ داده شوند).
+    """
+    # mediapipe سنگین است و فقط وقتی مرحله‌ای landmark لازم دارد بارگذاری می‌شود
+    import mediapipe as mp
+
+    return mp.solutions.face_mesh.FaceMesh(
+        static_image_mode=static_image_mode,
+        max_num_faces=10,
+        refine_landmarks=True,
+        min_detection_confidence=0.3
+    )
+
+def get_face_mesh():
+    """
+    برگرداندن نمونهٔ مشترک FaceMesh؛ گراف mediapipe فقط یک بار ساخته می‌شود.
+    """
+    global _FACE_MESH
+    if _FACE_MESH is None:
+        _FACE_MESH = create_face_mesh(static_image_mode=True)
+    return _FACE_MESH
+
+def run_face_mesh(face_mesh, bgr, max_side=1024):
+    """
+    اجرای FaceMesh روی نسخهٔ کوچک‌شدهٔ bgr (بزرگ‌ترین ضلع حداکثر max_side؛ 0 = بدون کوچک‌سازی).
+    خروجی: لیست آرایه‌های (N, 2) float32 با مختصات نرمال‌شده.
+    """
+    h, w = bgr.shape[:2]
+    proxy = bgr
+    if max_side > 0 and max(h, w) > max_side:
+        scale = max_side / max(h, w)
+        proxy = cv2.resize(bgr, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+
+    results = face_mesh.process(cv2.cvtColor(proxy, cv2.COLOR_BGR2RGB))
+    faces = []
+    for face_landmarks in results.multi_face_landmarks or []:
+        faces.append(np.array([(lm.x, lm.y) for lm in face_landmarks.landmark], dtype=np.float32))
+    return faces
+
+# کش LRU نتایج تشخیص چهره: کلید = هش محتوای تصویر، مقدار = لیست آرایه‌های landmark نرمال‌شده
+_FACE_CACHE = OrderedDict()
+_FACE_CACHE_SIZE = 64
+_FACE_CACHE_LOCK = threading.Lock()
+
+def image_content_hash(image):
+    """
+    هش محتوای یک آرایهٔ تصویر (به همراه ابعاد و نوع داده).
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(str((image.shape, image.dtype.str)).encode("ascii"))
+    digest.update(np.ascontiguousarray(image).data)
+    return digest.hexdigest()
+
+def needs_face_landmarks(args):
+    """
+    آیا مرحلهٔ فعالی در زنجیره به landmarkهای چهره نیاز دارد؟
+    """
+    return pipeline_plan(args).needs_landmarks
+
+def face_effects_enabled(args):
+    """
+    آیا دست‌کم یکی از افکت‌های مبتنی بر landmark (چشم، دندان، لب، مژه، عینک) فعال است؟
+    """
+    if args.faceEnhance.lower() != 'true':
+        return False
+    return (
+        args.eyeBrighten > 0 or
+        args.teethWhiten > 0 or
+        args.lipstick > 0 or
+        args.eyelashEnhance > 0 or
+        args.addGlasses.lower() == 'true'
+    )
+
+def detect_faces(bgr, max_side=1024):
+    """
+    تشخیص چهره‌ها با FaceMesh روی یک نسخهٔ کوچک‌شده (بزرگ‌ترین ضلع حداکثر max_side؛ 0 = بدون کوچک‌سازی).
+    چون landmarkها نرمال‌شده‌اند، بدون تبدیل به قاب اصلی برمی‌گردند.
+    خروجی: لیست آرایه‌های (N, 2) float32؛ نتیجه بر اساس هش محتوا کش می‌شود
+    (process_subject قاب منبع را می‌دهد تا کلید به برش و پیش‌نمایش وابسته نباشد).
+    """
+    try:
+        key = (image_content_hash(bgr), max_side)
+        with _FACE_CACHE_LOCK:
+            cached = _FACE_CACHE.get(key)
+            if cached is not None:
+                _FACE_CACHE.move_to_end(key)
+        if cached is not None:
+            print("Face landmarks served from cache.")
+            return cached
+
+        faces = run_face_mesh(get_face_mesh(), bgr, max_side)
+
+        with _FACE_CACHE_LOCK:
+            _FACE_CACHE[key] = faces
+            if len(_FACE_CACHE) > _FACE_CACHE_SIZE:
+                _FACE_CACHE.popitem(last=False)
+        return faces
+    except Exception as e:
+        print(f"Error in detect_faces: {e}")
+        sys.exit(1)
+
+# sessionهای onnxruntime برای rembg، به ازای (مدل، تعداد نخ) یک بار ساخته می‌شوند
+_REMBG_SESSIONS = {}
+
+def get_rembg_session(model_name, threads=0):
+    """
+    برگرداندن session مشترک rembg برای مدل داده شده.
+    threads: تعداد نخ‌های onnxruntime (0 = پیش‌فرض onnxruntime).
+    """
+    key = (model_name, threads)
+    session = _REMBG_SESSIONS.get(key)
+    if session is None:
+        from rembg import new_session
+
+        # rembg تعداد نخ‌ها را از OMP_NUM_THREADS می‌خواند
+        previous = os.environ.get("OMP_NUM_THREADS")
+        if threads > 0:
+            os.environ["OMP_NUM_THREADS"] = str(threads)
+        try:
+            session = new_session(model_name)
+        finally:
+            if threads > 0:
+                if previous is None:
+                    os.environ.pop("OMP_NUM_THREADS", None)
+                else:
+                    os.environ["OMP_NUM_THREADS"] = previous
+        _REMBG_SESSIONS[key] = session
+    return session
+
+def remove_background(image_bytes, args):
+    """
+    حذف پس‌زمینه درون همین پروسه با rembg و برگرداندن ماتِ RGBA به صورت آرایهٔ BGRA.
+    image_bytes: بایت‌های فایل آپلود شده (JPEG/PNG/...).
+    """
+    try:
+        from PIL import Image
+        from rembg import remove
+
+        session = get_rembg_session(args.rembgModel, args.rembgThreads)
+        with Image.open(io.BytesIO(image_bytes)) as pil_image:
+            cutout = remove(
+                pil_image,
+                session=session,
+                alpha_matting=(args.alphaMatting.lower() == 'true'),
+                alpha_matting_foreground_threshold=args.alphaMattingForeground,
+                alpha_matting_background_threshold=args.alphaMattingBackground,
+                alpha_matting_erode_size=args.alphaMattingErodeSize,
+            )
+        rgba = np.asarray(cutout.convert("RGBA"))
+        return cv2.cvtColor(rgba, cv2.COLOR_RGBA2BGRA)
+    except Exception as e:
+        print(f"Error in remove_background: {e}")
+        sys.exit(1)
+
+def matte_cache_key(image_bytes, args):
+    """
+    کلید محتوایی مات: sha256 بایت‌های آپلود به همراه نام مدل و آستانه‌های alpha matting.
+    """
+    digest = hashlib.sha256(image_bytes)
+    digest.update(json.dumps([
+        args.rembgModel,
+        args.alphaMatting.lower() == 'true',
+        args.alphaMattingForeground,
+        args.alphaMattingBackground,
+        args.alphaMattingErodeSize,
+    ]).encode("utf-8"))
+    return digest.hexdigest()
+
+class MatteCache:
+    """
+    کش دیسکی و محدود به حجم برای مات‌های RGBA خروجی rembg (LRU بر اساس mtime فایل‌ها).
+    چند worker می‌توانند یک پوشه را به اشتراک بگذارند؛ نوشتن اتمیک است (فایل موقت + os.replace).
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(directory, exist_ok=True)
+        self._total_bytes = sum(size for _, size, _ in self._entries())
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key + ".png")
+
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def get(self, key):
+        """
+        خواندن مات از کش؛ در صورت نبودن None. هر برخورد mtime فایل را به‌روز می‌کند (LRU).
+        """
+        path = self._path(key)
+        image = cv2.imread(path, cv2.IMREAD_UNCHANGED) if os.path.exists(path) else None
+        if image is None or image.ndim != 3 or image.shape[2] != 4:
+            self.misses += 1
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return image
+
+    def put(self, key, image):
+        """
+        ذخیرهٔ مات BGRA با فشرده‌سازی سبک PNG و حذف قدیمی‌ترین ورودی‌ها در صورت عبور از سقف حجم.
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        ok, encoded = cv2.imencode(".png", image, [cv2.IMWRITE_PNG_COMPRESSION, 1])
+        if not ok or encoded.nbytes > self.max_bytes:
+            return
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "wb") as f:
+            f.write(encoded.tobytes())
+        # بازنویسی همان کلید: حجم فایل قبلی از مجموع کم می‌شود
+        try:
+            previous_bytes = os.path.getsize(path)
+        except OSError:
+            previous_bytes = 0
+        os.replace(temp_path, path)
+        self._total_bytes += encoded.nbytes - previous_bytes
+        if self._total_bytes > self.max_bytes:
+            self.evict()
+
+    def evict(self):
+        """
+        اسکن پوشه (ممکن است workerهای دیگر هم نوشته باشند) و حذف ورودی‌های کم‌استفاده تا زیر سقف حجم.
+        """
+        entries = sorted(self._entries(), key=lambda entry: entry[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            self.evictions += 1
+        self._total_bytes = total
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+_MATTE_CACHES = {}
+
+def get_matte_cache(args):
+    """
+    کش مات مربوط به تنظیمات کار (یک نمونه برای هر پوشه در هر پروسه)، یا None اگر غیرفعال باشد.
+    """
+    if not args.matteCacheDir or args.matteCacheMaxMb <= 0:
+        return None
+    directory = os.path.abspath(args.matteCacheDir)
+    cache = _MATTE_CACHES.get(directory)
+    if cache is None:
+        cache = MatteCache(directory, int(args.matteCacheMaxMb * 1024 * 1024))
+        _MATTE_CACHES[directory] = cache
+    cache.max_bytes = int(args.matteCacheMaxMb * 1024 * 1024)
+    return cache
+
+def load_subject(image_bytes, args):
+    """
+    حذف پس‌زمینه با استفاده از کش مات: در صورت برخورد، اجرای rembg کاملاً حذف می‌شود.
+    """
+    cache = get_matte_cache(args)
+    if cache is None:
+        return remove_background(image_bytes, args)
+    key = matte_cache_key(image_bytes, args)
+    image = cache.get(key)
+    if image is not None:
+        print("Background removal: matte cache hit.")
+        return image
+    image = remove_background(image_bytes, args)
+    try:
+        cache.put(key, image)
+    except Exception as e:
+        # خطای کش نباید کار را خراب کند
+        print(f"Error in matte cache: {e}")
+    return image
+
+def build_arg_parser():
     parser = argparse.ArgumentParser(description='Apply multiple effects to the subject.')
-    parser.add_argument('input', type=str, help='Input image path (PNG with transparency)')
-    parser.add_argument('output', type=str, help='Output image path')
+    parser.add_argument('input', type=str, nargs='?', help='Input image path (PNG with transparency), or - for stdin')
+    parser.add_argument('output', type=str, nargs='?', help='Output image path, or - for PNG bytes on stdout')
     parser.add_argument('--blackWhiteLevel', type=float, default=0.2, help='Black and white effect intensity (0 to 1)')
     parser.add_argument('--posterizeBits', type=int, default=4, help='Number of bits for posterize (1 to 8)')
     parser.add_argument('--contrastFactor', type=float, default=1.0, help='Contrast adjustment factor (>1 to increase, <1 to decrease)')
@@ -521,27 +1145,696 @@ def main():
     parser.add_argument('--blur', type=float, default=0.0, help='Blur level (0 to 100)')
     parser.add_argument('--vignette', type=float, default=0.0, help='Vignette strength (0 to 1)')
     parser.add_argument('--skinSmooth', type=float, default=0.0, help='Skin smooth strength (0 to 1)')
+    parser.add_argument('--skinSmoothMode', type=str, default='bilateral', choices=['bilateral', 'fast'], help='Skin smoothing algorithm: full-frame bilateral or fast guided filter on the face mask')
+    parser.add_argument('--skinSmoothQuality', type=float, default=0.5, help='Fast skin smoothing: resolution ratio for filter coefficients (0.1 to 1)')
     parser.add_argument('--eyeBrighten', type=float, default=0.0, help='Eye brightening level (0 to 1)')
     parser.add_argument('--teethWhiten', type=float, default=0.0, help='Teeth whitening level (0 to 1)')
     parser.add_argument('--lipstick', type=float, default=0.0, help='Lipstick level (0 to 1)')
     parser.add_argument('--eyelashEnhance', type=float, default=0.0, help='Eyelash enhancement level (0 to 1)')
     parser.add_argument('--addGlasses', type=str, default='False', help='Add glasses to the face (True/False)')
+    parser.add_argument('--pipeline', type=str, default='', help='Inline pipeline spec as JSON ({"stages": [{"op": ..., ...}]}); replaces the effect flags')
+    parser.add_argument('--pipelineFile', type=str, default='', help='Path to a JSON pipeline spec file (command line only; rejected in worker jobs)')
+    parser.add_argument('--tileRows', type=int, default=256, help='Band height for multithreaded filter execution (0 = no tiling)')
+    parser.add_argument('--threads', type=int, default=0, help='Threads for tiled execution (0 = CPU count, 1 = single-threaded)')
+    parser.add_argument('--detectMaxSide', type=int, default=1024, help='Longest side of the proxy image used for face detection (0 = full resolution)')
+    parser.add_argument('--cropToSubject', type=str, default='True', help='Process only the bounding box of the visible subject (True/False)')
+    parser.add_argument('--outputFormat', type=str, default='', choices=['', 'png', 'webp', 'jpeg'], help='Output encoding: png, webp (with alpha) or jpeg (colour plus a separate PNG alpha mask); empty = from the output extension')
+    parser.add_argument('--pngCompression', type=int, default=1, help='PNG compression level (0 = fastest/largest to 9 = slowest/smallest)')
+    parser.add_argument('--quality', type=int, default=90, help='WebP/JPEG quality (1 to 100; above 100 = lossless WebP)')
+    parser.add_argument('--renditions', type=str, default='', help='Output several sizes from one pass: "maxSide[:format[:quality]],..." (0 = full size) or a JSON list; format/quality default to --outputFormat/--quality')
+    parser.add_argument('--previewMaxSide', type=int, default=0, help='Preview mode: render on a proxy with this longest side, kernels scaled to match (0 = full resolution)')
+    parser.add_argument('--bufferArenaMb', type=float, default=256, help='Memory cap in MB for reusable scratch buffers kept between stages and jobs (0 = allocate per stage)')
+    parser.add_argument('--checkpointMb', type=float, default=0, help='Memory cap in MB for per-stage checkpoints reused across jobs on the same image (0 = disabled)')
+    parser.add_argument('--removeBg', type=str, default='False', help='Remove the background in-process before applying effects (True/False)')
+    parser.add_argument('--rembgModel', type=str, default='u2net_human_seg', help='rembg model name')
+    parser.add_argument('--rembgThreads', type=int, default=0, help='onnxruntime thread count for rembg (0 = default)')
+    parser.add_argument('--alphaMatting', type=str, default='True', help='Use alpha matting for background removal (True/False)')
+    parser.add_argument('--alphaMattingForeground', type=int, default=240, help='Alpha matting foreground threshold')
+    parser.add_argument('--alphaMattingBackground', type=int, default=80, help='Alpha matting background threshold')
+    parser.add_argument('--alphaMattingErodeSize', type=int, default=20, help='Alpha matting erode size')
+    parser.add_argument('--matteCacheDir', type=str, default='', help='Directory for the disk cache of background-removal mattes (empty = disabled)')
+    parser.add_argument('--matteCacheMaxMb', type=float, default=512, help='Size limit of the matte cache in MB')
+    parser.add_argument('--instrument', type=str, default='False', help='Record per-stage wall/CPU time and output shape as one JSON record per job (True/False)')
+    parser.add_argument('--instrumentMemory', type=str, default='False', help='Also record per-stage peak allocation with tracemalloc; slower (True/False)')
+    parser.add_argument('--profileHook', type=str, default='', help='Optional module:function called as hook(stage, "start"/"end") around each stage')
+    parser.add_argument('--worker', action='store_true', help='Run as a long-lived worker reading framed jobs from stdin')
+    parser.add_argument('--maxJobs', type=int, default=200, help='Worker: exit after this many jobs (0 = unlimited)')
+    parser.add_argument('--maxRssMb', type=float, default=1536, help='Worker: exit when resident memory exceeds this (0 = unlimited)')
+    return parser
+
+def sharpness_halo(factor, scale=1.0):
+    """
+    شعاع کرنل GaussianBlur در adjust_sharpness (9x9).
+    """
+    return scale_kernel_radius(4, scale) if factor != 0 else 0
 
-    args = parser.parse_args()
+def blur_halo(blur_level, scale=1.0):
+    """
+    شعاع کرنل GaussianBlur در apply_blur.
+    """
+    if blur_level <= 0:
+        return 0
+    ksize = int(blur_level * scale)
+    return (ksize + 1 if ksize % 2 == 0 else ksize) // 2
 
+def skin_smooth_halo(smooth_strength, mode="bilateral", scale=1.0):
+    """
+    شعاع همسایگی bilateralFilter در apply_skin_smooth (d=15)؛
+    در حالت fast دو boxFilter پشت‌سرهم به علاوهٔ درون‌یابی، یعنی حدود دو برابر.
+    """
+    if smooth_strength <= 0:
+        return 0
+    radius = scale_kernel_radius(7, scale)
+    return 2 * radius + 2 if mode == "fast" else radius
+
+# opهای قابل استفاده در مشخصات زنجیره و پارامترهای پیش‌فرض هر کدام
+PIPELINE_OPS = {
+    "faceEffects": {"eyeBrighten": 0.0, "teethWhiten": 0.0, "lipstick": 0.0, "eyelashEnhance": 0.0, "addGlasses": False},
+    "blackWhite": {"level": 0.2},
+    "posterize": {"bits": 4},
+    "contrast": {"factor": 1.0},
+    "overlay": {"alpha": 0.5, "color": (0, 0, 0)},
+    "hsv": {"brightness": 0.0, "saturation": 0.0, "hue": 0.0},
+    "brightness": {"factor": 0.0},
+    "saturation": {"factor": 0.0},
+    "hue": {"factor": 0.0},
+    "sharpness": {"factor": 0.0},
+    "blur": {"level": 0.0},
+    "vignette": {"strength": 0.0},
+    "skinSmooth": {"strength": 0.0, "mode": "bilateral", "quality": 0.5},
+    "alphaClose": {"iterations": 1},
+}
+
+# سقف تعداد مراحل یک مشخصات زنجیره (مشخصات از بدنهٔ درخواست کلاینت می‌آید)
+MAX_PIPELINE_STAGES = 32
+
+# نام مرحلهٔ اجرایی هر نوع (در لاگ، profile و کلید checkpoint)
+PIPELINE_STAGE_NAMES = {
+    "faceEffects": "face effects",
+    "blackWhite": "black and white",
+    "tone": "tone curve",
+    "hsv": "hsv",
+    "sharpness": "sharpness",
+    "blur": "blur",
+    "vignette": "vignette",
+    "skinSmooth": "skin smooth",
+    "alphaClose": "alpha close",
+}
+
+# مرحلهٔ برنامه‌ریزی‌شده: kind یکی از کلیدهای PIPELINE_STAGE_NAMES، params تاپل مرتب (نام، مقدار)
+PlannedStage = namedtuple("PlannedStage", "name kind params landmarks alpha")
+# برنامهٔ اجرا: key هش مشخصات، stages مراحل فعال به ترتیب، dropped opهای حذف‌شدهٔ بی‌اثر
+PipelinePlan = namedtuple("PipelinePlan", "key stages dropped needs_landmarks needs_alpha")
+
+def _coerce_pipeline_param(default, value):
+    if isinstance(default, bool):
+        return value.lower() == 'true' if isinstance(value, str) else bool(value)
+    if isinstance(default, int):
+        return int(value)
+    if isinstance(default, float):
+        return float(value)
+    if isinstance(default, tuple):
+        return tuple(int(v) for v in value)
+    return str(value)
+
+def normalize_pipeline_spec(spec):
+    """
+    اعتبارسنجی مشخصات زنجیره و تکمیل پارامترها با مقادیر پیش‌فرض.
+    spec: {"stages": [{"op": "blur", "level": 5}, ...]} یا مستقیماً لیست مراحل.
+    خروجی: لیست (op، دیکشنری پارامترها). ساختار نادرست، بیش از MAX_PIPELINE_STAGES مرحله یا مقدار
+    نامعتبر با ValueError گزارش می‌شود.
+    """
+    stages = spec.get("stages", []) if isinstance(spec, dict) else spec
+    if not isinstance(stages, list):
+        raise ValueError(f"Pipeline stages must be a list, got {type(stages).__name__}")
+    if len(stages) > MAX_PIPELINE_STAGES:
+        raise ValueError(f"Too many pipeline stages: {len(stages)} (at most {MAX_PIPELINE_STAGES})")
+    normalized = []
+    for item in stages:
+        if not isinstance(item, dict):
+            raise ValueError(f"Pipeline stage must be an object, got {type(item).__name__}")
+        op = item.get("op")
+        if not isinstance(op, str) or op not in PIPELINE_OPS:
+            raise ValueError(f"Unknown pipeline op: {op}")
+        defaults = PIPELINE_OPS[op]
+        unknown = set(item) - set(defaults) - {"op"}
+        if unknown:
+            raise ValueError(f"Unknown parameter(s) for pipeline op '{op}': {', '.join(sorted(unknown))}")
+        params = {}
+        for name, default in defaults.items():
+            if name not in item:
+                params[name] = default
+                continue
+            try:
+                params[name] = _coerce_pipeline_param(default, item[name])
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid value for parameter '{name}' of pipeline op '{op}': {item[name]!r}")
+        normalized.append((op, params))
+    return normalized
+
+def _is_identity_op(op, params):
+    if op == "faceEffects":
+        return not (
+            params["eyeBrighten"] > 0 or params["teethWhiten"] > 0 or params["lipstick"] > 0 or
+            params["eyelashEnhance"] > 0 or params["addGlasses"]
+        )
+    if op == "blackWhite":
+        return params["level"] == 0
+    if op in ("posterize", "contrast", "overlay"):
+        return _is_identity_tone_stage(_tone_stage(op, params))
+    if op == "hsv":
+        return params["brightness"] == 0 and params["saturation"] == 0 and params["hue"] == 0
+    if op in ("brightness", "saturation", "hue", "sharpness"):
+        return params["factor"] == 0
+    if op == "blur":
+        return params["level"] <= 0
+    if op == "vignette":
+        return params["strength"] <= 0
+    if op == "skinSmooth":
+        return params["strength"] <= 0
+    if op == "alphaClose":
+        return params["iterations"] <= 0
+    return False
+
+def _tone_stage(op, params):
+    if op == "posterize":
+        return ("posterize", params["bits"])
+    if op == "contrast":
+        return ("contrast", params["factor"])
+    return ("overlay", params["alpha"], params["color"])
+
+def plan_pipeline(spec, key=None):
+    """
+    ساخت برنامهٔ اجرا از مشخصات زنجیره:
+    - opهای بی‌اثر (مثل contrast 1.0، overlay 0، blackWhite 0، posterize 8، افکت‌های چهرهٔ صفر) حذف می‌شوند؛
+    - opهای نقطه‌ای مجاور (posterize، contrast، overlay) در یک مرحلهٔ LUT ادغام می‌شوند؛
+    - opهای HSV مجاور (hsv، brightness، saturation، hue) در یک گذر HSV ادغام می‌شوند،
+      مگر اینکه یک کانال دو بار تنظیم شود؛
+    - برای هر مرحله نیاز به landmarkهای چهره و کانال آلفا علامت زده می‌شود.
+    """
+    stages = []
+    dropped = []
+    for op, params in normalize_pipeline_spec(spec):
+        if _is_identity_op(op, params):
+            dropped.append(op)
+            continue
+        previous = stages[-1] if stages else None
+        if op in ("posterize", "contrast", "overlay"):
+            tone = _tone_stage(op, params)
+            if previous is not None and previous[0] == "tone":
+                previous[1]["stages"] += (tone,)
+            else:
+                stages.append(["tone", {"stages": (tone,)}])
+            continue
+        if op in ("hsv", "brightness", "saturation", "hue"):
+            channels = params if op == "hsv" else {op: params["factor"]}
+            channels = {name: value for name, value in channels.items() if value != 0}
+            if previous is not None and previous[0] == "hsv" and not any(previous[1][name] != 0 for name in channels):
+                previous[1].update(channels)
+            else:
+                merged = {"brightness": 0.0, "saturation": 0.0, "hue": 0.0}
+                merged.update(channels)
+                stages.append(["hsv", merged])
+            continue
+        stages.append([op, dict(params)])
+
+    planned = tuple(
+        PlannedStage(
+            PIPELINE_STAGE_NAMES[kind], kind, tuple(sorted(params.items())),
+            kind == "faceEffects" or (kind == "skinSmooth" and params["mode"] == "fast"),
+            kind == "alphaClose",
+        )
+        for kind, params in stages
+    )
+    return PipelinePlan(
+        key, planned, tuple(dropped),
+        any(stage.landmarks for stage in planned), any(stage.alpha for stage in planned),
+    )
+
+def pipeline_spec_key(spec):
+    """
+    هش مشخصات زنجیره (JSON مرتب‌شده).
+    """
+    canonical = json.dumps(spec, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+# کش LRU برنامه‌های ساخته‌شده؛ کلید = هش مشخصات
+_PLAN_CACHE = OrderedDict()
+_PLAN_CACHE_SIZE = 64
+_PLAN_CACHE_LOCK = threading.Lock()
+
+def compile_pipeline(spec):
+    """
+    برنامهٔ اجرای مشخصات زنجیره؛ presetهای تکراری از کش برگردانده می‌شوند.
+    خروجی: (plan، آیا از کش آمده)
+    """
+    key = pipeline_spec_key(spec)
+    with _PLAN_CACHE_LOCK:
+        plan = _PLAN_CACHE.get(key)
+        if plan is not None:
+            _PLAN_CACHE.move_to_end(key)
+            return plan, True
+    plan = plan_pipeline(spec, key)
+    with _PLAN_CACHE_LOCK:
+        _PLAN_CACHE[key] = plan
+        while len(_PLAN_CACHE) > _PLAN_CACHE_SIZE:
+            _PLAN_CACHE.popitem(last=False)
+    return plan, False
+
+def spec_from_args(args):
+    """
+    مشخصات زنجیره برای یک کار: از --pipeline (فقط JSON درون‌خطی)، --pipelineFile (فقط خط فرمان) یا در نبود
+    آن‌ها از فلگ‌های افکت با همان ترتیب همیشگی زنجیره.
+    --pipeline هرگز به عنوان مسیر فایل خوانده نمی‌شود، چون مقدار آن از بدنهٔ درخواست کلاینت می‌آید.
+    """
+    if args.pipeline and args.pipelineFile:
+        raise ValueError("use either --pipeline or --pipelineFile, not both")
+    if args.pipelineFile:
+        with open(args.pipelineFile, "r", encoding="utf-8") as f:
+            return json.loads(f.read())
+    if args.pipeline:
+        if not args.pipeline.lstrip().startswith(("{", "[")):
+            raise ValueError("--pipeline must be an inline JSON object or list")
+        return json.loads(args.pipeline)
+
+    stages = []
+    if face_effects_enabled(args):
+        stages.append({
+            "op": "faceEffects", "eyeBrighten": args.eyeBrighten, "teethWhiten": args.teethWhiten,
+            "lipstick": args.lipstick, "eyelashEnhance": args.eyelashEnhance,
+            "addGlasses": args.addGlasses.lower() == 'true',
+        })
+    stages += [
+        {"op": "blackWhite", "level": args.blackWhiteLevel},
+        {"op": "posterize", "bits": args.posterizeBits},
+        {"op": "contrast", "factor": args.contrastFactor},
+        {"op": "overlay", "alpha": args.overlayAlpha, "color": [0, 0, 0]},
+        # اعمال blackLevel و whiteLevel در صورت نیاز (در حال حاضر پیاده نشده).
+        {"op": "hsv", "brightness": args.brightness, "saturation": args.saturation, "hue": args.hue},
+        {"op": "sharpness", "factor": args.sharpness},
+        {"op": "blur", "level": args.blur},
+        {"op": "vignette", "strength": args.vignette},
+        {"op": "skinSmooth", "strength": args.skinSmooth, "mode": args.skinSmoothMode, "quality": args.skinSmoothQuality},
+        # Morphological Close با کرنل 3x3 روی کانال آلفا برای رفع نویز لبه‌ها
+        {"op": "alphaClose", "iterations": 1},
+    ]
+    return {"stages": stages}
+
+def pipeline_plan(args):
+    """
+    برنامهٔ اجرای زنجیرهٔ یک کار (از کش در صورت تکراری بودن preset).
+    """
+    with profile_stage("plan") as entry:
+        plan, cached = compile_pipeline(spec_from_args(args))
+        entry["cached"] = cached
+    if not cached:
+        summary = " -> ".join(stage.name for stage in plan.stages) or "(none)"
+        print(f"Pipeline plan: {summary}; dropped no-op stages: {', '.join(plan.dropped) or 'none'}")
+    return plan
+
+def effect_chain_halo(plan, scale=1.0):
+    """
+    مجموع شعاع کرنل‌های فیلترهای مکانی برنامه (sharpen، blur، skin smooth) با پارامترهای داده شده.
+    پیکسل‌هایی که دست‌کم این فاصله را از لبهٔ برش دارند، دقیقاً مثل اجرای روی کل قاب محاسبه می‌شوند.
+    """
+    halo = 0
+    for stage in plan.stages:
+        params = dict(stage.params)
+        if stage.kind == "sharpness":
+            halo += sharpness_halo(params["factor"], scale)
+        elif stage.kind == "blur":
+            halo += blur_halo(params["level"], scale)
+        elif stage.kind == "skinSmooth":
+            halo += skin_smooth_halo(params["strength"], params["mode"], scale)
+    return halo
+
+# حاشیهٔ زنجیره برای بیشینهٔ بازهٔ اسلایدرها (sharpness، blur تا 100، skin smooth در حالت fast)
+MAX_EFFECT_CHAIN_HALO = sharpness_halo(1) + blur_halo(100) + skin_smooth_halo(1, "fast")
+
+# استخرهای نخ مشترک برای اجرای نواری، یکی برای هر تعداد نخ؛ OpenCV در حین پردازش GIL را آزاد می‌کند.
+# استخرها هرگز بسته نمی‌شوند تا نخی که هنوز ارجاعی به یک استخر دارد (مثلاً قاب‌های هم‌زمان ویدیو
+# با --threads متفاوت) با استخر بسته‌شده مواجه نشود؛ تعداد مقادیر متمایز threads در عمل کم است.
+_TILE_POOLS = {}
+_TILE_POOL_LOCK = threading.Lock()
+
+def get_tile_pool(threads):
+    """
+    برگرداندن استخر نخ مشترک با threads نخ (0 = تعداد هسته‌ها).
+    """
+    threads = threads if threads > 0 else (os.cpu_count() or 1)
+    with _TILE_POOL_LOCK:
+        pool = _TILE_POOLS.get(threads)
+        if pool is None:
+            pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix=f"tile{threads}")
+            _TILE_POOLS[threads] = pool
+        return pool
+
+class BufferArena:
+    """
+    مخزن بافرهای موقت قابل استفادهٔ مجدد با کلید (shape, dtype) برای پرهیز از تخصیص آرایه‌های هم‌اندازهٔ قاب
+    در هر مرحله و هر کار (و تکه‌تکه شدن حافظه در workerهای ماندگار).
+    take یک بافر آزاد هم‌شکل (یا در نبودش یک بافر تازه) می‌دهد و give آن را پس می‌گیرد؛ محتوای بافر
+    تحویلی تعریف‌نشده است. بافرهای آزاد تا سقف max_bytes نگه داشته و قدیمی‌ترین‌ها اول رها می‌شوند.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._free = OrderedDict()
+        self._free_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def take(self, shape, dtype=np.uint8):
+        key = (tuple(shape), np.dtype(dtype).str)
+        with self._lock:
+            buffers = self._free.get(key)
+            if buffers:
+                buffer = buffers.pop()
+                if not buffers:
+                    del self._free[key]
+                self._free_bytes -= buffer.nbytes
+                self.hits += 1
+                return buffer
+            self.misses += 1
+        return np.empty(shape, dtype=dtype)
+
+    def give(self, buffer):
+        # فقط آرایه‌های مستقل و قابل نوشتن (نه برش یا checkpoint فقط‌خواندنی) پذیرفته می‌شوند
+        if buffer is None or buffer.base is not None or not buffer.flags.writeable or buffer.nbytes > self.max_bytes:
+            return
+        key = (buffer.shape, buffer.dtype.str)
+        with self._lock:
+            buffers = self._free.setdefault(key, [])
+            if any(item is buffer for item in buffers):
+                return
+            buffers.append(buffer)
+            self._free.move_to_end(key)
+            self._free_bytes += buffer.nbytes
+            while self._free_bytes > self.max_bytes:
+                oldest_key, oldest = next(iter(self._free.items()))
+                self._free_bytes -= oldest.pop(0).nbytes
+                if not oldest:
+                    del self._free[oldest_key]
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "freeMb": round(self._free_bytes / (1024 * 1024), 1)}
+
+# آرنای مشترک پروسه (بین کارهای worker و نخ‌های اجرای نواری)
+_BUFFER_ARENA = None
+
+def get_buffer_arena(max_mb):
+    """
+    برگرداندن آرنای بافر مشترک با سقف max_mb مگابایت (0 = غیرفعال، None).
+    """
+    global _BUFFER_ARENA
+    if max_mb <= 0:
+        return None
+    max_bytes = int(max_mb * 1024 * 1024)
+    if _BUFFER_ARENA is None:
+        _BUFFER_ARENA = BufferArena(max_bytes)
+    _BUFFER_ARENA.max_bytes = max_bytes
+    return _BUFFER_ARENA
+
+def run_tiled(image, func, halo, tile_rows=256, threads=0, out=None, arena=None):
+    """
+    اجرای func روی نوارهای افقی تصویر به صورت موازی و دوختن نتیجه.
+    هر نوار halo ردیف از همسایه‌های بالا و پایین را هم می‌گیرد، پس برای فیلتری با شعاع <= halo
+    خروجی بیت به بیت با اجرای روی کل تصویر برابر است. func(tile, out) باید ابعاد و نوع داده را حفظ کند
+    و خروجی را در out (اگر None نباشد) بنویسد.
+    tile_rows: ارتفاع هر نوار؛ threads: تعداد نخ‌ها (0 = تعداد هسته‌ها، 1 = بدون نواربندی).
+    out: بافر خروجی اختیاری هم‌اندازهٔ image (جدا از image)؛ arena: آرنای بافرهای موقت نوارها (اختیاری).
+    """
     try:
-        print("Reading input image...")
-        image = cv2.imread(args.input, cv2.IMREAD_UNCHANGED)
-        if image is None:
-            print("Error: Could not read input image.")
-            sys.exit(1)
-        print("Input image read successfully.")
+        rows = image.shape[0]
+        if threads == 1 or tile_rows <= 0 or rows <= tile_rows:
+            return func(image, out)
+
+        output = out if out is not None else np.empty_like(image)
+
+        def run_band(y0):
+            y1 = min(y0 + tile_rows, rows)
+            p0 = max(y0 - halo, 0)
+            p1 = min(y1 + halo, rows)
+            band = image[p0:p1]
+            scratch = arena.take(band.shape, band.dtype) if arena is not None else None
+            result = func(band, scratch)
+            output[y0:y1] = result[y0 - p0:y1 - p0]
+            if arena is not None:
+                arena.give(scratch)
+
+        list(get_tile_pool(threads).map(run_band, range(0, rows, tile_rows)))
+        return output
     except Exception as e:
-        print(f"Error reading input image: {e}")
+        print(f"Error in run_tiled: {e}")
         sys.exit(1)
 
+class StageProfiler:
+    """
+    ثبت زمان دیواری، زمان CPU، بیشینهٔ تخصیص حافظه (اختیاری، با tracemalloc) و ابعاد خروجی هر مرحلهٔ یک کار.
+    hook (اختیاری) در شروع و پایان هر مرحله با (name, "start"/"end") صدا زده می‌شود؛
+    مثلاً برای علامت‌گذاری در profilerهای نمونه‌برداری.
+    """
+
+    def __init__(self, trace_memory=False, hook=None):
+        self.trace_memory = trace_memory
+        self.hook = hook
+        self.stages = []
+        self.depth = 0
+        # بیشینهٔ مطلق حافظهٔ مراحل تودرتو؛ reset_peak مرحلهٔ داخلی بیشینهٔ مرحلهٔ بیرونی را پاک می‌کند
+        self._nested_peaks = []
+        self._started_tracing = False
+        self._start = time.perf_counter()
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._started_tracing = True
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        entry = {"name": name, "depth": self.depth}
+        self.stages.append(entry)
+        if self.hook:
+            self.hook(name, "start")
+        if self.trace_memory:
+            if self._nested_peaks:
+                _, peak = tracemalloc.get_traced_memory()
+                self._nested_peaks[-1] = max(self._nested_peaks[-1], peak)
+            tracemalloc.reset_peak()
+            base, _ = tracemalloc.get_traced_memory()
+            self._nested_peaks.append(base)
+        self.depth += 1
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield entry
+        finally:
+            entry["wallMs"] = round((time.perf_counter() - wall) * 1000, 2)
+            entry["cpuMs"] = round((time.process_time() - cpu) * 1000, 2)
+            self.depth -= 1
+            if self.trace_memory:
+                _, peak = tracemalloc.get_traced_memory()
+                peak = max(peak, self._nested_peaks.pop())
+                entry["peakMb"] = round((peak - base) / (1024 * 1024), 2)
+                if self._nested_peaks:
+                    self._nested_peaks[-1] = max(self._nested_peaks[-1], peak)
+            if self.hook:
+                self.hook(name, "end")
+
+    def close(self):
+        if self._started_tracing:
+            tracemalloc.stop()
+            self._started_tracing = False
+
+    def to_record(self):
+        """
+        یک رکورد JSON برای کل کار.
+        """
+        return {
+            "totalMs": round((time.perf_counter() - self._start) * 1000, 2),
+            "peakRssMb": round(peak_rss_mb(), 1),
+            "stages": self.stages,
+        }
+
+    def server_timing(self):
+        """
+        رشتهٔ سازگار با هدر Server-Timing (فقط مراحل سطح بالا).
+        """
+        parts = []
+        for index, entry in enumerate(self.stages):
+            if entry["depth"] == 0 and "wallMs" in entry:
+                token = re.sub(r"[^A-Za-z0-9_-]+", "-", entry["name"]).strip("-")
+                parts.append(f'{index}-{token};dur={entry["wallMs"]};desc="{entry["name"]}"')
+        return ", ".join(parts)
+
+# profiler کار جاری؛ None یعنی ابزارسنجی خاموش است و profile_stage هزینه‌ای ندارد
+_PROFILER = None
+_LAST_PROFILE = None
+_NULL_STAGE = contextlib.nullcontext({})
+
+def profile_stage(name):
+    """
+    context manager ثبت یک مرحله در profiler کار جاری (در حالت خاموش یک nullcontext مشترک).
+    """
+    if _PROFILER is None:
+        return _NULL_STAGE
+    return _PROFILER.stage(name)
+
+def record_output(entry, image):
+    """
+    ثبت ابعاد خروجی مرحله در رکورد profiler (در حالت خاموش کاری نمی‌کند).
+    """
+    if _PROFILER is not None and image is not None:
+        entry["shape"] = list(np.shape(image))
+    return image
+
+def load_profile_hook(spec):
+    """
+    بارگذاری hook از رشتهٔ "module:function".
+    """
+    if not spec:
+        return None
+    module_name, _, function_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+@contextlib.contextmanager
+def job_profiler(args):
+    """
+    فعال‌سازی ابزارسنجی برای یک کار طبق --instrument/--instrumentMemory/--profileHook.
+    پس از پایان کار نتیجه با last_job_profile() در دسترس است.
+    """
+    global _PROFILER, _LAST_PROFILE
+    _LAST_PROFILE = None
+    if args.instrument.lower() != 'true':
+        yield None
+        return
+    profiler = StageProfiler(args.instrumentMemory.lower() == 'true', load_profile_hook(args.profileHook))
+    _PROFILER = profiler
     try:
-        if image.shape[2] != 4:
+        yield profiler
+    finally:
+        _PROFILER = None
+        profiler.close()
+        _LAST_PROFILE = profiler
+
+def last_job_profile():
+    """
+    profiler آخرین کار (یا None اگر ابزارسنجی خاموش بوده).
+    """
+    return _LAST_PROFILE
+
+# کش LRU خروجی مراحل زنجیره (checkpoint) با سقف حجم؛ کلید = (هش تصویر ورودی، پارامترهای مراحل تا آن نقطه)
+_CHECKPOINTS = OrderedDict()
+_CHECKPOINT_BYTES = 0
+_CHECKPOINT_LOCK = threading.Lock()
+
+def get_checkpoint(key):
+    with _CHECKPOINT_LOCK:
+        image = _CHECKPOINTS.get(key)
+        if image is not None:
+            _CHECKPOINTS.move_to_end(key)
+        return image
+
+def put_checkpoint(key, image, max_bytes, copy=False):
+    """
+    ذخیرهٔ خروجی یک مرحله (فقط‌خواندنی) و حذف قدیمی‌ترین checkpointها تا زیر سقف حجم.
+    copy: image بافر موقت (مثلاً از آرنا) است و فقط اگر واقعاً ذخیره شود، یک کپی از آن نگه داشته می‌شود.
+    """
+    global _CHECKPOINT_BYTES
+    with _CHECKPOINT_LOCK:
+        if image.nbytes > max_bytes or key in _CHECKPOINTS:
+            return
+        if copy:
+            image = image.copy()
+        image.setflags(write=False)
+        _CHECKPOINTS[key] = image
+        _CHECKPOINT_BYTES += image.nbytes
+        while _CHECKPOINT_BYTES > max_bytes:
+            _, evicted = _CHECKPOINTS.popitem(last=False)
+            _CHECKPOINT_BYTES -= evicted.nbytes
+
+def run_stages(image, stages, checkpoint_mb=0, buffers=None):
+    """
+    اجرای پشت‌سرهم مراحل [(name, params, func), ...] روی image؛ هر func(image, out) خروجی را برمی‌گرداند
+    و اگر out داده شده باشد در آن می‌نویسد.
+    buffers: دو بافر هم‌اندازهٔ image برای اجرای رفت‌وبرگشتی (ping-pong)؛ هر مرحله از یکی می‌خواند و در
+    دیگری می‌نویسد، پس کل زنجیره بدون تخصیص آرایهٔ تازه اجرا می‌شود. خروجی ممکن است یکی از همین بافرها باشد.
+    با checkpoint_mb > 0 خروجی هر مرحله با کلید (هش image، پارامترهای مراحل تا آن مرحله) نگه داشته می‌شود
+    و اجرا از عمیق‌ترین checkpoint معتبر ادامه می‌یابد؛ مثلاً تغییر فقط Vignette مراحل قبلی را تکرار نمی‌کند.
+    checkpointها بعد از کار هم زنده می‌مانند، پس با buffers فقط خروجی مرحله‌ای که واقعاً checkpoint می‌شود
+    (کلید تازه و زیر سقف حجم) از بافر کپی می‌شود؛ بقیهٔ مراحل مثل حالت بدون checkpoint تخصیصی ندارند.
+    """
+    def next_buffer(image):
+        if not buffers:
+            return None
+        return buffers[1] if buffers[0] is image else buffers[0]
+
+    if checkpoint_mb <= 0:
+        for name, _, func in stages:
+            print(f"Applying {name}...")
+            with profile_stage(name) as entry:
+                image = record_output(entry, func(image, next_buffer(image)))
+        return image
+
+    max_bytes = int(checkpoint_mb * 1024 * 1024)
+    source_hash = image_content_hash(image)
+    keys = []
+    prefix = ()
+    for name, params, _ in stages:
+        prefix = prefix + ((name, params),)
+        keys.append((source_hash, prefix))
+
+    start = 0
+    for index in range(len(stages), 0, -1):
+        cached = get_checkpoint(keys[index - 1])
+        if cached is not None:
+            print(f"Resuming from checkpoint after stage '{stages[index - 1][0]}'.")
+            with profile_stage(f"checkpoint:{stages[index - 1][0]}") as entry:
+                record_output(entry, cached)
+            image = cached
+            start = index
+            break
+
+    for index in range(start, len(stages)):
+        name, _, func = stages[index]
+        print(f"Applying {name}...")
+        with profile_stage(name) as entry:
+            result = record_output(entry, func(image, next_buffer(image)))
+        # مرحلهٔ بی‌اثر همان ورودی را برمی‌گرداند؛ checkpoint قبلی همان نتیجه را پوشش می‌دهد
+        if result is not image:
+            put_checkpoint(keys[index], result, max_bytes, copy=bool(buffers))
+        image = result
+    return image
+
+def subject_bounding_box(alpha_channel, margin):
+    """
+    پیدا کردن کادر محیطی پیکسل‌های alpha > 0 با حاشیهٔ margin، محدود به قاب.
+    خروجی: (y0, y1, x0, x1) یا None اگر تصویر کاملاً شفاف باشد.
+    """
+    try:
+        x, y, w, h = cv2.boundingRect(alpha_channel)
+        if w == 0 or h == 0:
+            return None
+        rows, cols = alpha_channel.shape[:2]
+        return (
+            max(y - margin, 0), min(y + h + margin, rows),
+            max(x - margin, 0), min(x + w + margin, cols),
+        )
+    except Exception as e:
+        print(f"Error in subject_bounding_box: {e}")
+        sys.exit(1)
+
+def process_subject(image, args, faces=None):
+    """
+    اجرای زنجیرهٔ افکت‌ها روی تصویر BGRA؛ در حالت cropToSubject فقط روی کادر سوژه
+    (ناحیهٔ alpha > 0 با حاشیه‌ای به اندازهٔ کرنل فیلترها) اجرا و نتیجه در قاب اصلی جای‌گذاری می‌شود.
+    faces: landmarkهای نرمال‌شدهٔ از پیش محاسبه‌شده نسبت به کل image (مثلاً از ردیابی ویدیو)؛ None = تشخیص.
+    تشخیص روی قاب منبع (پیش از پیش‌نمایش و برش) و فقط در صورت نیاز مرحله‌ای انجام می‌شود؛ کش detect_faces
+    با هش همین قاب کلید می‌خورد و landmarkها سپس به دستگاه برش نگاشت می‌شوند، پس ویرایش دوبارهٔ همان
+    آپلود با اسلایدرهای دیگر (کادر برش یا مقیاس متفاوت) تشخیص را تکرار نمی‌کند.
+    """
+    try:
+        if image.ndim != 3 or image.shape[2] != 4:
             print("Error: Input image does not have an alpha channel.")
             sys.exit(1)
     except Exception as e:
@@ -549,67 +1842,195 @@ def main():
         sys.exit(1)
 
     try:
-        print("Separating channels...")
-        bgr = image[:, :, :3]
-        alpha_channel = image[:, :, 3]
+        plan = pipeline_plan(args)
     except Exception as e:
-        print(f"Error separating channels: {e}")
+        print(f"Error in pipeline spec: {e}")
         sys.exit(1)
 
+    if faces is None:
+        source_bgr = image[:, :, :3]
+
+        def detect_source_faces():
+            print("Detecting faces using Mediapipe FaceMesh...")
+            with profile_stage("face detection"):
+                return detect_faces(source_bgr, args.detectMaxSide)
+
+        faces = detect_source_faces
+
+    with profile_stage("preview resize") as entry:
+        image, scale = make_preview(image, args.previewMaxSide)
+        record_output(entry, image)
+
+    if args.cropToSubject.lower() != 'true':
+        return process_subject_frame(image, args, scale=scale, faces=faces, plan=plan)
+
+    # حاشیهٔ 2 پیکسلی اضافه برای Morphological Close روی کانال آلفا؛
+    # با checkpoint حاشیه ثابت (بیشینه) است تا تغییر اسلایدرهای مکانی کادر برش و در نتیجه کلیدها را عوض نکند
+    halo = effect_chain_halo(plan, scale)
+    if args.checkpointMb > 0:
+        halo = max(halo, MAX_EFFECT_CHAIN_HALO)
+    bbox = subject_bounding_box(image[:, :, 3], halo + 2)
+    if bbox is None:
+        print("Subject is fully transparent; processing the whole frame.")
+        return process_subject_frame(image, args, scale=scale, faces=faces, plan=plan)
+
+    y0, y1, x0, x1 = bbox
+    print(f"Cropping to subject: rows {y0}-{y1}, cols {x0}-{x1} of {image.shape[0]}x{image.shape[1]}")
+    # مختصات نرمال‌شدهٔ قاب به مختصات نرمال‌شدهٔ برش
+    frame_size = np.array((image.shape[1], image.shape[0]), dtype=np.float32)
+    crop_size = np.array((x1 - x0, y1 - y0), dtype=np.float32)
+    frame_faces = faces
+
+    def crop_faces():
+        points_list = frame_faces() if callable(frame_faces) else frame_faces
+        return [(points * frame_size - (x0, y0)) / crop_size for points in points_list]
+
+    faces = crop_faces
+    processed = process_subject_frame(
+        image[y0:y1, x0:x1], args, frame_shape=image.shape, offset=(y0, x0), scale=scale, faces=faces, plan=plan
+    )
     try:
-        print("Detecting faces using Mediapipe FaceMesh...")
-        mp_face_mesh = mp.solutions.face_mesh
-        with mp_face_mesh.FaceMesh(
-            static_image_mode=True,
-            max_num_faces=10,
-            refine_landmarks=True,
-            min_detection_confidence=0.3
-        ) as face_mesh:
-            results = face_mesh.process(cv2.cvtColor(bgr, cv2.COLOR_BGR2RGB))
-
-        faceEnhanceBool = (args.faceEnhance.lower() == 'true')
-        if results.multi_face_landmarks and faceEnhanceBool:
-            print(f"Detected {len(results.multi_face_landmarks)} face(s). Applying face effects...")
-            for face_landmark in results.multi_face_landmarks:
-                bgr = apply_face_effects(bgr, face_landmark, args)
-        else:
-            print("No faces detected for facial effects or faceEnhance is False.")
+        with profile_stage("paste crop"):
+            final_image = np.copy(image)
+            final_image[y0:y1, x0:x1] = processed
+        return final_image
     except Exception as e:
-        print(f"Error processing face landmarks: {e}")
+        print(f"Error pasting subject crop: {e}")
         sys.exit(1)
 
-    # اعمال افکت‌های عمومی
+def make_preview(image, max_side):
+    """
+    نسخهٔ کوچک‌شدهٔ تصویر برای حالت پیش‌نمایش (INTER_AREA) به همراه ضریب کوچک‌سازی.
+    اگر max_side صفر باشد یا تصویر از آن کوچک‌تر باشد، خود تصویر با ضریب 1 برمی‌گردد.
+    """
+    h, w = image.shape[:2]
+    if max_side <= 0 or max(h, w) <= max_side:
+        return image, 1.0
+    scale = max_side / float(max(h, w))
+    size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+    print(f"Preview mode: rendering at {size[0]}x{size[1]} instead of {w}x{h}")
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+
+def process_subject_frame(image, args, frame_shape=None, offset=(0, 0), scale=1.0, faces=None, plan=None):
+    """
+    اجرای کل زنجیرهٔ افکت‌ها روی یک تصویر BGRA و برگرداندن تصویر BGRA نهایی.
+    frame_shape و offset وقتی image برشی از قاب بزرگ‌تر است، هندسهٔ Vignette را به قاب اصلی می‌بندند.
+    scale: در حالت پیش‌نمایش ضریب کوچک‌سازی نسبت به اصل؛ کرنل فیلترهای مکانی به همان نسبت کوچک می‌شوند
+    تا ظاهر پیش‌نمایش با رندر کامل یکی باشد (Vignette نسبت به ابعاد قاب تعریف شده و خودبه‌خود مقیاس می‌شود).
+    faces: landmarkهای نرمال‌شده نسبت به image، یا تابعی که آن‌ها را (فقط در صورت نیاز) برمی‌گرداند؛
+    None = تشخیص با detect_faces روی خود image.
+    plan: برنامهٔ اجرای زنجیره (PipelinePlan)؛ None = ساخت از args با pipeline_plan.
+    """
     try:
-        print("Applying black and white effect...")
-        bw_image = blend_with_grayscale(bgr, args.blackWhiteLevel)
+        print("Separating channels...")
+        bgr = image[:, :, :3]
+        alpha_channel = image[:, :, 3]
+    except Exception as e:
+        print(f"Error separating channels: {e}")
+        sys.exit(1)
 
-        print("Applying posterize effect...")
-        posterized_image = posterize(bw_image, args.posterizeBits)
+    if plan is None:
+        plan = pipeline_plan(args)
+    h, w = bgr.shape[:2]
+    detected = None
+
+    def face_geometries():
+        # تشخیص چهره فقط وقتی مرحله‌ای که باید اجرا شود به آن نیاز دارد (نتیجه در detect_faces هم کش است)
+        nonlocal detected
+        if detected is None:
+            if faces is not None:
+                points_list = faces() if callable(faces) else faces
+                detected = [FaceGeometry(face_points, w, h) for face_points in points_list]
+            elif plan.needs_landmarks:
+                print("Detecting faces using Mediapipe FaceMesh...")
+                with profile_stage("face detection"):
+                    detected = [FaceGeometry(face_points, w, h) for face_points in detect_faces(bgr, args.detectMaxSide)]
+            else:
+                detected = []
+                print("Face detection skipped: no enabled stage needs landmarks.")
+        return detected
 
-        print("Adjusting contrast...")
-        contrasted_image = adjust_contrast(posterized_image, args.contrastFactor)
+    arena = get_buffer_arena(args.bufferArenaMb)
 
-        print("Applying overlay...")
-        overlayed_image = apply_overlay(contrasted_image, args.overlayAlpha, color=(0, 0, 0))
+    def tiled(image, out, func, halo=0):
+        return run_tiled(image, func, halo, args.tileRows, args.threads, out=out, arena=arena)
 
-        # اعمال blackLevel و whiteLevel در صورت نیاز (در حال حاضر پیاده نشده).
+    def face_stage(image, out, params):
+        geometries = face_geometries()
+        if not geometries:
+            print("No faces detected for facial effects.")
+            return image
+        print(f"Detected {len(geometries)} face(s). Applying face effects...")
+        # افکت‌های چهره درجا می‌نویسند؛ ورودی فراخواننده دست‌نخورده می‌ماند
+        if out is not None:
+            np.copyto(out, image)
+            image = out
+        else:
+            image = image.copy()
+        for geometry in geometries:
+            image = apply_face_effects(image, geometry, params)
+        return image
 
-        # Brightness
-        overlayed_image = adjust_brightness(overlayed_image, args.brightness)
-        # Saturation
-        overlayed_image = adjust_saturation(overlayed_image, args.saturation)
-        # Sharpness
-        overlayed_image = adjust_sharpness(overlayed_image, args.sharpness)
-        # Hue
-        overlayed_image = adjust_hue(overlayed_image, args.hue)
-        # Blur
-        overlayed_image = apply_blur(overlayed_image, args.blur)
-        # Vignette
-        overlayed_image = apply_vignette(overlayed_image, args.vignette)
-        # Skin Smooth
-        overlayed_image = apply_skin_smooth(overlayed_image, args.skinSmooth)
-
-        final_bgr = overlayed_image
+    def skin_stage(image, out, params):
+        if params["mode"] == 'fast':
+            return apply_skin_smooth(
+                image, params["strength"], mode="fast", quality=params["quality"],
+                geometries=face_geometries(), scale=scale, out=out
+            )
+        return tiled(
+            image, out,
+            lambda tile, tile_out: apply_skin_smooth(tile, params["strength"], scale=scale, out=tile_out),
+            skin_smooth_halo(params["strength"], scale=scale)
+        )
+
+    def executable(stage):
+        # (پارامترهای مؤثر بر خروجی، تابع)؛ tileRows/threads خروجی را تغییر نمی‌دهند ولی scale،
+        # هندسهٔ قاب و پروکسی تشخیص چهره تغییر می‌دهند و در کلید checkpoint می‌آیند
+        p = dict(stage.params)
+        if stage.kind == "faceEffects":
+            return (args.detectMaxSide,), lambda image, out: face_stage(image, out, p)
+        if stage.kind == "blackWhite":
+            return (), lambda image, out: tiled(
+                image, out, lambda tile, tile_out: blend_with_grayscale(tile, p["level"], out=tile_out))
+        if stage.kind == "tone":
+            # posterize، contrast و overlay در یک گذر LUT
+            return (), lambda image, out: tiled(
+                image, out, lambda tile, tile_out: apply_tone_curve(tile, p["stages"], out=tile_out))
+        if stage.kind == "hsv":
+            # Brightness + Saturation + Hue در یک گذر HSV
+            return (), lambda image, out: tiled(
+                image, out, lambda tile, tile_out: adjust_hsv(tile, p["brightness"], p["saturation"], p["hue"], out=tile_out))
+        if stage.kind == "sharpness":
+            return (scale,), lambda image, out: tiled(
+                image, out, lambda tile, tile_out: adjust_sharpness(tile, p["factor"], scale, out=tile_out),
+                sharpness_halo(p["factor"], scale))
+        if stage.kind == "blur":
+            return (scale,), lambda image, out: tiled(
+                image, out, lambda tile, tile_out: apply_blur(tile, p["level"], scale, out=tile_out),
+                blur_halo(p["level"], scale))
+        if stage.kind == "vignette":
+            # Vignette وابسته به موقعیت است؛ یک ضرب سراسری
+            return (frame_shape, offset), lambda image, out: apply_vignette(
+                image, p["strength"], frame_shape=frame_shape, offset=offset, out=out)
+        if stage.kind == "skinSmooth":
+            return (args.detectMaxSide, scale), lambda image, out: skin_stage(image, out, p)
+        raise ValueError(f"Unsupported pipeline stage: {stage.kind}")
+
+    # هر مرحله: (نام، پارامترهای مؤثر بر خروجی، تابع)؛ مراحل کانال آلفا بعد از ترکیب اجرا می‌شوند
+    stages = []
+    for stage in plan.stages:
+        if stage.alpha:
+            continue
+        extra, func = executable(stage)
+        stages.append((stage.name, stage.params + extra, func))
+
+    # دو بافر رفت‌وبرگشتی از آرنا برای کل زنجیره؛ بعد از ساختن تصویر BGRA نهایی به آرنا برمی‌گردند
+    buffers = None
+    if arena is not None and stages:
+        buffers = [arena.take(bgr.shape, bgr.dtype), arena.take(bgr.shape, bgr.dtype)]
+
+    try:
+        final_bgr = run_stages(bgr, stages, args.checkpointMb, buffers)
     except Exception as e:
         print(f"Error applying effects: {e}")
         sys.exit(1)
@@ -617,40 +2038,452 @@ def main():
     # ترکیب با کانال آلفا
     try:
         print("Combining with alpha channel...")
-        final_image = cv2.cvtColor(final_bgr, cv2.COLOR_BGR2BGRA)
-        final_image[:, :, 3] = alpha_channel
+        with profile_stage("combine alpha"):
+            final_image = cv2.cvtColor(final_bgr, cv2.COLOR_BGR2BGRA)
+            final_image[:, :, 3] = alpha_channel
     except Exception as e:
         print(f"Error combining with alpha channel: {e}")
         sys.exit(1)
+    finally:
+        for buffer in buffers or ():
+            arena.give(buffer)
 
     # (جدید) مرحلهٔ پس‌پردازش روی کانال آلفا برای رفع نویز لبه‌ها
-    try:
-        print("Post-processing alpha channel (removing noise on edges)...")
+    for stage in plan.stages:
+        if stage.kind != "alphaClose":
+            continue
+        try:
+            print("Post-processing alpha channel (removing noise on edges)...")
+
+            # جدا کردن کانال آلفا
+            alpha = final_image[:, :, 3]
+
+            # روش 1: Morphological Close با یک کرنل 3x3
+            kernel = np.ones((3, 3), np.uint8)
+            with profile_stage(stage.name):
+                alpha = cv2.morphologyEx(alpha, cv2.MORPH_CLOSE, kernel, iterations=dict(stage.params)["iterations"])
+
+            # (اختیاری) اگر خواستید کمی نرم‌تر شود:
+            # alpha = cv2.GaussianBlur(alpha, (3,3), 0)
+
+            # برگرداندن آلفا به تصویر
+            final_image[:, :, 3] = alpha
+        except Exception as e:
+            print(f"Error in alpha post-processing step: {e}")
+            sys.exit(1)
+
+    return final_image
+
+def read_input_bytes(args):
+    """
+    بایت‌های کدشدهٔ ورودی: از فایل args.input یا در صورت "-" از stdin.
+    """
+    if args.input == '-':
+        return sys.stdin.buffer.read()
+    with open(args.input, "rb") as f:
+        return f.read()
 
-        # جدا کردن کانال آلفا
-        alpha = final_image[:, :, 3]
+def decode_image(image_bytes):
+    """
+    دیکد بایت‌های تصویر با cv2.imdecode (بدون کپی اضافه از بافر ورودی).
+    """
+    return cv2.imdecode(np.frombuffer(image_bytes, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+
+def encode_image(image, extension=".png", params=()):
+    """
+    کد کردن تصویر خروجی در حافظه با cv2.imencode؛ خروجی آرایهٔ uint8 یک‌بعدی است.
+    """
+    ok, encoded = cv2.imencode(extension, image, list(params))
+    if not ok:
+        raise ValueError(f"Could not encode output image as {extension}")
+    return encoded
+
+OUTPUT_FORMATS = {
+    ".png": "png",
+    ".webp": "webp",
+    ".jpg": "jpeg",
+    ".jpeg": "jpeg",
+}
+
+def output_format(args):
+    """
+    فرمت خروجی: --outputFormat یا در صورت خالی بودن، از پسوند فایل خروجی (پیش‌فرض png).
+    """
+    if args.outputFormat:
+        return args.outputFormat
+    if args.output and args.output != '-':
+        return OUTPUT_FORMATS.get(os.path.splitext(args.output)[1].lower(), "png")
+    return "png"
 
-        # روش 1: Morphological Close با یک کرنل 3x3
-        kernel = np.ones((3, 3), np.uint8)
-        alpha = cv2.morphologyEx(alpha, cv2.MORPH_CLOSE, kernel, iterations=1)
+def encode_format(image, fmt, quality=90, png_compression=1):
+    """
+    کد کردن یک تصویر BGRA با یک فرمت.
+    خروجی: لیست (name, mime_type, extension, encoded)؛
+    png و webp یک خروجی با آلفا دارند و jpeg رنگ (JPEG) به همراه ماسک آلفای جدا (PNG خاکستری) برمی‌گرداند.
+    """
+    png_params = (cv2.IMWRITE_PNG_COMPRESSION, png_compression)
+    if fmt == "png":
+        return [("image", "image/png", ".png", encode_image(image, ".png", png_params))]
+    if fmt == "webp":
+        # کیفیت بیشتر از 100 در OpenCV یعنی WebP بدون اتلاف
+        return [("image", "image/webp", ".webp", encode_image(image, ".webp", (cv2.IMWRITE_WEBP_QUALITY, quality)))]
+    if fmt == "jpeg":
+        color = encode_image(image[:, :, :3], ".jpg", (cv2.IMWRITE_JPEG_QUALITY, min(quality, 100)))
+        mask = encode_image(image[:, :, 3], ".png", png_params)
+        return [("image", "image/jpeg", ".jpg", color), ("mask", "image/png", ".png", mask)]
+    raise ValueError(f"Unsupported output format: {fmt}")
+
+def encode_outputs(image, args):
+    """
+    کد کردن تصویر BGRA نهایی با فرمت و تنظیمات سرعت/کیفیت کار (یا با --renditions، همهٔ اندازه‌ها).
+    خروجی: لیست (name, mime_type, extension, encoded).
+    """
+    if args.renditions:
+        return encode_renditions(image, args)
+    return encode_format(image, output_format(args), args.quality, args.pngCompression)
 
-        # (اختیاری) اگر خواستید کمی نرم‌تر شود:
-        # alpha = cv2.GaussianBlur(alpha, (3,3), 0)
+# سقف تعداد renditionهای یک کار (هر کدام یک کد کردن کامل است)
+MAX_RENDITIONS = 8
 
-        # برگرداندن آلفا به تصویر
-        final_image[:, :, 3] = alpha
+def parse_renditions(spec, default_format="png", default_quality=90, source_side=0):
+    """
+    فهرست renditionهای خروجی از رشتهٔ "maxSide[:format[:quality]],..." (مثل "0:png,1024:webp:85,256:jpeg:80")
+    یا JSON به شکل [{"maxSide": 1024, "format": "webp", "quality": 85}, ...]. maxSide صفر = اندازهٔ کامل.
+    source_side: بزرگ‌ترین ضلع تصویر منبع؛ maxSide بزرگ‌تر از آن به همین مقدار محدود می‌شود (0 = نامعلوم).
+    خروجی: لیست (max_side, format, quality, suffix) به ترتیب درخواست؛ بیش از MAX_RENDITIONS مورد خطاست.
+    suffix پسوند نام خروجی است و از اندازهٔ درخواستی (نه محدودشده) می‌آید تا به اندازهٔ منبع وابسته نباشد:
+    "" برای rendition اول (خروجی اصلی)، "<maxSide>" یا "Full" برای بقیه؛ نام تکراری اول نام فرمت
+    و سپس شماره می‌گیرد (512، 512Webp، 512Webp2، ...).
+    """
+    if spec.lstrip().startswith("["):
+        items = [
+            (item.get("maxSide", 0), item.get("format") or default_format, item.get("quality", default_quality))
+            for item in json.loads(spec)
+        ]
+    else:
+        items = []
+        for part in spec.split(","):
+            fields = part.strip().split(":")
+            items.append((
+                fields[0],
+                fields[1] if len(fields) > 1 and fields[1] else default_format,
+                fields[2] if len(fields) > 2 and fields[2] else default_quality,
+            ))
+    if len(items) > MAX_RENDITIONS:
+        raise ValueError(f"Too many renditions: {len(items)} (at most {MAX_RENDITIONS})")
+    renditions = []
+    used = set()
+    for index, (max_side, fmt, quality) in enumerate(items):
+        max_side, quality = int(max_side), int(quality)
+        if max_side < 0:
+            raise ValueError(f"Invalid rendition size: {max_side}")
+        if fmt not in ("png", "webp", "jpeg"):
+            raise ValueError(f"Unsupported rendition format: {fmt}")
+        suffix = "" if index == 0 else (str(max_side) if max_side else "Full")
+        if suffix in used:
+            suffix += fmt.capitalize()
+        base, number = suffix, 2
+        while suffix in used:
+            suffix = f"{base}{number}"
+            number += 1
+        used.add(suffix)
+        if source_side > 0:
+            max_side = min(max_side, source_side)
+        renditions.append((max_side, fmt, quality, suffix))
+    return renditions
+
+def rendition_pyramid(image, sides):
+    """
+    تولید نسخه‌های کوچک‌شدهٔ image برای ضلع‌های بیشینهٔ sides، از بزرگ به کوچک.
+    هر سطح با INTER_AREA از سطح قبلی (نه از تصویر کامل) ساخته می‌شود؛ ابعاد هر سطح نسبت به تصویر کامل گرد می‌شوند.
+    ضلع صفر یا بزرگ‌تر از تصویر همان image را می‌دهد (بزرگ‌نمایی انجام نمی‌شود).
+    خروجی: generator زوج‌های (side، تصویر).
+    """
+    h, w = image.shape[:2]
+    longest = max(h, w)
+    current = image
+    for side in sorted(set(sides), key=lambda value: -value if value else -float("inf")):
+        if side == 0 or side >= longest:
+            yield side, image
+            continue
+        scale = side / float(longest)
+        size = (max(1, int(round(w * scale))), max(1, int(round(h * scale))))
+        current = cv2.resize(current, size, interpolation=cv2.INTER_AREA)
+        yield side, current
+
+def encode_renditions(image, args):
+    """
+    همهٔ renditionهای --renditions از یک تصویر نهایی در یک کار: هرم INTER_AREA و کد کردن موازی
+    (کد کردن هر سطح در استخر نخ هم‌زمان با ساختن سطح کوچک‌تر بعدی شروع می‌شود).
+    نام خروجی‌ها: image/mask برای rendition اول (خروجی اصلی) و image<suffix>/mask<suffix> برای بقیه
+    (suffix از parse_renditions، مثل image512 یا imageFull). renditionهایی که پس از محدود شدن به اندازهٔ
+    منبع یکسان می‌شوند (همان اندازه، فرمت و کیفیت) یک بار کد می‌شوند.
+    """
+    renditions = parse_renditions(args.renditions, output_format(args), args.quality, max(image.shape[:2]))
+    pool = get_tile_pool(args.threads)
+    futures = {}
+    for side, level in rendition_pyramid(image, [max_side for max_side, _, _, _ in renditions]):
+        for max_side, fmt, quality, _ in renditions:
+            key = (max_side, fmt, quality)
+            if max_side == side and key not in futures:
+                futures[key] = pool.submit(encode_format, level, fmt, quality, args.pngCompression)
+
+    outputs = []
+    for max_side, fmt, quality, suffix in renditions:
+        for name, mime_type, extension, encoded in futures[(max_side, fmt, quality)].result():
+            outputs.append((f"{name}{suffix}", mime_type, extension, encoded))
+    return outputs
+
+def write_outputs(outputs, output_path):
+    """
+    ذخیرهٔ خروجی‌ها روی دیسک: خروجی اصلی در output_path و بقیه کنار آن با پسوند _<name>.
+    هر فایل اول در یک فایل موقت نوشته و سپس جایگزین می‌شود تا اجرای نیمه‌کاره فایل ناقص باقی نگذارد.
+    """
+    stem = os.path.splitext(output_path)[0]
+    for name, _, extension, encoded in outputs:
+        path = output_path if name == "image" else f"{stem}_{name}{extension}"
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        encoded.tofile(temp_path)
+        os.replace(temp_path, path)
+
+def run_job(args, input_bytes=None):
+    """
+    اجرای زنجیرهٔ افکت‌ها روی یک تصویر کدشده.
+    input_bytes: بایت‌های ورودی؛ اگر None باشد از args.input (فایل یا "-" برای stdin) خوانده می‌شود.
+    خروجی در args.output نوشته می‌شود؛ اگر output برابر "-" یا None باشد خروجی‌های کدشدهٔ
+    encode_outputs برگردانده می‌شوند. با --instrument True رکورد مراحل با last_job_profile() در دسترس است.
+    بیشینهٔ حافظهٔ مقیم در شروع کار صفر می‌شود؛ پس از کار peak_rss_mb() بیشینهٔ همین کار است.
+    """
+    reset_peak_rss()
+    with job_profiler(args):
+        return _run_job(args, input_bytes)
+
+def _run_job(args, input_bytes):
+    # فهرست renditionها قبل از پردازش بررسی می‌شود تا خطای آن بعد از کل زنجیره ظاهر نشود
+    if args.renditions:
+        try:
+            parse_renditions(args.renditions, output_format(args), args.quality)
+        except Exception as e:
+            print(f"Error in renditions: {e}")
+            sys.exit(1)
+
+    try:
+        print("Reading input image...")
+        if input_bytes is None:
+            with profile_stage("read input"):
+                input_bytes = read_input_bytes(args)
+        if args.removeBg.lower() == 'true':
+            print("Removing background...")
+            with profile_stage("background removal") as entry:
+                image = record_output(entry, load_subject(input_bytes, args))
+        else:
+            with profile_stage("decode") as entry:
+                image = record_output(entry, decode_image(input_bytes))
+        if image is None:
+            print("Error: Could not read input image.")
+            sys.exit(1)
+        print("Input image read successfully.")
     except Exception as e:
-        print(f"Error in alpha post-processing step: {e}")
+        print(f"Error reading input image: {e}")
         sys.exit(1)
 
-    # ذخیرهٔ فایل خروجی
+    final_image = process_subject(image, args)
+
+    # کد کردن خروجی در حافظه و در صورت نیاز ذخیره در فایل
     try:
-        print("Saving output image...")
-        cv2.imwrite(args.output, final_image)
+        label = "renditions" if args.renditions else output_format(args)
+        print(f"Encoding output image ({label})...")
+        with profile_stage(f"encode {label}") as entry:
+            outputs = encode_outputs(final_image, args)
+            entry["bytes"] = sum(encoded.nbytes for _, _, _, encoded in outputs)
+        if not args.output or args.output == '-':
+            print("Output image encoded successfully.")
+            return outputs
+        with profile_stage("write output"):
+            write_outputs(outputs, args.output)
         print("Output image saved successfully.")
+        return None
     except Exception as e:
         print(f"Error saving output image: {e}")
         sys.exit(1)
 
+def read_frame(stream):
+    """
+    خواندن یک فریم با پیشوند طول 4 بایتی (big-endian). در پایان جریان None برمی‌گرداند.
+    """
+    header = stream.read(4)
+    if len(header) < 4:
+        return None
+    (length,) = struct.unpack(">I", header)
+    payload = stream.read(length)
+    if len(payload) < length:
+        return None
+    return payload
+
+def write_frame(stream, payload):
+    """
+    نوشتن یک فریم با پیشوند طول 4 بایتی (big-endian). payload هر شیء بافر (bytes یا آرایهٔ numpy) است
+    و بدون کپی نوشته می‌شود.
+    """
+    view = memoryview(payload)
+    stream.write(struct.pack(">I", view.nbytes))
+    stream.write(view.cast("B"))
+    stream.flush()
+
+def current_rss_mb():
+    """
+    حافظهٔ مقیم فعلی پروسه به مگابایت (روی لینوکس از /proc، در غیر این صورت بیشینهٔ RSS).
+    """
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # روی macOS واحد ru_maxrss بایت است و روی لینوکس کیلوبایت
+        return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def reset_peak_rss():
+    """
+    صفر کردن بیشینهٔ حافظهٔ مقیم (VmHWM) پروسه تا peak_rss_mb فقط کار جاری را نشان دهد (لینوکس 4.0 به بعد).
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+def peak_rss_mb():
+    """
+    بیشینهٔ حافظهٔ مقیم پروسه به مگابایت از آخرین reset_peak_rss (در غیر لینوکس: از شروع پروسه).
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def run_worker(worker_args):
+    """
+    حالت worker: مدل‌ها یک بار بارگذاری می‌شوند و کارها به صورت فریم‌های JSON از stdin خوانده می‌شوند.
+    هر کار: {"id": ..., "argv": [input, output, "--flag", value, ...], "payload": true/false}
+    هر پاسخ: {"id": ..., "ok": true/false, "error": ..., "recycle": true/false, "matteCache": {...},
+              "outputs": [{"name": ..., "type": ...}, ...], "profile": {...}, "serverTiming": "...",
+              "rssMb": ..., "peakRssMb": ...}
+    اگر payload کار true باشد، فریم بعدی بایت‌های کدشدهٔ ورودی است و input باید "-" باشد؛
+    اگر output برابر "-" باشد، پس از پاسخ موفق به ازای هر عضو outputs یک فریم خام با بایت‌های آن می‌آید.
+    به این ترتیب هیچ فایل موقتی روی دیسک ساخته نمی‌شود.
+    matteCache شمارنده‌های برخورد/عدم برخورد/حذف کش مات در همین کار است (در صورت فعال بودن کش).
+    rssMb حافظهٔ مقیم پس از کار و peakRssMb بیشینهٔ آن در طول همین کار است.
+    پس از maxJobs کار یا عبور حافظه از maxRssMb، worker خارج می‌شود تا والد آن را دوباره بسازد.
+    """
+    protocol_in = sys.stdin.buffer
+    protocol_out = sys.stdout.buffer
+    # stdout برای پروتکل رزرو است؛ لاگ‌های print به stderr می‌روند
+    sys.stdout = sys.stderr
+
+    parser = build_arg_parser()
+    get_face_mesh()
+    if worker_args.removeBg.lower() == 'true':
+        get_rembg_session(worker_args.rembgModel, worker_args.rembgThreads)
+    load_overlay_asset(GLASSES_IMAGE_PATH)
+    write_frame(protocol_out, json.dumps({"ready": True, "pid": os.getpid()}).encode("utf-8"))
+
+    jobs_done = 0
+    while True:
+        payload = read_frame(protocol_in)
+        if payload is None:
+            break
+
+        reply = {"id": None, "ok": True}
+        outputs = None
+        try:
+            job = json.loads(payload)
+            reply["id"] = job.get("id")
+            # فریم بایت‌های ورودی حتی اگر آرگومان‌ها نامعتبر باشند خوانده می‌شود تا پروتکل همگام بماند
+            input_bytes = read_frame(protocol_in) if job.get("payload") else None
+            if job.get("payload") and input_bytes is None:
+                break
+            job_args = parser.parse_args([str(a) for a in job.get("argv", [])])
+            if not job_args.input or not job_args.output:
+                raise ValueError("input and output paths are required")
+            if job_args.input == '-' and input_bytes is None:
+                raise ValueError("input '-' requires a payload frame")
+            if job_args.pipelineFile:
+                raise ValueError("--pipelineFile is not accepted in worker jobs; send the spec inline with --pipeline")
+            matte_cache = get_matte_cache(job_args) if job_args.removeBg.lower() == 'true' else None
+            before = matte_cache.stats() if matte_cache else None
+            outputs = run_job(job_args, input_bytes)
+            profiler = last_job_profile()
+            if profiler is not None:
+                reply["profile"] = profiler.to_record()
+                reply["serverTiming"] = profiler.server_timing()
+            if matte_cache:
+                after = matte_cache.stats()
+                reply["matteCache"] = {name: after[name] - before[name] for name in after}
+        except SystemExit as e:
+            reply["ok"] = False
+            reply["error"] = f"job exited with status {e.code}"
+        except Exception as e:
+            print(f"Error in worker job: {e}")
+            reply["ok"] = False
+            reply["error"] = str(e)
+
+        jobs_done += 1
+        rss_mb = current_rss_mb()
+        recycle = (
+            (worker_args.maxJobs > 0 and jobs_done >= worker_args.maxJobs) or
+            (worker_args.maxRssMb > 0 and rss_mb > worker_args.maxRssMb)
+        )
+        reply["rssMb"] = round(rss_mb, 1)
+        reply["peakRssMb"] = round(peak_rss_mb(), 1)
+        reply["recycle"] = recycle
+        outputs = outputs if reply["ok"] and outputs else []
+        reply["outputs"] = [{"name": name, "type": mime_type} for name, mime_type, _, _ in outputs]
+        write_frame(protocol_out, json.dumps(reply).encode("utf-8"))
+        for _, _, _, encoded in outputs:
+            write_frame(protocol_out, encoded)
+
+        if recycle:
+            print(f"Worker recycling after {jobs_done} job(s), rss={rss_mb:.1f}MB")
+            break
+
+def main():
+    parser = build_arg_parser()
+    args = parser.parse_args()
+
+    if args.worker:
+        run_worker(args)
+        return
+
+    if not args.input or not args.output:
+        parser.error("input and output paths are required")
+
+    if args.output == '-':
+        # stdout فقط بایت‌های خروجی را می‌گیرد؛ لاگ‌ها به stderr می‌روند.
+        # یک خروجی به صورت خام نوشته می‌شود؛ چند خروجی (jpeg + ماسک) هر کدام یک فریم با پیشوند طول
+        output_stream = sys.stdout.buffer
+        sys.stdout = sys.stderr
+        outputs = run_job(args)
+        if len(outputs) == 1:
+            output_stream.write(memoryview(outputs[0][3]).cast("B"))
+            output_stream.flush()
+        else:
+            for _, _, _, encoded in outputs:
+                write_frame(output_stream, encoded)
+    else:
+        run_job(args)
+
+    print(f"Peak resident memory: {peak_rss_mb():.1f} MB")
+
+    # رکورد ابزارسنجی کار به صورت یک خط JSON روی stderr
+    profiler = last_job_profile()
+    if profiler is not None:
+        sys.stderr.write(json.dumps({"profile": profiler.to_record()}) + "\n")
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,242 @@
+# process_video.py
+
+import argparse
+import collections
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+import process_image as pi
+
+PIXEL_FORMATS = {
+    "bgr24": 3,
+    "bgra": 4,
+}
+
+def read_video_frames(source):
+    """
+    فریم‌های BGR از یک فایل ویدیو، URL یا دوربین (source عددی = اندیس دوربین).
+    خروجی: (generator فریم‌ها، fps منبع یا 0)
+    """
+    capture = cv2.VideoCapture(int(source) if source.isdigit() else source)
+    if not capture.isOpened():
+        raise ValueError(f"Could not open video source: {source}")
+    fps = capture.get(cv2.CAP_PROP_FPS) or 0
+
+    def frames():
+        try:
+            while True:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                yield frame
+        finally:
+            capture.release()
+
+    return frames(), fps
+
+def read_raw_frames(stream, width, height, channels):
+    """
+    فریم‌های خام پشت‌سرهم (مثل rawvideo در ffmpeg) از یک pipe؛ هر فریم width*height*channels بایت.
+    """
+    frame_bytes = width * height * channels
+    while True:
+        buffer = bytearray(frame_bytes)
+        view = memoryview(buffer)
+        filled = 0
+        while filled < frame_bytes:
+            count = stream.readinto(view[filled:])
+            if not count:
+                return
+            filled += count
+        yield np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, channels)
+
+def prefetch(iterable, depth):
+    """
+    اجرای iterable (مثلاً دیکد فریم‌ها) در یک نخ جدا با صف محدود depth.
+    خروجی: (generator، صف) تا عمق صف قابل گزارش باشد.
+    """
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                buffer.put(item)
+        except Exception as e:
+            buffer.put(e)
+        finally:
+            buffer.put(done)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    def items():
+        while True:
+            item = buffer.get()
+            if item is done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    return items(), buffer
+
+def ordered_map(executor, func, iterable, depth, in_flight):
+    """
+    اجرای func روی هر عضو iterable در executor با حداکثر depth کار هم‌زمان و برگرداندن نتایج به ترتیب ورودی.
+    in_flight: deque مشترک آینده‌های در حال اجرا (برای گزارش عمق صف).
+    """
+    for item in iterable:
+        in_flight.append(executor.submit(func, *item))
+        if len(in_flight) >= depth:
+            yield in_flight.popleft().result()
+    while in_flight:
+        yield in_flight.popleft().result()
+
+class FaceTracker:
+    """
+    FaceMesh در حالت ردیابی (static_image_mode=False): landmarkها بین فریم‌ها منتقل می‌شوند.
+    باید به ترتیب فریم‌ها و از یک نخ صدا زده شود.
+    """
+
+    def __init__(self, max_side=1024):
+        self.max_side = max_side
+        self.face_mesh = pi.create_face_mesh(static_image_mode=False)
+
+    def __call__(self, bgr):
+        return pi.run_face_mesh(self.face_mesh, bgr, self.max_side)
+
+class FrameWriter:
+    """
+    نوشتن فریم‌های خروجی در یک فایل ویدیو (VideoWriter) یا به صورت خام روی یک جریان.
+    """
+
+    def __init__(self, output, fps, fourcc, pixel_format, stream=None):
+        self.output = output
+        self.fps = fps
+        self.fourcc = fourcc
+        self.pixel_format = pixel_format
+        self.stream = stream
+        self.writer = None
+
+    def write(self, frame):
+        if self.pixel_format == "bgr24" and frame.shape[2] == 4:
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+        if self.stream is not None:
+            self.stream.write(memoryview(np.ascontiguousarray(frame)).cast("B"))
+            return
+        if self.writer is None:
+            h, w = frame.shape[:2]
+            self.writer = cv2.VideoWriter(self.output, cv2.VideoWriter_fourcc(*self.fourcc), self.fps, (w, h))
+            if not self.writer.isOpened():
+                raise ValueError(f"Could not open video writer for {self.output}")
+        self.writer.write(frame)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.release()
+        if self.stream is not None:
+            self.stream.flush()
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Apply an effect preset to a video file, camera or raw frame pipe. '
+                    'Unrecognised flags are passed to process_image.py as the preset.'
+    )
+    parser.add_argument('input', type=str, help='Video file, URL, camera index, or - for raw frames on stdin')
+    parser.add_argument('output', type=str, help='Output video file, or - for raw frames on stdout')
+    parser.add_argument('--width', type=int, default=0, help='Raw input: frame width')
+    parser.add_argument('--height', type=int, default=0, help='Raw input: frame height')
+    parser.add_argument('--pixFmt', type=str, default='bgr24', choices=list(PIXEL_FORMATS), help='Raw input pixel format (bgra carries a per-frame matte)')
+    parser.add_argument('--outPixFmt', type=str, default='bgr24', choices=list(PIXEL_FORMATS), help='Raw output pixel format')
+    parser.add_argument('--fps', type=float, default=0, help='Output frame rate (0 = from the source, 30 for raw input)')
+    parser.add_argument('--fourcc', type=str, default='mp4v', help='FourCC codec for video file output')
+    parser.add_argument('--workers', type=int, default=0, help='Frame processing threads (0 = CPU count)')
+    parser.add_argument('--queueSize', type=int, default=8, help='Maximum frames buffered between decode, processing and encode')
+    parser.add_argument('--statsEvery', type=int, default=30, help='Report fps and queue depth every N frames (0 = only at the end)')
+    parser.add_argument('--verbose', action='store_true', help='Keep per-frame log lines from process_image')
+    args, preset_argv = parser.parse_known_args()
+
+    # موازی‌سازی در سطح فریم است؛ هر فریم تک‌نخی اجرا می‌شود مگر اینکه preset خودش --threads بدهد
+    preset = pi.build_arg_parser().parse_args(['--threads', '1'] + preset_argv)
+    workers = args.workers or os.cpu_count() or 1
+    if workers > 1:
+        cv2.setNumThreads(1)
+
+    # stdout فقط برای فریم‌های خروجی خام؛ لاگ‌ها به stderr یا خاموش
+    output_stream = sys.stdout.buffer if args.output == '-' else None
+    sys.stdout = sys.stderr if args.verbose else open(os.devnull, "w")
+
+    try:
+        if args.input == '-':
+            if args.width <= 0 or args.height <= 0:
+                parser.error("--width and --height are required for raw input")
+            frames = read_raw_frames(sys.stdin.buffer, args.width, args.height, PIXEL_FORMATS[args.pixFmt])
+            source_fps = 0
+        else:
+            frames, source_fps = read_video_frames(args.input)
+    except Exception as e:
+        sys.stderr.write(f"Error opening input: {e}\n")
+        sys.exit(1)
+
+    writer = FrameWriter(args.output, args.fps or source_fps or 30, args.fourcc, args.outPixFmt, output_stream)
+    tracker = FaceTracker(preset.detectMaxSide) if pi.needs_face_landmarks(preset) else None
+
+    def track(frames):
+        # ردیابی landmark به ترتیب فریم‌ها و در همین نخ
+        for frame in frames:
+            if frame.shape[2] == 3:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+            faces = tracker(frame[:, :, :3]) if tracker else []
+            yield frame, faces
+
+    def process(frame, faces):
+        return pi.process_subject(frame, preset, faces=faces)
+
+    decoded, decode_queue = prefetch(frames, args.queueSize)
+    in_flight = collections.deque()
+    count = 0
+    start = time.perf_counter()
+    window_start, window_count = start, 0
+
+    def stats():
+        now = time.perf_counter()
+        return {
+            "frames": count,
+            "fps": round(count / (now - start), 2) if now > start else 0.0,
+            "recentFps": round(window_count / (now - window_start), 2) if now > window_start else 0.0,
+            "decodeQueue": decode_queue.qsize(),
+            "inFlight": len(in_flight),
+        }
+
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for result in ordered_map(executor, process, track(decoded), args.queueSize, in_flight):
+                writer.write(result)
+                count += 1
+                window_count += 1
+                if args.statsEvery > 0 and count % args.statsEvery == 0:
+                    sys.stderr.write(json.dumps(stats()) + "\n")
+                    window_start, window_count = time.perf_counter(), 0
+    except SystemExit:
+        sys.stderr.write(f"Error: frame {count} failed\n")
+        sys.exit(1)
+    except Exception as e:
+        sys.stderr.write(f"Error processing video: {e}\n")
+        sys.exit(1)
+    finally:
+        writer.close()
+
+    summary = stats()
+    summary["done"] = True
+    sys.stderr.write(json.dumps(summary) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,337 @@
+import { spawn } from "child_process";
+import fs from "fs";
+import os from "os";
+
+// یک پروسهٔ پایتون ماندگار که process_image.py را در حالت --worker اجرا می‌کند.
+// پیام‌ها در هر دو جهت با پیشوند طول 4 بایتی (big-endian) و بدنهٔ JSON فریم می‌شوند؛
+// بایت‌های تصویر ورودی/خروجی (در صورت وجود) در فریم خام بعد از پیام JSON می‌آیند.
+class PythonWorker {
+  constructor(scriptPath, options = {}) {
+    this.scriptPath = scriptPath;
+    this.options = options;
+    this.current = null;
+    this.nextId = 1;
+    this.chunks = [];
+    this.buffered = 0;
+    this.pendingReply = null;
+    this.ready = false;
+    this.exited = false;
+    this.retiring = false;
+    this.timer = null;
+    this.onReady = null;
+    this.onIdle = null;
+    this.onExit = null;
+    this.start();
+  }
+
+  start() {
+    const { maxJobs = 200, maxRssMb = 1536, pythonPath = "python3", extraArgs = [] } = this.options;
+    this.proc = spawn(pythonPath, [
+      this.scriptPath,
+      "--worker",
+      "--maxJobs", String(maxJobs),
+      "--maxRssMb", String(maxRssMb),
+      ...extraArgs.map(String),
+    ], { stdio: ["pipe", "pipe", "pipe"] });
+
+    this.proc.stdout.on("data", (chunk) => this.handleData(chunk));
+    this.proc.stderr.on("data", (chunk) => {
+      process.stdout.write(`[python ${this.proc.pid}] ${chunk}`);
+    });
+    this.proc.on("exit", (code, signal) => {
+      console.log(`Python worker ${this.proc.pid} exited (code=${code}, signal=${signal})`);
+      this.finish();
+    });
+    // خطای spawn (مثلاً مسیر نادرست پایتون) یا kill؛ ممکن است رویداد exit بعد از آن نیاید
+    this.proc.on("error", (err) => {
+      console.error(`Python worker ${this.proc.pid} error: ${err.message}`);
+      this.finish();
+    });
+    // EPIPE وقتی worker وسط نوشتن کار یا payload بمیرد؛ exit پس از آن کار را جمع می‌کند
+    this.proc.stdin.on("error", (err) => {
+      console.error(`Python worker ${this.proc.pid} stdin error: ${err.message}`);
+      this.retiring = true;
+      this.proc.kill("SIGKILL");
+    });
+  }
+
+  // پایان worker (exit یا error)، فقط یک بار: کار در حال اجرا به استخر برمی‌گردد
+  finish() {
+    if (this.exited) return;
+    this.exited = true;
+    clearTimeout(this.timer);
+    const job = this.current;
+    this.current = null;
+    if (this.onExit) this.onExit(this, job);
+  }
+
+  // تکه‌ها فقط وقتی یک فریم کامل رسید به هم چسبانده می‌شوند تا خروجی‌های بزرگ چندبار کپی نشوند
+  handleData(chunk) {
+    this.chunks.push(chunk);
+    this.buffered += chunk.length;
+    while (this.buffered >= 4) {
+      if (this.chunks[0].length < 4) {
+        this.chunks = [Buffer.concat(this.chunks)];
+      }
+      const length = this.chunks[0].readUInt32BE(0);
+      if (this.buffered < 4 + length) break;
+      const data = this.chunks.length === 1 ? this.chunks[0] : Buffer.concat(this.chunks, this.buffered);
+      const frame = data.subarray(4, 4 + length);
+      const rest = data.subarray(4 + length);
+      this.chunks = rest.length ? [rest] : [];
+      this.buffered = rest.length;
+      this.handleFrame(frame);
+    }
+  }
+
+  handleFrame(frame) {
+    if (this.pendingReply) {
+      // فریم‌های خام بایت‌های خروجی، به ترتیب message.outputs
+      const message = this.pendingReply;
+      const output = message.outputs.find((item) => !item.data);
+      output.data = frame;
+      if (message.outputs.every((item) => item.data)) {
+        this.pendingReply = null;
+        this.handleMessage(message);
+      }
+      return;
+    }
+    const message = JSON.parse(frame.toString("utf-8"));
+    if (message.outputs && message.outputs.length > 0) {
+      this.pendingReply = message;
+      return;
+    }
+    this.handleMessage(message);
+  }
+
+  handleMessage(message) {
+    if (message.ready) {
+      this.ready = true;
+      if (this.onReady) this.onReady(this);
+      return;
+    }
+    if (message.recycle) {
+      // worker بعد از این پاسخ خارج می‌شود؛ کار جدیدی به آن نمی‌دهیم
+      this.retiring = true;
+    }
+    const job = this.current;
+    if (!job || job.id !== message.id) return;
+    this.current = null;
+    clearTimeout(this.timer);
+    if (message.ok) {
+      job.resolve(message);
+    } else {
+      job.reject(new Error(message.error || "Python job failed"));
+    }
+    if (this.onIdle) this.onIdle(this);
+  }
+
+  get idle() {
+    return this.ready && !this.exited && !this.retiring && this.current === null;
+  }
+
+  send(job) {
+    job.id = this.nextId++;
+    this.current = job;
+    const { jobTimeoutMs = 0 } = this.options;
+    if (jobTimeoutMs > 0) {
+      this.timer = setTimeout(() => this.timeout(job), jobTimeoutMs);
+    }
+    const message = { id: job.id, argv: job.argv.map(String), payload: Boolean(job.payload) };
+    this.writeFrame(Buffer.from(JSON.stringify(message), "utf-8"));
+    if (job.payload) {
+      this.writeFrame(job.payload);
+    }
+  }
+
+  // کاری که از مهلتش گذشته شکست می‌خورد و worker کشته می‌شود؛ چون current خالی شده،
+  // استخر پس از خروج آن را دوباره در صف نمی‌گذارد و فقط یک worker تازه می‌سازد
+  timeout(job) {
+    if (this.current !== job) return;
+    console.error(`Python worker ${this.proc.pid} exceeded the job timeout; killing it`);
+    this.current = null;
+    this.retiring = true;
+    job.reject(new Error(`Python job timed out after ${this.options.jobTimeoutMs} ms`));
+    this.proc.kill("SIGKILL");
+  }
+
+  writeFrame(payload) {
+    const header = Buffer.alloc(4);
+    header.writeUInt32BE(payload.length, 0);
+    // هدر و بدنه جدا نوشته می‌شوند تا آپلودهای بزرگ کپی نشوند
+    this.proc.stdin.write(header);
+    this.proc.stdin.write(payload);
+  }
+
+  kill() {
+    this.retiring = true;
+    this.proc.kill("SIGKILL");
+  }
+}
+
+// حافظهٔ در دسترس پروسه: حد cgroup (داخل کانتینر) اگر از حافظهٔ کل ماشین کمتر باشد
+function availableMemoryMb() {
+  let bytes = os.totalmem();
+  for (const file of ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]) {
+    try {
+      const limit = Number(fs.readFileSync(file, "utf-8").trim());
+      if (Number.isFinite(limit) && limit > 0) bytes = Math.min(bytes, limit);
+    } catch (err) {
+      // فایل در این نسخهٔ cgroup وجود ندارد یا مقدارش "max" است
+    }
+  }
+  return bytes / (1024 * 1024);
+}
+
+// تعداد workerها بر اساس هسته‌ها و حافظه: هر worker تا maxRssMb حافظه می‌گیرد
+// و بخشی از حافظه برای خود Node و بافرهای آپلود/خروجی کنار گذاشته می‌شود.
+export function defaultPoolSize({ maxRssMb = 1536, reserveMb = 512 } = {}) {
+  const cores = os.availableParallelism ? os.availableParallelism() : os.cpus().length;
+  const byMemory = Math.floor((availableMemoryMb() - reserveMb) / maxRssMb);
+  return Math.max(1, Math.min(cores, byMemory));
+}
+
+// خطای پر بودن صف؛ سرور آن را به 503 با Retry-After تبدیل می‌کند
+export class QueueFullError extends Error {
+  constructor(message = "Python job queue is full") {
+    super(message);
+    this.code = "QUEUE_FULL";
+  }
+}
+
+// مجموعه‌ای از workerها با صف‌های اولویت‌دار؛ هر worker در هر لحظه فقط یک کار دارد
+// و workerی که خارج شود (بازیافت یا خطا) جایگزین می‌شود.
+// - پذیرش: اگر تعداد کارهای منتظر به maxQueue برسد، کار جدید با QueueFullError رد می‌شود.
+// - اولویت: صف preview (اسلایدرهای تعاملی) قبل از final خالی می‌شود، ولی بعد از
+//   previewBurst پیش‌نمایش پشت‌سرهم یک رندر نهایی منتظر اجرا می‌شود تا گرسنه نماند.
+// - ادغام: کارهایی با key یکسان (هش تصویر + argv) که هنوز تمام نشده‌اند یک بار اجرا می‌شوند.
+export class PythonWorkerPool {
+  constructor(scriptPath, { size = 1, maxAttempts = 2, maxQueue = 32, previewBurst = 3, ...options } = {}) {
+    this.scriptPath = scriptPath;
+    this.options = options;
+    this.maxAttempts = maxAttempts;
+    this.maxQueue = maxQueue;
+    this.previewBurst = previewBurst;
+    this.queues = { preview: [], final: [] };
+    this.previewStreak = 0;
+    this.inFlight = new Map();
+    this.counters = { accepted: 0, coalesced: 0, rejected: 0 };
+    this.spawnFailures = 0;
+    this.respawnTimers = new Set();
+    this.closed = false;
+    this.workers = [];
+    for (let i = 0; i < size; i++) {
+      this.workers.push(this.spawnWorker());
+    }
+  }
+
+  spawnWorker() {
+    const worker = new PythonWorker(this.scriptPath, this.options);
+    worker.onReady = () => {
+      this.spawnFailures = 0;
+      this.pump();
+    };
+    worker.onIdle = () => this.pump();
+    worker.onExit = (dead, job) => {
+      if (job) {
+        // کاری که وسط اجرا ماند، اگر سهمیهٔ تلاش دارد دوباره در ابتدای صف خودش قرار می‌گیرد
+        if (job.attempts < this.maxAttempts) {
+          this.queues[job.priority].unshift(job);
+        } else {
+          job.reject(new Error("Python worker exited before finishing the job"));
+        }
+      }
+      const index = this.workers.indexOf(dead);
+      if (index === -1 || this.closed) return;
+      // اگر worker حتی آماده هم نشده بود (کرش در شروع یا spawn ناموفق)، با تأخیر نمایی دوباره
+      // می‌سازیم تا در حلقهٔ کرش گیر نکنیم؛ اولین worker آماده شمارنده را صفر می‌کند
+      let delay = 0;
+      if (!dead.ready) {
+        this.spawnFailures += 1;
+        delay = Math.min(1000 * 2 ** (this.spawnFailures - 1), 30000);
+      }
+      const timer = setTimeout(() => {
+        this.respawnTimers.delete(timer);
+        this.workers[index] = this.spawnWorker();
+      }, delay);
+      this.respawnTimers.add(timer);
+      // کار برگشته به صف را workerهای آمادهٔ دیگر می‌توانند بردارند
+      this.pump();
+    };
+    return worker;
+  }
+
+  get queued() {
+    return this.queues.preview.length + this.queues.final.length;
+  }
+
+  nextJob() {
+    const { preview, final } = this.queues;
+    if (preview.length > 0 && (final.length === 0 || this.previewStreak < this.previewBurst)) {
+      this.previewStreak += 1;
+      return preview.shift();
+    }
+    this.previewStreak = 0;
+    return final.shift();
+  }
+
+  pump() {
+    for (const worker of this.workers) {
+      if (this.queued === 0) return;
+      if (!worker.idle) continue;
+      const job = this.nextJob();
+      job.attempts += 1;
+      worker.send(job);
+    }
+  }
+
+  // payload: بایت‌های تصویر ورودی (Buffer) برای argv با input برابر "-"؛
+  // اگر output برابر "-" باشد، بایت‌های خروجی در message.outputs[i].data برمی‌گردند.
+  // priority: "preview" یا "final"؛ key: شناسهٔ کار برای ادغام کارهای یکسان (اختیاری).
+  // پاسخ کارهای ادغام‌شده همان پاسخ با coalesced=true است (بافرهای خروجی مشترک‌اند).
+  run(argv, payload = null, { priority = "final", key = null } = {}) {
+    if (key && this.inFlight.has(key)) {
+      this.counters.coalesced += 1;
+      return this.inFlight.get(key).then((message) => ({ ...message, coalesced: true }));
+    }
+    if (this.queued >= this.maxQueue) {
+      this.counters.rejected += 1;
+      return Promise.reject(new QueueFullError());
+    }
+    this.counters.accepted += 1;
+    const lane = this.queues[priority] ? priority : "final";
+    const promise = new Promise((resolve, reject) => {
+      this.queues[lane].push({ argv, payload, priority: lane, resolve, reject, attempts: 0 });
+      this.pump();
+    });
+    if (key) {
+      this.inFlight.set(key, promise);
+      const forget = () => this.inFlight.delete(key);
+      promise.then(forget, forget);
+    }
+    return promise;
+  }
+
+  // توقف استخر: workerها کشته و کارهای منتظر رد می‌شوند
+  close() {
+    this.closed = true;
+    for (const timer of this.respawnTimers) clearTimeout(timer);
+    this.respawnTimers.clear();
+    for (const lane of Object.values(this.queues)) {
+      for (const job of lane.splice(0)) job.reject(new Error("Python worker pool closed"));
+    }
+    for (const worker of this.workers) {
+      if (!worker.exited) worker.kill();
+    }
+  }
+
+  stats() {
+    return {
+      workers: this.workers.length,
+      running: this.workers.filter((worker) => worker.current !== null).length,
+      queued: { preview: this.queues.preview.length, final: this.queues.final.length },
+      maxQueue: this.maxQueue,
+      ...this.counters,
+    };
+  }
+}
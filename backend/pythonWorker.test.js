@@ -0,0 +1,51 @@
+import { test } from "node:test";
+import assert from "node:assert/strict";
+import fs from "fs";
+import os from "os";
+import path from "path";
+import { PythonWorkerPool } from "./pythonWorker.js";
+
+// اجرا: از پوشهٔ backend با npm test (node --test)
+const PYTHON = process.env.PYTHON_PATH || "python3";
+
+// worker ساختگی: پیام ready می‌فرستد، هدر و JSON کار را می‌خواند و قبل از خواندن payload خارج می‌شود
+const STUB_WORKER = `
+import json, os, struct, sys
+out = sys.stdout.buffer
+body = json.dumps({"ready": True}).encode("utf-8")
+out.write(struct.pack(">I", len(body)) + body)
+out.flush()
+length = struct.unpack(">I", sys.stdin.buffer.read(4))[0]
+sys.stdin.buffer.read(length)
+os._exit(1)
+`;
+
+function writeStub() {
+  const dir = fs.mkdtempSync(path.join(os.tmpdir(), "worker-test-"));
+  const script = path.join(dir, "stub_worker.py");
+  fs.writeFileSync(script, STUB_WORKER);
+  return script;
+}
+
+test("a worker dying while a payload is written fails the job without crashing", async () => {
+  const pool = new PythonWorkerPool(writeStub(), { size: 1, maxAttempts: 2, pythonPath: PYTHON });
+  // payload بزرگ‌تر از بافر pipe تا worker وسط نوشتن بمیرد (EPIPE)
+  const payload = Buffer.alloc(32 * 1024 * 1024, 1);
+  try {
+    await assert.rejects(pool.run(["-", "-"], payload), /exited before finishing/);
+    // worker دوباره ساخته شده و کار بعدی هم به همان شکل کنترل‌شده شکست می‌خورد
+    await assert.rejects(pool.run(["-", "-"], payload), /exited before finishing/);
+  } finally {
+    pool.close();
+  }
+});
+
+test("a failed spawn is retried with backoff instead of crashing", async () => {
+  const pool = new PythonWorkerPool(writeStub(), { size: 1, pythonPath: "/nonexistent/python" });
+  const pending = pool.run(["-", "-"], null);
+  await new Promise((resolve) => setTimeout(resolve, 1500));
+  assert.equal(pool.spawnFailures, 2);
+  assert.equal(pool.stats().queued.final, 1);
+  pool.close();
+  await assert.rejects(pending, /pool closed/);
+});
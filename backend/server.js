@@ -1,11 +1,11 @@
+import crypto from "crypto";
 import express from "express";
 import fileUpload from "express-fileupload";
 import cors from "cors";
-import fs from "fs";
-import { execFile } from "child_process";
+import os from "os";
 import path from "path";
 import { fileURLToPath } from "url";
-import { v4 as uuidv4 } from 'uuid'; // Import uuid برای تولید نام فایل‌های منحصر به فرد
+import { PythonWorkerPool, defaultPoolSize } from "./pythonWorker.js";
 
 // تعریف __dirname در ESM
 const __filename = fileURLToPath(import.meta.url);
@@ -14,6 +14,91 @@ const __dirname = path.dirname(__filename);
 // مسیر اسکریپت پایتون
 const PROCESS_IMAGE_PATH = path.join(__dirname, "process_image.py");
 const REMBG_MODEL_NAME = "u2net_human_seg";
+
+// تنظیمات حذف بک‌گراند که درون worker پایتون اجرا می‌شود
+const REMBG_ARGS = [
+  "--removeBg", "True",
+  "--rembgModel", REMBG_MODEL_NAME,
+  "--rembgThreads", process.env.REMBG_THREADS || "0",
+  "--alphaMatting", process.env.REMBG_ALPHA_MATTING || "True",
+  "--alphaMattingForeground", process.env.REMBG_AM_FOREGROUND || "240",
+  "--alphaMattingBackground", process.env.REMBG_AM_BACKGROUND || "80",
+  "--alphaMattingErodeSize", process.env.REMBG_AM_ERODE_SIZE || "20",
+  // کش دیسکی مات‌ها: ارسال دوبارهٔ همان عکس با اسلایدرهای دیگر، rembg را دوباره اجرا نمی‌کند
+  "--matteCacheDir", process.env.MATTE_CACHE_DIR || path.join(os.tmpdir(), "matte-cache"),
+  "--matteCacheMaxMb", process.env.MATTE_CACHE_MAX_MB || "512",
+];
+
+// سقف حافظهٔ checkpointهای مراحل در هر worker: تغییر اسلایدرهای انتهایی زنجیره، مراحل قبلی را تکرار نمی‌کند
+const CHECKPOINT_MB = process.env.PYTHON_CHECKPOINT_MB || "512";
+// بیشینهٔ ضلع تصویر در حالت پیش‌نمایش (preview=true)؛ رندر کامل فقط بدون preview انجام می‌شود
+const PREVIEW_MAX_SIDE = process.env.PREVIEW_MAX_SIDE || "1024";
+
+// ابزارسنجی مراحل: هر کار یک رکورد JSON در لاگ و هدر Server-Timing در پاسخ
+const INSTRUMENT = process.env.PYTHON_INSTRUMENT || "True";
+const INSTRUMENT_MEMORY = process.env.PYTHON_INSTRUMENT_MEMORY || "False";
+
+// تنظیمات کدگذاری خروجی
+const OUTPUT_FORMATS = ["png", "webp", "jpeg"];
+const PNG_COMPRESSION = process.env.PNG_COMPRESSION || "1";
+// سقف renditionهای یک درخواست (هم‌اندازهٔ MAX_RENDITIONS در process_image.py)
+const MAX_RENDITIONS = 8;
+
+// تعداد renditionهای درخواست‌شده (لیست JSON یا رشتهٔ "maxSide[:format[:quality]],...")؛
+// JSON نامعتبر همین‌جا رد نمی‌شود و خطای آن از worker برمی‌گردد
+function countRenditions(renditions) {
+  if (Array.isArray(renditions)) return renditions.length;
+  if (typeof renditions !== "string" || renditions.trim() === "") return 0;
+  if (renditions.trim().startsWith("[")) {
+    try {
+      const parsed = JSON.parse(renditions);
+      return Array.isArray(parsed) ? parsed.length : 0;
+    } catch (e) {
+      return 0;
+    }
+  }
+  return renditions.split(",").length;
+}
+
+// ارسال خروجی‌های خام: یک خروجی مستقیم با Content-Type خودش، چند خروجی به صورت multipart/mixed
+function sendBinaryOutputs(res, outputs) {
+  if (outputs.length === 1) {
+    return res.type(outputs[0].type).send(outputs[0].data);
+  }
+  const boundary = `output-${Date.now().toString(36)}`;
+  const parts = [];
+  for (const output of outputs) {
+    parts.push(Buffer.from(
+      `--${boundary}\r\nContent-Type: ${output.type}\r\nContent-Disposition: attachment; name="${output.name}"\r\n\r\n`
+    ));
+    parts.push(output.data, Buffer.from("\r\n"));
+  }
+  parts.push(Buffer.from(`--${boundary}--\r\n`));
+  return res.type(`multipart/mixed; boundary=${boundary}`).send(Buffer.concat(parts));
+}
+
+// شمارنده‌های تجمیعی کش مات از پاسخ‌های workerها
+const matteCacheStats = { hits: 0, misses: 0, evictions: 0 };
+
+// workerهای ماندگار پایتون (cv2/mediapipe فقط یک بار بارگذاری می‌شوند)؛
+// تعداد پیش‌فرض از هسته‌ها و حافظهٔ در دسترس و سقف RSS هر worker به دست می‌آید
+const WORKER_MAX_RSS_MB = parseFloat(process.env.PYTHON_WORKER_MAX_RSS_MB || "1536");
+const WORKER_COUNT = parseInt(process.env.PYTHON_WORKERS || "0", 10) || defaultPoolSize({ maxRssMb: WORKER_MAX_RSS_MB });
+// نخ‌های پردازش کاشی‌ای هر worker: هسته‌ها بین workerها تقسیم می‌شوند تا oversubscription پیش نیاید
+const WORKER_THREADS = String(Math.max(1, Math.floor(os.cpus().length / WORKER_COUNT)));
+
+const pythonPool = new PythonWorkerPool(PROCESS_IMAGE_PATH, {
+  size: WORKER_COUNT,
+  // کارهای منتظر بیش از این تعداد با 503 رد می‌شوند
+  maxQueue: parseInt(process.env.PYTHON_MAX_QUEUE || String(WORKER_COUNT * 8), 10),
+  maxJobs: parseInt(process.env.PYTHON_WORKER_MAX_JOBS || "200", 10),
+  maxRssMb: WORKER_MAX_RSS_MB,
+  // کاری که بیش از این طول بکشد شکست می‌خورد و worker آن دوباره ساخته می‌شود (0 = بدون مهلت)
+  jobTimeoutMs: parseInt(process.env.PYTHON_JOB_TIMEOUT_MS || "120000", 10),
+  // session مدل rembg هنگام راه‌اندازی worker ساخته می‌شود
+  extraArgs: REMBG_ARGS,
+});
+
 const app = express();
 // پورت از متغیر محیطی یا 8080
 const PORT = process.env.PORT || 8080;
@@ -22,7 +107,8 @@ app.use(fileUpload());
 app.use(cors({
   origin: '*', // در صورت نیاز می‌توانید این مقدار را محدودتر کنید، مثلاً 'https://your-frontend-domain.com'
   methods: ['GET', 'POST'],
-  allowedHeaders: ['Content-Type']
+  allowedHeaders: ['Content-Type'],
+  exposedHeaders: ['Server-Timing', 'X-Outputs', 'X-Matte-Cache', 'X-Coalesced', 'Retry-After'],
 }));
 
 // روت API برای حذف بک‌گراند
@@ -36,157 +122,186 @@ app.post("/api/remove-bg", (req, res) => {
     }
     const uploadedFile = req.files.file;
 
-    // تولید نام فایل‌های موقت منحصر به فرد
-    const uniqueId = uuidv4();
-    const inputPath = path.join(__dirname, `${uniqueId}_input.png`);
-    const noBgPath = path.join(__dirname, `${uniqueId}_noBg.png`);
-    const outputPath = path.join(__dirname, `${uniqueId}_output.png`);
-
-    console.log(`Saving uploaded file to ${inputPath}`);
-    // ذخیره موقت فایل ورودی
-    fs.writeFileSync(inputPath, uploadedFile.data);
-
-    // اجرای دستور rembg
-    console.log("Executing rembg command");
-    execFile(
-      "rembg",
-      [
-        "i",
-        "--model", REMBG_MODEL_NAME,
-        "--alpha-matting",
-        "--alpha-matting-foreground-threshold", "240",
-        "--alpha-matting-background-threshold", "80",
-        "--alpha-matting-erode-size", "20",
-        inputPath,
-        noBgPath
-      ],
-      (err, stdout, stderr) => {
-        if (err) {
-          console.error("Error in rembg child_process:", err);
-          console.error("stderr output:", stderr);
-          // پاک کردن فایل‌های موقت
-          fs.unlinkSync(inputPath);
-          return res.status(500).json({ error: "Failed to remove background" });
-        }
+    // پارامترهای افکت‌ها از body
+    const {
+      blackWhiteLevel = 0.2,
+      posterizeBits = 4,
+      contrastFactor = 1.0,
+      overlayAlpha = 0.5,
+      blackLevel = 0.2,
+      whiteLevel = 0.8,
+      faceEnhance = false,
+      brightness = 0.0,
+      saturation = 0.0,
+      sharpness = 0.0,
+      hue = 0.0,
+      blur = 0.0,
+      vignette = 0.0,
+      skinSmooth = 0.0,
+      eyeBrighten = 0.0,
+      teethWhiten = 0.0,
+      lipstick = 0.0,
+      eyelashEnhance = 0.0,
+      addGlasses = false,
+      preview = false,
+      format = "png",
+      quality = 90,
+      response = "json",
+      pipeline = "",
+      renditions = "",
+    } = req.body;
 
-        console.log("rembg command executed successfully");
-
-        // پارامترهای افکت‌ها از body
-        const {
-          blackWhiteLevel = 0.2,
-          posterizeBits = 4,
-          contrastFactor = 1.0,
-          overlayAlpha = 0.5,
-          blackLevel = 0.2,
-          whiteLevel = 0.8,
-          faceEnhance = false,
-          brightness = 0.0,
-          saturation = 0.0,
-          sharpness = 0.0,
-          hue = 0.0,
-          blur = 0.0,
-          vignette = 0.0,
-          skinSmooth = 0.0,
-          eyeBrighten = 0.0,
-          teethWhiten = 0.0,
-          lipstick = 0.0,
-          eyelashEnhance = 0.0,
-          addGlasses = false,
-        } = req.body;
-
-        // تبدیل مقادیر به عدد/بولین
-        const blackWhiteLevelNum = parseFloat(blackWhiteLevel);
-        const posterizeBitsNum = parseInt(posterizeBits, 10);
-        const contrastFactorNum = parseFloat(contrastFactor);
-        const overlayAlphaNum = parseFloat(overlayAlpha);
-        const blackLevelNum = parseFloat(blackLevel);
-        const whiteLevelNum = parseFloat(whiteLevel);
-        const faceEnhanceBool = faceEnhance === 'true' || faceEnhance === true;
-        const brightnessNum = parseFloat(brightness);
-        const saturationNum = parseFloat(saturation);
-        const sharpnessNum = parseFloat(sharpness);
-        const hueNum = parseFloat(hue);
-        const blurNum = parseFloat(blur);
-        const vignetteNum = parseFloat(vignette);
-        const skinSmoothNum = parseFloat(skinSmooth);
-        const eyeBrightenNum = parseFloat(eyeBrighten);
-        const teethWhitenNum = parseFloat(teethWhiten);
-        const lipstickNum = parseFloat(lipstick);
-        const eyelashEnhanceNum = parseFloat(eyelashEnhance);
-        const addGlassesBool = addGlasses === 'true' || addGlasses === true;
-
-        console.log("Executing Python script for effects");
-        // اجرای اسکریپت پایتون برای افکت‌ها
-        execFile(
-          "python3",
-          [
-            PROCESS_IMAGE_PATH,
-            noBgPath,
-            outputPath,
-            "--blackWhiteLevel", blackWhiteLevelNum,
-            "--posterizeBits", posterizeBitsNum,
-            "--contrastFactor", contrastFactorNum,
-            "--overlayAlpha", overlayAlphaNum,
-            "--blackLevel", blackLevelNum,
-            "--whiteLevel", whiteLevelNum,
-            "--faceEnhance", faceEnhanceBool,
-            "--brightness", brightnessNum,
-            "--saturation", saturationNum,
-            "--sharpness", sharpnessNum,
-            "--hue", hueNum,
-            "--blur", blurNum,
-            "--vignette", vignetteNum,
-            "--skinSmooth", skinSmoothNum,
-            "--eyeBrighten", eyeBrightenNum,
-            "--teethWhiten", teethWhitenNum,
-            "--lipstick", lipstickNum,
-            "--eyelashEnhance", eyelashEnhanceNum,
-            "--addGlasses", addGlassesBool
-          ],
-          (pyErr, pyStdout, pyStderr) => {
-            console.log("Python stdout:", pyStdout);
-            console.log("Python stderr:", pyStderr);
-
-            if (pyErr) {
-              console.error("Error in Python script:", pyErr);
-              // پاک کردن فایل‌های موقت
-              fs.unlinkSync(inputPath);
-              fs.unlinkSync(noBgPath);
-              return res.status(500).json({ error: "Python script failed" });
+    // تبدیل مقادیر به عدد/بولین
+    const blackWhiteLevelNum = parseFloat(blackWhiteLevel);
+    const posterizeBitsNum = parseInt(posterizeBits, 10);
+    const contrastFactorNum = parseFloat(contrastFactor);
+    const overlayAlphaNum = parseFloat(overlayAlpha);
+    const blackLevelNum = parseFloat(blackLevel);
+    const whiteLevelNum = parseFloat(whiteLevel);
+    const faceEnhanceBool = faceEnhance === 'true' || faceEnhance === true;
+    const brightnessNum = parseFloat(brightness);
+    const saturationNum = parseFloat(saturation);
+    const sharpnessNum = parseFloat(sharpness);
+    const hueNum = parseFloat(hue);
+    const blurNum = parseFloat(blur);
+    const vignetteNum = parseFloat(vignette);
+    const skinSmoothNum = parseFloat(skinSmooth);
+    const eyeBrightenNum = parseFloat(eyeBrighten);
+    const teethWhitenNum = parseFloat(teethWhiten);
+    const lipstickNum = parseFloat(lipstick);
+    const eyelashEnhanceNum = parseFloat(eyelashEnhance);
+    const addGlassesBool = addGlasses === 'true' || addGlasses === true;
+    const previewBool = preview === 'true' || preview === true;
+    // فرمت خروجی: png، webp (با آلفا) یا jpeg (رنگ + ماسک آلفای جدا)
+    const outputFormat = OUTPUT_FORMATS.includes(format) ? format : "png";
+    const qualityNum = parseInt(quality, 10) || 90;
+    // مشخصات اعلانی زنجیره (JSON)؛ در صورت وجود جای پارامترهای افکت بالا را می‌گیرد
+    // فقط JSON درون‌خطی پذیرفته می‌شود؛ رشتهٔ دیگر (مثل مسیر فایل) هرگز به worker نمی‌رسد
+    const pipelineIsObject = pipeline !== null && typeof pipeline === "object";
+    if (!pipelineIsObject && !(typeof pipeline === "string" && (pipeline === "" || /^\s*[{[]/.test(pipeline)))) {
+      return res.status(400).json({ error: "pipeline must be a JSON object or array" });
+    }
+    const pipelineSpec = pipelineIsObject ? JSON.stringify(pipeline) : pipeline;
+    // چند اندازه/فرمت خروجی از یک پردازش، مثل "0:png,1024:webp:85,256:jpeg:80"؛
+    // همه با هم برمی‌گردند (JSON: base64 + <name>Base64، binary: multipart/mixed)
+    const renditionSpec = typeof renditions === "string" ? renditions : JSON.stringify(renditions);
+    if (countRenditions(renditions) > MAX_RENDITIONS) {
+      return res.status(400).json({ error: `At most ${MAX_RENDITIONS} renditions per request` });
+    }
+
+    const argv = [
+      "-",
+      "-",
+      ...REMBG_ARGS,
+      "--threads", WORKER_THREADS,
+      "--checkpointMb", CHECKPOINT_MB,
+      "--instrument", INSTRUMENT,
+      "--instrumentMemory", INSTRUMENT_MEMORY,
+      "--previewMaxSide", previewBool ? PREVIEW_MAX_SIDE : 0,
+      "--outputFormat", outputFormat,
+      "--pngCompression", PNG_COMPRESSION,
+      "--quality", qualityNum,
+      "--blackWhiteLevel", blackWhiteLevelNum,
+      "--posterizeBits", posterizeBitsNum,
+      "--contrastFactor", contrastFactorNum,
+      "--overlayAlpha", overlayAlphaNum,
+      "--blackLevel", blackLevelNum,
+      "--whiteLevel", whiteLevelNum,
+      "--faceEnhance", faceEnhanceBool,
+      "--brightness", brightnessNum,
+      "--saturation", saturationNum,
+      "--sharpness", sharpnessNum,
+      "--hue", hueNum,
+      "--blur", blurNum,
+      "--vignette", vignetteNum,
+      "--skinSmooth", skinSmoothNum,
+      "--eyeBrighten", eyeBrightenNum,
+      "--teethWhiten", teethWhitenNum,
+      "--lipstick", lipstickNum,
+      "--eyelashEnhance", eyelashEnhanceNum,
+      "--addGlasses", addGlassesBool,
+      ...(pipelineSpec ? ["--pipeline", pipelineSpec] : []),
+      ...(renditionSpec ? ["--renditions", renditionSpec] : []),
+    ];
+    // کارهای یکسان در حال اجرا (همان تصویر و همان پارامترها) یک بار محاسبه می‌شوند
+    const jobKey = crypto.createHash("sha256")
+      .update(uploadedFile.data)
+      .update(JSON.stringify(argv.map(String)))
+      .digest("hex");
+
+    console.log("Sending job to Python worker (background removal + effects)");
+    // حذف بک‌گراند و اجرای افکت‌ها هر دو در worker ماندگار پایتون انجام می‌شوند؛
+    // بایت‌های آپلود مستقیم از طریق pipe فرستاده و PNG خروجی از همان pipe گرفته می‌شود (بدون فایل موقت)
+    pythonPool
+      .run(argv, uploadedFile.data, { priority: previewBool ? "preview" : "final", key: jobKey })
+      .then((reply) => {
+        try {
+          if (reply.coalesced) {
+            res.set("X-Coalesced", "true");
+          }
+          // شمارنده‌ها فقط یک بار برای هر محاسبه جمع می‌شوند
+          if (reply.matteCache && !reply.coalesced) {
+            for (const name of Object.keys(matteCacheStats)) {
+              matteCacheStats[name] += reply.matteCache[name] || 0;
             }
+            res.set("X-Matte-Cache", reply.matteCache.hits ? "hit" : "miss");
+          }
 
-            try {
-              console.log(`Reading output file from ${outputPath}`);
-              // خواندن فایل خروجی
-              const outputBuffer = fs.readFileSync(outputPath);
-              const base64 = `data:image/png;base64,${outputBuffer.toString("base64")}`;
-
-              // پاک کردن فایل‌های موقت
-              fs.unlinkSync(inputPath);
-              fs.unlinkSync(noBgPath);
-              fs.unlinkSync(outputPath);
-
-              // ارسال نتیجه به فرانت‌اند
-              console.log("Sending response to frontend");
-              return res.json({ base64 });
-            } catch (readErr) {
-              console.error("Error reading output file:", readErr);
-              // پاک کردن فایل‌های موقت
-              fs.unlinkSync(inputPath);
-              fs.unlinkSync(noBgPath);
-              fs.unlinkSync(outputPath);
-              return res.status(500).json({ error: "Failed to read output file" });
+          if (reply.profile) {
+            if (!reply.coalesced) {
+              console.log(JSON.stringify({ event: "job", id: reply.id, rssMb: reply.rssMb, peakRssMb: reply.peakRssMb, profile: reply.profile }));
             }
+            res.set("Server-Timing", reply.serverTiming);
+          }
+
+          const outputs = reply.outputs || [];
+          if (outputs.length === 0) {
+            throw new Error("Python worker returned no image bytes");
+          }
+          res.set("X-Outputs", outputs.map((item) => `${item.name}=${item.type}`).join(", "));
+
+          // ارسال نتیجه به فرانت‌اند
+          console.log("Sending response to frontend");
+          if (response === "binary") {
+            // بایت‌های خام بدون base64؛ برای jpeg + ماسک یک پاسخ multipart/mixed
+            return sendBinaryOutputs(res, outputs);
+          }
+          const [image, ...extras] = outputs;
+          const body = { base64: `data:${image.type};base64,${image.data.toString("base64")}` };
+          for (const extra of extras) {
+            body[`${extra.name}Base64`] = `data:${extra.type};base64,${extra.data.toString("base64")}`;
           }
-        );
-      }
-    );
+          return res.json(body);
+        } catch (readErr) {
+          console.error("Error reading output image:", readErr);
+          return res.status(500).json({ error: "Failed to read output image" });
+        }
+      })
+      .catch((pyErr) => {
+        if (pyErr.code === "QUEUE_FULL") {
+          // فشار معکوس: کلاینت بعداً دوباره تلاش کند
+          console.warn("Rejecting request: Python job queue is full");
+          return res.status(503).set("Retry-After", "1").json({ error: "Server busy, try again shortly" });
+        }
+        console.error("Error in Python script:", pyErr);
+        return res.status(500).json({ error: "Python script failed" });
+      });
   } catch (error) {
     console.error("Error in /api/remove-bg route:", error);
     return res.status(500).json({ error: "Internal server error" });
   }
 });
 
+// شمارنده‌های کش مات حذف بک‌گراند
+app.get("/api/matte-cache/stats", (req, res) => {
+  res.json(matteCacheStats);
+});
+
+// وضعیت صف‌ها و workerهای پایتون
+app.get("/api/scheduler/stats", (req, res) => {
+  res.json(pythonPool.stats());
+});
+
 // -------------------------------------------------------------------
 // سرو کردن فایل‌های بیلدشده React از فولدر "public":
 const publicPath = path.join(__dirname, "public");
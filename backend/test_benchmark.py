@@ -0,0 +1,59 @@
+# test_benchmark.py
+# اجرا: از پوشهٔ backend با python -m pytest -q
+
+import json
+import math
+
+import numpy as np
+
+import benchmark
+import process_image as pi
+
+
+def test_synthetic_face_detection_patches_and_restores():
+    faces = [benchmark.synthetic_face_points((0.5, 0.4), (0.15, 0.2))]
+    original = pi.detect_faces
+    with benchmark.synthetic_face_detection(faces):
+        detected = pi.detect_faces(np.zeros((10, 10, 3), dtype=np.uint8))
+        assert len(detected) == 1 and np.array_equal(detected[0], faces[0])
+    assert pi.detect_faces is original
+
+def test_bench_pipeline_runs_face_presets_without_mediapipe():
+    # تشخیص مصنوعی جای mediapipe را می‌گیرد؛ برش سوژه و پیش‌نمایش هم روی همین landmarkها اجرا می‌شوند
+    records = benchmark.bench_pipeline([0.02], presets=["portrait", "preview"], repeats=1)
+    assert len(records) == 2 * 2 * 2
+    for record in records:
+        assert record["suite"] == "pipeline"
+        assert record["seconds"] > 0 and record["peakTracedMb"] >= 0
+
+def test_psnr():
+    a = np.full((4, 4, 3), 100, dtype=np.uint8)
+    b = a.copy()
+    assert math.isinf(benchmark.psnr(a, b))
+    b[0, 0, 0] = 110
+    mask = np.zeros((4, 4), dtype=np.uint8)
+    mask[2:, 2:] = 1
+    assert math.isinf(benchmark.psnr(a, b, mask))
+    assert benchmark.psnr(a, b) < 100
+
+def _write_run(path, records):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump({"records": records}, f)
+
+def test_compare_runs_flags_regressions(tmp_path):
+    base = {"suite": "pipeline", "name": "defaults", "megapixels": 1, "faces": True, "transparent": True}
+    _write_run(tmp_path / "base.json", [
+        dict(base, seconds=1.0),
+        dict(base, name="stylized", seconds=1.0),
+    ])
+    _write_run(tmp_path / "current.json", [
+        dict(base, seconds=1.05),
+        dict(base, name="stylized", seconds=1.5),
+        dict(base, name="portrait", seconds=2.0),
+    ])
+    rows = benchmark.compare_runs(str(tmp_path / "base.json"), str(tmp_path / "current.json"), threshold=0.1)
+    # رکورد بدون خط پایه (portrait) مقایسه نمی‌شود
+    assert [(row["name"], row["ratio"], row["regression"]) for row in rows] == [
+        ("defaults", 1.05, False),
+        ("stylized", 1.5, True),
+    ]
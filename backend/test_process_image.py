@@ -0,0 +1,168 @@
+# test_process_image.py
+# اجرا: از پوشهٔ backend با python -m pytest -q
+
+import os
+
+import cv2
+import numpy as np
+import pytest
+
+import process_image as pi
+
+
+# --- مشخصات و برنامهٔ زنجیره ---
+
+def test_normalize_pipeline_spec_fills_defaults():
+    stages = pi.normalize_pipeline_spec({"stages": [{"op": "blur", "level": "5"}, {"op": "skinSmooth"}]})
+    assert stages == [
+        ("blur", {"level": 5.0}),
+        ("skinSmooth", {"strength": 0.0, "mode": "bilateral", "quality": 0.5}),
+    ]
+
+def test_normalize_pipeline_spec_rejects_unknown_op():
+    with pytest.raises(ValueError, match="Unknown pipeline op: emboss"):
+        pi.normalize_pipeline_spec([{"op": "emboss"}])
+
+def test_normalize_pipeline_spec_rejects_unknown_param():
+    with pytest.raises(ValueError, match="radius"):
+        pi.normalize_pipeline_spec([{"op": "blur", "level": 3, "radius": 2}])
+
+def test_normalize_pipeline_spec_rejects_bad_value():
+    with pytest.raises(ValueError):
+        pi.normalize_pipeline_spec([{"op": "posterize", "bits": "many"}])
+
+@pytest.mark.parametrize("spec, message", [
+    ({"stages": "blur"}, "must be a list"),
+    (["blur"], "must be an object"),
+    ([{"op": ["blur"]}], "Unknown pipeline op"),
+    ([{"op": "overlay", "color": 5}], "Invalid value for parameter 'color'"),
+])
+def test_normalize_pipeline_spec_rejects_bad_structure(spec, message):
+    with pytest.raises(ValueError, match=message):
+        pi.normalize_pipeline_spec(spec)
+
+def test_normalize_pipeline_spec_limits_stage_count():
+    assert len(pi.normalize_pipeline_spec([{"op": "blur"}] * pi.MAX_PIPELINE_STAGES)) == pi.MAX_PIPELINE_STAGES
+    with pytest.raises(ValueError, match="Too many pipeline stages"):
+        pi.normalize_pipeline_spec([{"op": "blur", "level": 5}] * (pi.MAX_PIPELINE_STAGES + 1))
+
+def test_plan_pipeline_drops_identity_and_merges_stages():
+    plan = pi.plan_pipeline({"stages": [
+        {"op": "contrast", "factor": 1.0},
+        {"op": "posterize", "bits": 3},
+        {"op": "overlay", "alpha": 0.2},
+        {"op": "brightness", "factor": 0.1},
+        {"op": "saturation", "factor": -0.2},
+        {"op": "blur", "level": 0},
+        {"op": "vignette", "strength": 0.5},
+    ]})
+    assert [stage.kind for stage in plan.stages] == ["tone", "hsv", "vignette"]
+    assert plan.dropped == ("contrast", "blur")
+    assert dict(plan.stages[1].params) == {"brightness": 0.1, "saturation": -0.2, "hue": 0.0}
+    assert not plan.needs_landmarks and not plan.needs_alpha
+
+def test_plan_pipeline_keeps_repeated_hsv_channel_separate():
+    plan = pi.plan_pipeline([{"op": "hue", "factor": 10}, {"op": "hue", "factor": -5}])
+    assert [stage.kind for stage in plan.stages] == ["hsv", "hsv"]
+
+def test_plan_pipeline_flags_landmarks_and_alpha():
+    plan = pi.plan_pipeline([{"op": "skinSmooth", "strength": 0.5, "mode": "fast"}, {"op": "alphaClose"}])
+    assert plan.needs_landmarks and plan.needs_alpha
+
+# --- renditionها ---
+
+def test_parse_renditions_string_defaults():
+    assert pi.parse_renditions("0,1024:webp:85,256:jpeg", "png", 90) == [
+        (0, "png", 90, ""), (1024, "webp", 85, "1024"), (256, "jpeg", 90, "256"),
+    ]
+
+def test_parse_renditions_json():
+    spec = '[{"maxSide": 512, "format": "webp", "quality": 70}, {"format": "jpeg"}]'
+    assert pi.parse_renditions(spec, "png", 80) == [(512, "webp", 70, ""), (0, "jpeg", 80, "Full")]
+
+def test_parse_renditions_clamps_to_source():
+    assert pi.parse_renditions("4096,300", source_side=1000) == [(1000, "png", 90, ""), (300, "png", 90, "300")]
+
+def test_parse_renditions_names_by_requested_size():
+    # اندازه‌های بزرگ‌تر از منبع همه به 700 محدود می‌شوند ولی نامشان از اندازهٔ درخواستی است
+    renditions = pi.parse_renditions("0,4096,5000,6000", source_side=700)
+    assert [suffix for _, _, _, suffix in renditions] == ["", "4096", "5000", "6000"]
+    assert [max_side for max_side, _, _, _ in renditions] == [0, 700, 700, 700]
+
+def test_parse_renditions_unique_names_for_repeats():
+    renditions = pi.parse_renditions("0,512,512,512:webp,512,512:webp")
+    assert [suffix for _, _, _, suffix in renditions] == ["", "512", "512Png", "512Webp", "512Png2", "512Webp2"]
+
+def test_encode_renditions_outputs_have_unique_names():
+    image = np.random.default_rng(2).integers(0, 256, (70, 50, 4), dtype=np.uint8)
+    args = pi.build_arg_parser().parse_args(["-", "-", "--renditions", "0,4096,5000,6000", "--threads", "1"])
+    names = [name for name, _, _, _ in pi.encode_renditions(image, args)]
+    assert names == ["image", "image4096", "image5000", "image6000"]
+
+@pytest.mark.parametrize("spec", ["-5", "256:gif", "abc"])
+def test_parse_renditions_rejects_invalid(spec):
+    with pytest.raises(ValueError):
+        pi.parse_renditions(spec)
+
+def test_parse_renditions_limits_count():
+    assert len(pi.parse_renditions(",".join(["64"] * pi.MAX_RENDITIONS))) == pi.MAX_RENDITIONS
+    with pytest.raises(ValueError, match="Too many renditions"):
+        pi.parse_renditions(",".join(["64"] * (pi.MAX_RENDITIONS + 1)))
+
+# --- اجرای نواری ---
+
+def _gaussian(tile, out):
+    return cv2.GaussianBlur(tile, (9, 9), 0, dst=out)
+
+@pytest.mark.parametrize("tile_rows", [16, 37, 64])
+def test_run_tiled_matches_full_frame(tile_rows):
+    image = np.random.default_rng(0).integers(0, 256, (150, 90, 4), dtype=np.uint8)
+    expected = _gaussian(image, None)
+    arena = pi.BufferArena(64 * 1024 * 1024)
+    result = pi.run_tiled(image, _gaussian, halo=4, tile_rows=tile_rows, threads=2, arena=arena)
+    assert np.array_equal(result, expected)
+
+def test_run_tiled_writes_into_out():
+    image = np.random.default_rng(1).integers(0, 256, (100, 40, 3), dtype=np.uint8)
+    out = np.zeros_like(image)
+    result = pi.run_tiled(image, _gaussian, halo=4, tile_rows=24, threads=2, out=out)
+    assert result is out
+    assert np.array_equal(out, _gaussian(image, None))
+
+def test_get_tile_pool_keeps_earlier_pools_usable():
+    # نخی که استخر را گرفته نباید با درخواست تعداد نخ دیگری از نخ دیگر، استخر بسته‌شده ببیند
+    pool = pi.get_tile_pool(2)
+    assert pi.get_tile_pool(3) is not pool
+    assert pool.submit(sum, (1, 2)).result() == 3
+    assert pi.get_tile_pool(2) is pool
+
+# --- کش مات ---
+
+def _matte(seed):
+    return np.random.default_rng(seed).integers(0, 256, (48, 48, 4), dtype=np.uint8)
+
+def _disk_bytes(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(directory) for name in files)
+
+def test_matte_cache_evicts_least_recently_used(tmp_path):
+    entry_bytes = cv2.imencode(".png", _matte(0), [cv2.IMWRITE_PNG_COMPRESSION, 1])[1].nbytes
+    cache = pi.MatteCache(str(tmp_path), int(entry_bytes * 2.5))
+    cache.put("aa01", _matte(0))
+    os.utime(cache._path("aa01"), (1000, 1000))
+    cache.put("bb02", _matte(1))
+    os.utime(cache._path("bb02"), (2000, 2000))
+    # خواندن aa01 آن را جدیدترین ورودی می‌کند؛ پس bb02 اول حذف می‌شود
+    assert np.array_equal(cache.get("aa01"), _matte(0))
+    cache.put("cc03", _matte(2))
+
+    assert cache.get("bb02") is None
+    assert cache.get("aa01") is not None and cache.get("cc03") is not None
+    assert cache.evictions == 1
+    assert cache._total_bytes == _disk_bytes(tmp_path)
+
+def test_matte_cache_overwrite_keeps_total(tmp_path):
+    cache = pi.MatteCache(str(tmp_path), 64 * 1024 * 1024)
+    for seed in range(4):
+        cache.put("dd04", _matte(seed))
+    assert cache._total_bytes == _disk_bytes(tmp_path)
+    assert cache.evictions == 0